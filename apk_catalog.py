@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Local catalog of Magisk releases for offline patching
+APKs are mirrored into one directory and listed in a JSON index keyed by
+version code, with their SHA256, architectures and payload cache keys, so
+lookups never reopen or rehash the APKs.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+
+from apk_index import ApkError, load_apk_index
+from fastcopy import copy_and_hash, hash_file
+from payload_cache import default_cache_dir
+
+
+CATALOG_INDEX = "catalog.json"
+
+
+class CatalogError(Exception):
+    """Raised when a version is not in the catalog or an APK cannot be added"""
+
+
+def default_catalog_dir():
+    """Return the catalog directory, honouring MAGISK_PATCHER_CATALOG"""
+    return os.environ.get("MAGISK_PATCHER_CATALOG") or os.path.join(default_cache_dir(), "catalog")
+
+
+class ApkCatalog:
+    """Directory of mirrored APKs plus a catalog.json index
+
+    Entries are keyed by version code; version names are indexed too, so
+    get() accepts 27000, "27000", "27.0", "v27.0" or "latest".
+    """
+
+    def __init__(self, root=None):
+        self.root = root or default_catalog_dir()
+        self.index_path = os.path.join(self.root, CATALOG_INDEX)
+        self.entries = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f).get("versions", {})
+        except (OSError, ValueError):
+            entries = {}
+        self.entries = {int(code): entry for code, entry in entries.items()}
+        self._names = {entry["version_name"]: code for code, entry in self.entries.items()
+                       if entry.get("version_name")}
+
+    def save(self):
+        """Write the index atomically"""
+        data = {"versions": {str(code): entry for code, entry in sorted(self.entries.items())}}
+        fd, tmp_path = tempfile.mkstemp(prefix=".catalog-", dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def add(self, apk_path):
+        """Mirror an APK into the catalog and index it, returning its entry"""
+        try:
+            index = load_apk_index(apk_path)
+        except (OSError, ApkError) as e:
+            raise CatalogError(str(e))
+        if not index.version_code:
+            raise CatalogError(f"No MAGISK_VER_CODE in {os.path.basename(apk_path)}")
+
+        filename = f"Magisk-{index.version_name or index.version_code}.apk"
+        rel_path = os.path.join("apks", str(index.version_code), filename)
+        dst_path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+
+        # Copy and hash in one pass; an APK already in place is only hashed
+        if os.path.abspath(apk_path) == os.path.abspath(dst_path):
+            digest = hash_file(apk_path)
+        else:
+            digest = copy_and_hash(apk_path, dst_path + ".tmp")
+            os.replace(dst_path + ".tmp", dst_path)
+
+        entry = {
+            "version_code": index.version_code,
+            "version_name": index.version_name,
+            "path": rel_path,
+            "sha256": digest.sha256,
+            "size": digest.size,
+            "archs": index.archs,
+            "payloads": {},
+            "added": time.time(),
+        }
+        with self._lock:
+            previous = self.entries.get(index.version_code)
+            if previous and previous["sha256"] == entry["sha256"]:
+                entry["payloads"] = previous.get("payloads", {})
+            self.entries[index.version_code] = entry
+            if index.version_name:
+                self._names[index.version_name] = index.version_code
+            self.save()
+        return entry
+
+    def add_directory(self, directory):
+        """Add every .apk below directory, returning the added entries"""
+        added = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith(".apk"):
+                    added.append(self.add(os.path.join(dirpath, filename)))
+        return added
+
+    def get(self, version):
+        """Return the entry for a version code, version name or "latest" """
+        text = str(version).strip()
+        if text == "latest":
+            if not self.entries:
+                raise CatalogError("The catalog is empty")
+            return self.entries[max(self.entries)]
+        if text.isdigit() and int(text) in self.entries:
+            return self.entries[int(text)]
+        code = self._names.get(text) or self._names.get(text.lstrip("v"))
+        if code is None:
+            raise CatalogError(f"Magisk {text} is not in the catalog")
+        return self.entries[code]
+
+    def path_for(self, version):
+        """Absolute path of the APK for version"""
+        path = os.path.join(self.root, self.get(version)["path"])
+        if not os.path.exists(path):
+            raise CatalogError(f"Catalog APK is missing: {path}")
+        return path
+
+    def remove(self, version):
+        entry = self.get(version)
+        with self._lock:
+            del self.entries[entry["version_code"]]
+            self._names.pop(entry["version_name"], None)
+            self.save()
+        try:
+            os.remove(os.path.join(self.root, entry["path"]))
+        except OSError:
+            pass
+        return entry
+
+    def record_payloads(self, version, payload_keys):
+        """Point a version at its payload cache entries (arch -> cache key)"""
+        entry = self.get(version)
+        with self._lock:
+            entry["payloads"].update(payload_keys)
+            self.save()
+
+    def prime(self, payload_cache):
+        """Tell payload_cache the SHA256 of every catalog APK, so it never rehashes them"""
+        for code in self.entries:
+            entry = self.entries[code]
+            path = os.path.join(self.root, entry["path"])
+            if os.path.exists(path):
+                payload_cache.remember_sha256(path, entry["sha256"])
+
+    def versions(self):
+        """Entries sorted by version code, newest first"""
+        return [self.entries[code] for code in sorted(self.entries, reverse=True)]
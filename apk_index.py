@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Magisk APK index
+One pass over the zip central directory yields the Magisk version, the
+per-architecture libraries and every member's offset. Indexes are memoized
+per path, size and mtime, so selection, validation and extraction share one.
+"""
+
+import os
+import re
+import shutil
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fastcopy import BUFFER_SIZE
+
+
+UTIL_FUNCTIONS = "assets/util_functions.sh"
+STUB_APK = "stub.apk"
+
+# Libraries shipped in the APK that are not part of the boot payload
+SKIPPED_LIBS = ["libmagiskboot.so", "libbusybox.so", "libmagiskpolicy.so"]
+
+# Before Magisk 28 a 64-bit device also gets magisk32 from its 32-bit sibling ABI
+COMPAT_32BIT_ARCHS = {"arm64-v8a": "armeabi-v7a", "x86_64": "x86"}
+COMPAT_32BIT_LIB = "libmagisk32.so"
+COMPAT_32BIT_MAX_VERSION = 28000
+
+
+class ApkError(Exception):
+    """Raised when a file is not a readable Magisk APK"""
+
+
+def payload_name(lib_name):
+    """Payload file name of an APK library, e.g. libmagiskinit.so -> magiskinit"""
+    return lib_name.replace('lib', '').replace('.so', '')
+
+
+class ApkIndex:
+    """Central-directory index of a Magisk APK
+
+    libs maps arch -> {library name: ZipInfo}; ZipInfo.header_offset is the
+    member's offset in the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version_code = 0
+        self.version_name = ""
+        self.libs = {}
+        self.stub = None
+        self.members = {}
+
+        try:
+            with zipfile.ZipFile(path, 'r') as apk:
+                for info in apk.infolist():
+                    self._add_member(info)
+                if UTIL_FUNCTIONS in self.members:
+                    self._read_version(apk.read(UTIL_FUNCTIONS))
+        except (OSError, zipfile.BadZipFile) as e:
+            raise ApkError(f"Cannot read APK {os.path.basename(path)}: {str(e)}")
+
+    def _add_member(self, info):
+        self.members[info.filename] = info
+        parts = info.filename.split('/')
+        if len(parts) == 3 and parts[0] == 'lib' and parts[2].startswith('lib') \
+                and parts[2].endswith('.so'):
+            self.libs.setdefault(parts[1], {})[parts[2]] = info
+        elif parts[-1] == STUB_APK and len(parts) >= 2:
+            self.stub = info
+
+    def _read_version(self, content):
+        content = content.decode('utf-8', errors='replace')
+        match = re.search(r'MAGISK_VER_CODE=(\d+)', content)
+        if match:
+            self.version_code = int(match.group(1))
+        match = re.search(r'MAGISK_VER="([^"]+)"', content)
+        if match:
+            self.version_name = match.group(1)
+
+    @property
+    def archs(self):
+        return list(self.libs)
+
+    @property
+    def offsets(self):
+        """Member name -> offset of its local header"""
+        return {name: info.header_offset for name, info in self.members.items()}
+
+    def has_arch(self, arch):
+        return arch in self.libs
+
+    def payload_members(self, arch):
+        """Return {payload file name: ZipInfo} needed to patch for arch
+
+        This is the arch's libraries minus SKIPPED_LIBS, magisk32 from the
+        32-bit sibling ABI for Magisk before 28000, and stub.apk.
+        """
+        members = {}
+        compat_arch = COMPAT_32BIT_ARCHS.get(arch)
+        if self.version_code < COMPAT_32BIT_MAX_VERSION and compat_arch:
+            compat = self.libs.get(compat_arch, {}).get(COMPAT_32BIT_LIB)
+            if compat:
+                members[payload_name(COMPAT_32BIT_LIB)] = compat
+
+        for lib_name, info in self.libs.get(arch, {}).items():
+            if lib_name not in SKIPPED_LIBS:
+                members[payload_name(lib_name)] = info
+
+        if self.stub:
+            members[STUB_APK] = self.stub
+        return members
+
+    def extract(self, members, dest_dir, max_workers=None):
+        """Stream members ({output name: ZipInfo}) into dest_dir, returning name -> path
+
+        Members are inflated concurrently over a thread pool sharing one
+        open zip file; zlib releases the GIL while decompressing.
+        """
+        def extract_member(apk, info, output_path):
+            with apk.open(info) as src, open(output_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, BUFFER_SIZE)
+
+        extracted = {name: os.path.join(dest_dir, name) for name in members}
+        with zipfile.ZipFile(self.path, 'r') as apk:
+            if len(members) <= 1:
+                for name, info in members.items():
+                    extract_member(apk, info, extracted[name])
+                return extracted
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(extract_member, apk, info, extracted[name])
+                           for name, info in members.items()]
+                for future in futures:
+                    future.result()
+        return extracted
+
+    def extract_archs(self, archs, dest_dir, max_workers=None):
+        """Extract the payloads of several architectures in one parallel pass
+
+        Members shared between architectures (stub.apk, the 32-bit compat
+        magisk32) are inflated once and linked into every dest_dir/<arch>.
+        Returns arch -> {name: path}.
+        """
+        plans = {arch: self.payload_members(arch) for arch in archs}
+        unique = {}
+        for members in plans.values():
+            for info in members.values():
+                # Flatten member paths, e.g. lib/x86/libmagisk32.so -> lib_x86_libmagisk32.so
+                unique[info.filename.replace('/', '_')] = info
+
+        members_dir = os.path.join(dest_dir, ".members")
+        os.makedirs(members_dir, exist_ok=True)
+        inflated = self.extract(unique, members_dir, max_workers)
+
+        payloads = {}
+        for arch, members in plans.items():
+            arch_dir = os.path.join(dest_dir, arch)
+            os.makedirs(arch_dir, exist_ok=True)
+            payloads[arch] = {}
+            for name, info in members.items():
+                path = os.path.join(arch_dir, name)
+                src_path = inflated[info.filename.replace('/', '_')]
+                try:
+                    os.link(src_path, path)
+                except OSError:
+                    shutil.copyfile(src_path, path)
+                payloads[arch][name] = path
+        return payloads
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_apk_index(path):
+    """Return the ApkIndex of path, memoized per path, size and mtime"""
+    stat = os.stat(path)
+    memo_key = os.path.abspath(path)
+    with _indexes_lock:
+        cached = _indexes.get(memo_key)
+        if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return cached[1]
+
+    index = ApkIndex(path)
+    with _indexes_lock:
+        _indexes[memo_key] = ((stat.st_size, stat.st_mtime_ns), index)
+    return index
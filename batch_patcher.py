@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Batch patching of many boot images over a process pool
+Each job runs the headless engine in its own isolated working directory and
+leaves a .log, .events.jsonl and .report.json next to its output image
+"""
+
+import os
+import json
+import time
+import tempfile
+import shutil
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from apk_catalog import CatalogError
+from patch_engine import ARCHITECTURES, PatchEngine, PatchError, PatchOptions, calculate_sha256
+from payload_cache import DEFAULT_CACHE_SIZE, PayloadCache, ResultCache
+from patch_log import write_report
+from vbmeta import DISABLE_FLAGS, vbmeta_record
+
+
+class BatchJob:
+    """One manifest entry: boot image, APK, arch and options"""
+
+    def __init__(self, name, boot_image, apk_path, arch="arm64-v8a", options=None, output_path=None):
+        self.name = name
+        self.boot_image = boot_image
+        self.apk_path = apk_path
+        self.arch = arch
+        self.options = options or PatchOptions()
+        self.output_path = output_path
+
+
+def load_manifest(manifest_path, output_dir, catalog=None):
+    """Load batch jobs from a JSON manifest
+
+    The manifest is either a list of jobs or an object with a "jobs" list and
+    optional "defaults" applied to every job.  Each job has "boot", "apk" and
+    optionally "name", "arch", "output" and "options" (PatchOptions keywords).
+    With a catalog, "magisk_version" (code, name or "latest") may be given
+    instead of "apk". Relative paths are resolved against the manifest
+    directory.
+    """
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    defaults = manifest.get("defaults", {})
+
+    def resolve(path):
+        return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+    jobs = []
+    names = set()
+    outputs = {}
+    for index, job_entry in enumerate(manifest.get("jobs", [])):
+        entry = dict(defaults, **job_entry)
+        options = dict(defaults.get("options", {}), **entry.get("options", {}))
+
+        if "boot" not in entry:
+            raise PatchError(f"Manifest job {index} is missing 'boot'")
+
+        # A version given on the job itself beats an APK from the defaults
+        if "apk" in entry and ("apk" in job_entry or "magisk_version" not in job_entry):
+            apk_path = resolve(entry["apk"])
+        elif "magisk_version" in entry:
+            if catalog is None:
+                raise PatchError(f"Manifest job {index} selects a Magisk version but no catalog "
+                                 f"is available")
+            try:
+                apk_path = catalog.path_for(entry["magisk_version"])
+            except CatalogError as e:
+                raise PatchError(f"Manifest job {index}: {str(e)}")
+        else:
+            raise PatchError(f"Manifest job {index} is missing 'apk'")
+
+        arch = entry.get("arch", "arm64-v8a")
+        if arch not in ARCHITECTURES:
+            raise PatchError(f"Manifest job {index} has unknown architecture: {arch}")
+
+        name = entry.get("name") or os.path.splitext(os.path.basename(entry["boot"]))[0]
+        if name in names:
+            suffix = index
+            while f"{name}_{suffix}" in names:
+                suffix += 1
+            name = f"{name}_{suffix}"
+        names.add(name)
+
+        output = entry.get("output") or f"{name}_magisk_patched.img"
+        output = output if os.path.isabs(output) else os.path.join(output_dir, output)
+        # Jobs sharing an output would also share its .log, .events.jsonl and .report.json
+        output_key = os.path.normcase(os.path.abspath(output))
+        if output_key in outputs:
+            raise PatchError(f"Manifest jobs {outputs[output_key]} and {index} both write {output}")
+        outputs[output_key] = index
+
+        jobs.append(BatchJob(name, resolve(entry["boot"]), apk_path, arch,
+                             PatchOptions.from_dict(options), output))
+
+    return jobs
+
+
+def _file_logger(log_file):
+    """Return a log callable writing engine output to log_file"""
+    def log(message, level="INFO"):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        if level:
+            log_file.write(f"[{timestamp}] [{level}] {message}\n")
+        else:
+            log_file.write(f"{message}\n")
+    return log
+
+
+def _payload_cache(cache_dir, cache_size):
+    return PayloadCache(cache_dir, cache_size) if cache_dir else None
+
+
+def _result_cache(cache_dir, result_cache_size):
+    return ResultCache(cache_dir, result_cache_size) if cache_dir and result_cache_size else None
+
+
+def warm_payloads(apk_path, archs, magiskboot_path, cache_dir, cache_size=DEFAULT_CACHE_SIZE,
+                  engine_options=None):
+    """Fill the payload cache for every arch of one APK in a worker process"""
+    engine = PatchEngine(magiskboot_path, log=lambda message, level="INFO": None,
+                         payload_cache=_payload_cache(cache_dir, cache_size),
+                         **(engine_options or {}))
+    return engine.prepare_payloads(apk_path, archs)
+
+
+def run_job(job, magiskboot_path, scratch_dir=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+            engine_options=None, result_cache_size=None):
+    """Patch a single job in a worker process and return its result record
+
+    engine_options are extra PatchEngine keyword arguments, e.g. backends.
+    A result_cache_size enables the result cache under cache_dir.
+    """
+    started = time.perf_counter()
+    record = {
+        "name": job.name,
+        "boot": job.boot_image,
+        "arch": job.arch,
+        "output": job.output_path,
+        "status": "failed",
+        "error": "",
+        "seconds": 0.0,
+        "input_sha256": "",
+        "output_sha256": "",
+        "report": "",
+        "cached": False,
+    }
+
+    work_dir = None
+    base_path = os.path.splitext(job.output_path)[0]
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(job.output_path)), exist_ok=True)
+        with open(base_path + ".log", 'w') as log_file, \
+                open(base_path + ".events.jsonl", 'w') as event_file:
+            engine = PatchEngine(magiskboot_path, log=_file_logger(log_file),
+                                 payload_cache=_payload_cache(cache_dir, cache_size),
+                                 result_cache=_result_cache(cache_dir, result_cache_size),
+                                 event_stream=event_file, **(engine_options or {}))
+            if scratch_dir:
+                work_dir = tempfile.mkdtemp(prefix="magisk_patch_", dir=scratch_dir)
+            else:
+                work_dir = engine.make_work_dir(job.boot_image)
+            try:
+                result = engine.patch(job.boot_image, job.apk_path, job.arch, job.options,
+                                      output_path=job.output_path, work_dir=work_dir)
+                record["status"] = "ok"
+                record["input_sha256"] = result.original_sha256
+                record["output_sha256"] = result.sha256
+                record["cached"] = result.report.get("result_cache", {}).get("hit", False)
+            except Exception as e:
+                engine.log(f"Error: {str(e)}", "ERROR")
+                record["error"] = str(e)
+
+        if engine.report:
+            engine.report["name"] = job.name
+            write_report(engine.report, base_path + ".report.json")
+            record["report"] = base_path + ".report.json"
+    except OSError as e:
+        record["error"] = str(e)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not record["input_sha256"] and os.path.exists(job.boot_image):
+        record["input_sha256"] = calculate_sha256(job.boot_image)
+
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run_batch(jobs, magiskboot_path, max_workers=None, scratch_dir=None, on_result=None,
+              cache_dir=None, cache_size=DEFAULT_CACHE_SIZE, engine_options=None,
+              result_cache_size=None, vbmeta_images=None, vbmeta_flags=DISABLE_FLAGS,
+              on_vbmeta=None):
+    """Patch all jobs over a process pool, returning records in manifest order
+
+    With a cache_dir, the payloads of every distinct APK are prepared up
+    front, all of its architectures in one step, so the jobs only restore
+    them. A result_cache_size also lets jobs whose inputs were patched
+    before reuse the stored image.
+
+    vbmeta_images get their flags set to vbmeta_flags on the same pool,
+    alongside the jobs; each vbmeta.vbmeta_record is passed to on_vbmeta.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    # Keyed by manifest index: names are unique, but a caller may build jobs itself
+    records = {}
+
+    vbmeta_images = vbmeta_images or []
+    tasks = len(jobs) + len(vbmeta_images)
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, max(tasks, 1))) as pool:
+        # vbmeta images are independent of the payloads, so they start first
+        vbmeta_futures = [pool.submit(vbmeta_record, path, vbmeta_flags) for path in vbmeta_images]
+
+        if cache_dir:
+            payloads = {}
+            for job in jobs:
+                if os.path.exists(job.apk_path):
+                    archs = payloads.setdefault(os.path.abspath(job.apk_path), [])
+                    if job.arch not in archs:
+                        archs.append(job.arch)
+            warmups = [pool.submit(warm_payloads, apk_path, archs, magiskboot_path,
+                                   cache_dir, cache_size, engine_options)
+                       for apk_path, archs in payloads.items()]
+            for future in warmups:
+                try:
+                    future.result()
+                except Exception:
+                    # The job itself will report the extraction failure
+                    pass
+
+        futures = {pool.submit(run_job, job, magiskboot_path, scratch_dir, cache_dir, cache_size,
+                               engine_options, result_cache_size): index
+                   for index, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            job = jobs[index]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"name": job.name, "boot": job.boot_image, "arch": job.arch,
+                          "output": job.output_path, "status": "failed", "error": str(e),
+                          "seconds": 0.0, "input_sha256": "", "output_sha256": "", "report": "",
+                          "cached": False}
+            records[index] = record
+            if on_result:
+                on_result(record)
+
+        for path, future in zip(vbmeta_images, vbmeta_futures):
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"path": path, "status": "failed", "error": str(e), "source": "",
+                          "offset": -1, "old_flags": None, "flags": vbmeta_flags,
+                          "patched": False}
+            if on_vbmeta:
+                on_vbmeta(record)
+
+    return [records[index] for index in range(len(jobs))]
+
+
+def format_results(records):
+    """Format batch results as a plain text table"""
+    headers = ["JOB", "ARCH", "STATUS", "SECONDS", "INPUT SHA256", "OUTPUT SHA256"]
+    rows = [[r["name"], r["arch"], r["status"], f"{r['seconds']:.2f}",
+             r["input_sha256"][:16], r["output_sha256"][:16] or r["error"]] for r in records]
+
+    widths = [max(len(str(row[i])) for row in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    ok = sum(1 for r in records if r["status"] == "ok")
+    total = sum(r["seconds"] for r in records)
+    lines.append("")
+    lines.append(f"{ok}/{len(records)} succeeded, {total:.2f}s total job time")
+    return "\n".join(lines)
@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the patch pipeline
+Generates synthetic boot images (header v0-v4, several kernel and ramdisk
+sizes, with and without dtb) and a Magisk-layout APK, patches them through
+a stand-in magiskboot and reports throughput, per-stage latency percentiles
+and memory. Results are saved as JSON so runs can be compared.
+"""
+
+import os
+import sys
+import json
+import stat
+import struct
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from time import perf_counter
+
+from batch_patcher import BatchJob, run_batch
+from bootimg import BootImage
+from cpio import Cpio, CpioEntry
+from fdt import check_and_patch, dtb_test, scan_fdts
+from hexpatch import HexPatch, apply_hexpatches
+from patch_engine import (ARCHITECTURES, CPIO_BACKENDS, DTB_BACKENDS, HEXPATCH_BACKENDS,
+                          KERNEL_PATCHES, PatchOptions)
+from payload_cache import parse_size
+from xz_backend import XZ_BACKENDS, compress_xz
+
+
+HEADER_VERSIONS = [0, 1, 2, 3, 4]
+DEFAULT_KERNEL_SIZES = ["4M", "16M"]
+DEFAULT_RAMDISK_SIZES = ["1M", "8M"]
+DEFAULT_PAYLOAD_SIZE = "1M"
+DEFAULT_VERSION_CODE = 27000
+PERCENTILES = [50, 90, 99]
+
+BOOT_V0_HEADER_SIZES = {0: 1632, 1: 1648, 2: 1660}
+BOOT_V3_HEADER_SIZES = {3: 1580, 4: 1584}
+BOOT_V0_PAGE_SIZE = 2048
+BOOT_V3_PAGE_SIZE = 4096
+
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_END = 9
+
+# Cold starts of the CLI; these modules must only load on the paths that use them
+STARTUP_RUNS = 5
+LAZY_MODULES = ["tkinter", "requests", "webbrowser"]
+STARTUP_PROBE = """import sys, json
+sys.path.insert(0, {repo!r})
+import enhanced_magisk_patcher
+print(json.dumps([name for name in {modules!r} if name in sys.modules]))
+"""
+
+STANDIN_SCRIPT = """#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+from benchmark import standin_magiskboot
+sys.exit(standin_magiskboot(sys.argv[1:]))
+"""
+
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+def _align(data, page_size):
+    return data + b"\0" * (-len(data) % page_size)
+
+
+def _payload(rng, size):
+    """Half random, half repetitive bytes, so xz has something to do"""
+    noise = rng.randbytes(size // 2)
+    return noise + (b"magisk-bench\0\0\0\0" * (size // 32 + 1))[:size - len(noise)]
+
+
+def build_fdt(nodes):
+    """Serialize a device tree given as {name: value or nested dict}"""
+    strings = bytearray()
+    offsets = {}
+    struct_block = bytearray()
+
+    def string_offset(name):
+        if name not in offsets:
+            offsets[name] = len(strings)
+            strings.extend(name.encode() + b"\0")
+        return offsets[name]
+
+    def node(name, children):
+        struct_block.extend(struct.pack(">I", FDT_BEGIN_NODE))
+        struct_block.extend(_align(name.encode() + b"\0", 4))
+        for key, value in children.items():
+            if isinstance(value, dict):
+                continue
+            value = value.encode() + b"\0" if isinstance(value, str) else value
+            struct_block.extend(struct.pack(">III", FDT_PROP, len(value), string_offset(key)))
+            struct_block.extend(_align(value, 4))
+        for key, value in children.items():
+            if isinstance(value, dict):
+                node(key, value)
+        struct_block.extend(struct.pack(">I", FDT_END_NODE))
+
+    node("", nodes)
+    struct_block.extend(struct.pack(">I", FDT_END))
+
+    rsvmap = b"\0" * 16
+    off_rsvmap = 40
+    off_struct = off_rsvmap + len(rsvmap)
+    off_strings = off_struct + len(struct_block)
+    totalsize = off_strings + len(strings)
+    header = struct.pack(">10I", 0xd00dfeed, totalsize, off_struct, off_strings, off_rsvmap,
+                         17, 16, 0, len(strings), len(struct_block))
+    return header + rsvmap + bytes(struct_block) + bytes(strings)
+
+
+def sample_dtb():
+    """A device tree with the /chosen and fstab nodes Magisk looks at"""
+    return build_fdt({
+        "compatible": "magisk,bench",
+        "chosen": {"bootargs": "console=ttyMSM0 skip_initramfs rootwait"},
+        "firmware": {"android": {"fstab": {
+            "system": {"dev": "/dev/block/by-name/system", "mnt_point": "/system",
+                       "type": "ext4", "fsmgr_flags": "wait,slotselect,avb=vbmeta,verify"},
+            "vendor": {"dev": "/dev/block/by-name/vendor", "mnt_point": "/vendor",
+                       "type": "ext4", "fsmgr_flags": "wait,slotselect,avb"},
+        }}},
+    })
+
+
+def build_kernel(rng, size):
+    """Kernel-like blob that every KERNEL_PATCHES pattern matches once"""
+    patterns = b"".join(bytes.fromhex(old) for old, _ in KERNEL_PATCHES)
+    return _payload(rng, max(size - len(patterns), 0)) + patterns
+
+
+def build_ramdisk(rng, size):
+    """Stock newc ramdisk of about size bytes"""
+    fstab = (b"/dev/block/by-name/system /system ext4 ro wait,verify,avb=vbmeta\n"
+             b"/dev/block/by-name/userdata /data f2fs noatime wait,forceencrypt=footer\n")
+    ramdisk = Cpio({
+        "init": CpioEntry(stat.S_IFREG | 0o750, _payload(rng, max(size // 4, 1024))),
+        "fstab.bench": CpioEntry(stat.S_IFREG | 0o640, fstab),
+        "system": CpioEntry(stat.S_IFDIR | 0o755),
+        "system/etc": CpioEntry(stat.S_IFDIR | 0o755),
+        "verity_key": CpioEntry(stat.S_IFREG | 0o644, rng.randbytes(524)),
+    })
+    remaining = size - size // 4
+    index = 0
+    while remaining > 0:
+        chunk = min(remaining, 1024 * 1024)
+        ramdisk.entries[f"system/etc/blob{index}"] = CpioEntry(stat.S_IFREG | 0o644,
+                                                              _payload(rng, chunk))
+        remaining -= chunk
+        index += 1
+    return b"".join(bytes(chunk) for chunk in ramdisk.serialize())
+
+
+def build_boot_image(version, kernel, ramdisk, dtb=b"", second=b""):
+    """Build an AOSP boot image with header version 0-4
+
+    v2 carries dtb in its own section; the other versions append it to the
+    kernel, where magiskboot finds it as kernel_dtb.
+    """
+    if version == 2 or not dtb:
+        dtb_section = dtb
+    else:
+        kernel, dtb_section = kernel + dtb, b""
+
+    if version <= 2:
+        page = BOOT_V0_PAGE_SIZE
+        header = b"ANDROID!" + struct.pack("<10I", len(kernel), 0x8000, len(ramdisk), 0x1000000,
+                                           len(second), 0xf00000, 0x100, page, version, 0)
+        header += b"bench".ljust(16, b"\0") + b"console=ttyMSM0".ljust(512, b"\0")
+        header += b"\0" * 32 + b"\0" * 1024
+        if version >= 1:
+            header += struct.pack("<IQI", 0, 0, BOOT_V0_HEADER_SIZES[version])
+        if version >= 2:
+            header += struct.pack("<IQ", len(dtb_section), 0x1f00000)
+        image = _align(header, page) + _align(kernel, page) + _align(ramdisk, page)
+        image += _align(second, page)
+        if version >= 2:
+            image += _align(dtb_section, page)
+        return image
+
+    page = BOOT_V3_PAGE_SIZE
+    header = b"ANDROID!" + struct.pack("<4I", len(kernel), len(ramdisk), 0,
+                                       BOOT_V3_HEADER_SIZES[version])
+    header += b"\0" * 16 + struct.pack("<I", version) + b"console=ttyMSM0".ljust(1536, b"\0")
+    if version == 4:
+        header += struct.pack("<I", 0)
+    return _align(header, page) + _align(kernel, page) + _align(ramdisk, page)
+
+
+def build_apk(path, version_code=DEFAULT_VERSION_CODE, payload_size=1024 * 1024,
+              archs=ARCHITECTURES, seed=0):
+    """Write a synthetic APK with Magisk's lib/, assets/ and stub.apk layout"""
+    rng = random.Random(seed)
+    version_name = f"{version_code // 1000}.{version_code % 1000 // 100}"
+    util_functions = (f'MAGISK_VER="{version_name}"\n'
+                      f"MAGISK_VER_CODE={version_code}\n").encode()
+
+    with zipfile.ZipFile(path, "w") as apk:
+        apk.writestr("AndroidManifest.xml", rng.randbytes(4096), zipfile.ZIP_DEFLATED)
+        apk.writestr("assets/util_functions.sh", util_functions, zipfile.ZIP_DEFLATED)
+        apk.writestr("assets/stub.apk", _payload(rng, payload_size // 4), zipfile.ZIP_STORED)
+        for arch in archs:
+            libs = ["libmagiskinit.so", "libinit-ld.so", "libmagiskboot.so", "libbusybox.so"]
+            if version_code >= 28000:
+                libs.append("libmagisk.so")
+            elif arch in ("arm64-v8a", "x86_64"):
+                libs.append("libmagisk64.so")
+            else:
+                libs.append("libmagisk32.so")
+            for lib in libs:
+                apk.writestr(f"lib/{arch}/{lib}", _payload(rng, payload_size), zipfile.ZIP_STORED)
+    return path
+
+
+class Fixture:
+    """One synthetic boot image of the benchmark matrix"""
+
+    def __init__(self, version, kernel_size, ramdisk_size, dtb):
+        self.version = version
+        self.kernel_size = kernel_size
+        self.ramdisk_size = ramdisk_size
+        self.dtb = dtb
+        self.path = None
+
+    @property
+    def name(self):
+        dtb = "dtb" if self.dtb else "nodtb"
+        return f"v{self.version}-k{self.kernel_size}-r{self.ramdisk_size}-{dtb}"
+
+    def build(self, directory):
+        rng = random.Random(f"{self.name}")
+        image = build_boot_image(self.version, build_kernel(rng, self.kernel_size),
+                                 build_ramdisk(rng, self.ramdisk_size),
+                                 sample_dtb() if self.dtb else b"")
+        self.path = os.path.join(directory, f"{self.name}.img")
+        with open(self.path, "wb") as f:
+            f.write(image)
+        return self.path
+
+    def to_dict(self):
+        return {"name": self.name, "version": self.version, "kernel_size": self.kernel_size,
+                "ramdisk_size": self.ramdisk_size, "dtb": self.dtb}
+
+
+def fixture_matrix(versions, kernel_sizes, ramdisk_sizes, dtb_modes):
+    return [Fixture(version, kernel_size, ramdisk_size, dtb)
+            for version in versions
+            for kernel_size in kernel_sizes
+            for ramdisk_size in ramdisk_sizes
+            for dtb in dtb_modes]
+
+
+# ---------------------------------------------------------------------------
+# Stand-in magiskboot
+# ---------------------------------------------------------------------------
+
+def _write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _read(path, default=b""):
+    if not os.path.exists(path):
+        return default
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _standin_unpack(image_path):
+    with BootImage(image_path) as image:
+        if image.kind != "boot":
+            print("Only boot images are supported by the stand-in", file=sys.stderr)
+            return 1
+        for name, filename in [("kernel", "kernel"), ("ramdisk", "ramdisk.cpio"),
+                               ("second", "second"), ("dtb", "dtb"), ("kernel_dtb", "kernel_dtb")]:
+            if image.has(name):
+                _write(filename, image.view(name))
+        with open("header", "w") as f:
+            json.dump({"version": image.header_version}, f)
+    return 0
+
+
+def _standin_repack(image_path, output="new-boot.img"):
+    with open("header", "r") as f:
+        version = json.load(f)["version"]
+
+    # Like magiskboot, an unpatched (removed) kernel is taken from the original
+    kernel = _read("kernel", None)
+    if kernel is None:
+        with BootImage(image_path) as image:
+            kernel = bytes(image.view("kernel"))
+    dtb = _read("dtb") if version == 2 else _read("kernel_dtb")
+
+    _write(output, build_boot_image(version, kernel, _read("ramdisk.cpio"), dtb, _read("second")))
+    return 0
+
+
+def _standin_cpio(archive_path, commands):
+    ramdisk = Cpio.load(archive_path) if os.path.exists(archive_path) else Cpio()
+    for command in commands:
+        args = command.split()
+        if args[0] == "test":
+            return ramdisk.test()
+        if args[0] == "add":
+            ramdisk.add(int(args[1], 8), args[2], args[3])
+        elif args[0] == "mkdir":
+            ramdisk.mkdir(int(args[1], 8), args[2])
+        elif args[0] == "rm":
+            ramdisk.rm(args[-1], recursive=args[1] == "-r")
+        elif args[0] == "extract":
+            ramdisk.extract(args[1], args[2])
+        elif args[0] == "patch":
+            ramdisk.patch(os.environ.get("KEEPVERITY") == "true",
+                          os.environ.get("KEEPFORCEENCRYPT") == "true")
+        elif args[0] == "backup":
+            ramdisk.backup(Cpio.load(args[1]))
+        elif args[0] == "restore":
+            ramdisk.restore()
+        else:
+            print(f"Unsupported cpio command: {command}", file=sys.stderr)
+            return 1
+    ramdisk.dump(archive_path)
+    return 0
+
+
+def standin_magiskboot(argv):
+    """Minimal magiskboot for benchmarks, built on the native modules
+
+    Implements unpack, repack, cpio, compress=xz, hexpatch, dtb and sha1
+    for plain (uncompressed) boot images.
+    """
+    if not argv:
+        return 1
+    command = argv[0]
+
+    if command == "unpack":
+        return _standin_unpack(argv[-1])
+    if command == "repack":
+        return _standin_repack(*argv[1:3])
+    if command == "cpio":
+        return _standin_cpio(argv[1], argv[2:])
+    if command == "compress=xz":
+        compress_xz(argv[1], argv[2])
+        return 0
+    if command == "hexpatch":
+        matches = apply_hexpatches(argv[1], [HexPatch(argv[2], argv[3])])
+        return 0 if any(matches.values()) else 1
+    if command == "dtb":
+        if argv[2] == "test":
+            data = _read(argv[1])
+            return 0 if dtb_test(data, scan_fdts(data)) else 1
+        keep_verity = os.environ.get("KEEPVERITY", "true") == "true"
+        _, patched, _ = check_and_patch(argv[1], keep_verity,
+                                        log=lambda message: print(message, file=sys.stderr))
+        return 0 if patched else 1
+    if command == "sha1":
+        print(hashlib.sha1(_read(argv[1])).hexdigest())
+        return 0
+
+    print(f"Unsupported command: {command}", file=sys.stderr)
+    return 1
+
+
+def write_standin_magiskboot(directory):
+    """Write an executable stand-in magiskboot script and return its path"""
+    path = os.path.join(directory, "magiskboot")
+    with open(path, "w") as f:
+        f.write(STANDIN_SCRIPT.format(python=sys.executable,
+                                      repo=os.path.dirname(os.path.abspath(__file__))))
+    os.chmod(path, 0o755)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# Runner and statistics
+# ---------------------------------------------------------------------------
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-pct * len(ordered) // 100))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_stages(reports):
+    """Per-stage wall/CPU percentiles and peak memory over all reports"""
+    samples = {}
+    for report in reports:
+        for name, stage in report.get("stages", {}).items():
+            metrics = stage.get("metrics", {})
+            sample = samples.setdefault(name, {"wall": [], "cpu": [], "peak_rss": [],
+                                               "child_peak_rss": []})
+            sample["wall"].append(metrics.get("wall", stage.get("seconds", 0.0)))
+            sample["cpu"].append(metrics.get("cpu", 0.0))
+            sample["peak_rss"].append(metrics.get("peak_rss", 0))
+            sample["child_peak_rss"].append(metrics.get("child_peak_rss", 0))
+
+    stages = {}
+    for name, sample in samples.items():
+        wall = sample["wall"]
+        summary = {f"p{pct}": round(percentile(wall, pct), 6) for pct in PERCENTILES}
+        summary["mean"] = round(sum(wall) / len(wall), 6)
+        summary["cpu_p50"] = round(percentile(sample["cpu"], 50), 6)
+        summary["peak_rss"] = max(sample["peak_rss"])
+        summary["child_peak_rss"] = max(sample["child_peak_rss"])
+        summary["samples"] = len(wall)
+        stages[name] = summary
+    return stages
+
+
+def run_benchmark(fixtures, apk_path, magiskboot_path, work_dir, arch="arm64-v8a", jobs=1,
+                  repeat=1, cache=False, engine_options=None):
+    """Patch every fixture repeat times and return the results dict"""
+    output_dir = os.path.join(work_dir, "out")
+    batch_jobs = []
+    for run in range(repeat):
+        for fixture in fixtures:
+            batch_jobs.append(BatchJob(f"{fixture.name}-{run}", fixture.path, apk_path, arch,
+                                       PatchOptions(),
+                                       os.path.join(output_dir, f"{fixture.name}-{run}.img")))
+
+    cache_dir = os.path.join(work_dir, "cache") if cache else None
+    started = perf_counter()
+    records = run_batch(batch_jobs, magiskboot_path, max_workers=jobs, cache_dir=cache_dir,
+                        engine_options=engine_options)
+    elapsed = perf_counter() - started
+
+    reports = []
+    for record in records:
+        if record.get("report") and os.path.exists(record["report"]):
+            with open(record["report"], "r") as f:
+                reports.append(json.load(f))
+
+    ok = sum(1 for record in records if record["status"] == "ok")
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count()},
+        "config": {"arch": arch, "jobs": jobs, "repeat": repeat, "cache": cache,
+                   "engine": engine_options or {}},
+        "images": len(records),
+        "failed": len(records) - ok,
+        "elapsed": round(elapsed, 3),
+        "images_per_min": round(ok / elapsed * 60, 2) if elapsed else 0.0,
+        "peak_rss": max((stage["metrics"].get("peak_rss", 0) for report in reports
+                         for stage in report["stages"].values() if "metrics" in stage),
+                        default=0),
+        "stages": summarize_stages(reports),
+        "fixtures": [fixture.to_dict() for fixture in fixtures],
+        "runs": [{"name": record["name"], "status": record["status"],
+                  "seconds": record["seconds"], "error": record["error"]}
+                 for record in records],
+    }
+
+
+def measure_startup(runs=STARTUP_RUNS):
+    """Time cold starts of `enhanced_magisk_patcher.py --help` in fresh interpreters
+
+    Also reports which LAZY_MODULES a plain import of the module loads.
+    """
+    repo = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(repo, "enhanced_magisk_patcher.py")
+    samples = []
+    for _ in range(runs):
+        started = perf_counter()
+        subprocess.run([sys.executable, script, "--help"], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+        samples.append(perf_counter() - started)
+
+    probe = subprocess.run([sys.executable, "-c",
+                            STARTUP_PROBE.format(repo=repo, modules=LAZY_MODULES)],
+                           stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return {
+        "p50": round(percentile(samples, 50), 4),
+        "max": round(max(samples), 4),
+        "runs": runs,
+        "eager_modules": json.loads(probe.stdout),
+    }
+
+
+def format_startup(startup):
+    line = f"CLI startup: p50 {startup['p50'] * 1000:.1f}ms, max {startup['max'] * 1000:.1f}ms " \
+           f"over {startup['runs']} runs"
+    if startup["eager_modules"]:
+        line += f"; imported eagerly: {', '.join(startup['eager_modules'])}"
+    return line
+
+
+def check_startup_budget(startup, budget):
+    """Return the reasons startup misses budget seconds, empty when it fits"""
+    problems = []
+    if startup["p50"] > budget:
+        problems.append(f"p50 {startup['p50'] * 1000:.1f}ms exceeds the "
+                        f"{budget * 1000:.0f}ms budget")
+    if startup["eager_modules"]:
+        problems.append(f"{', '.join(startup['eager_modules'])} imported at startup")
+    return problems
+
+
+def format_benchmark(results):
+    """Format benchmark results as a plain text table"""
+    headers = ["STAGE", "P50", "P90", "P99", "MEAN", "CPU P50", "PEAK RSS"]
+    rows = [[name, *(f"{stage[f'p{pct}'] * 1000:.1f}ms" for pct in PERCENTILES),
+             f"{stage['mean'] * 1000:.1f}ms", f"{stage['cpu_p50'] * 1000:.1f}ms",
+             f"{stage['peak_rss'] / (1024 * 1024):.1f}M"]
+            for name, stage in results["stages"].items()]
+
+    widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    lines.append("")
+    lines.append(f"{results['images'] - results['failed']}/{results['images']} images in "
+                 f"{results['elapsed']:.2f}s: {results['images_per_min']:.1f} images/min, "
+                 f"peak RSS {results['peak_rss'] / (1024 * 1024):.1f}M")
+    if results.get("startup"):
+        lines.append(format_startup(results["startup"]))
+    return "\n".join(lines)
+
+
+def compare_results(baseline, results):
+    """Format throughput and per-stage p50 changes against a baseline run"""
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    lines = [f"images/min: {baseline['images_per_min']:.1f} -> {results['images_per_min']:.1f} "
+             f"({change(baseline['images_per_min'], results['images_per_min'])})"]
+    for name, stage in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if old:
+            lines.append(f"  {name}: p50 {old['p50'] * 1000:.1f}ms -> {stage['p50'] * 1000:.1f}ms "
+                         f"({change(old['p50'], stage['p50'])})")
+        else:
+            lines.append(f"  {name}: new stage, p50 {stage['p50'] * 1000:.1f}ms")
+    if baseline.get("startup") and results.get("startup"):
+        old, new = baseline["startup"]["p50"], results["startup"]["p50"]
+        lines.append(f"CLI startup p50: {old * 1000:.1f}ms -> {new * 1000:.1f}ms "
+                     f"({change(old, new)})")
+    return "\n".join(lines)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the patch pipeline on synthetic boot images")
+    parser.add_argument("--versions", default=",".join(map(str, HEADER_VERSIONS)),
+                        help="Boot header versions to generate (default: %(default)s)")
+    parser.add_argument("--kernel-sizes", default=",".join(DEFAULT_KERNEL_SIZES),
+                        help="Kernel sizes, e.g. 4M,16M (default: %(default)s)")
+    parser.add_argument("--ramdisk-sizes", default=",".join(DEFAULT_RAMDISK_SIZES),
+                        help="Ramdisk sizes, e.g. 1M,8M (default: %(default)s)")
+    parser.add_argument("--dtb", default="both", choices=["both", "yes", "no"],
+                        help="Generate images with a dtb, without, or both (default: both)")
+    parser.add_argument("--payload-size", type=parse_size, default=DEFAULT_PAYLOAD_SIZE,
+                        help="Size of each APK library (default: %(default)s)")
+    parser.add_argument("--version-code", type=int, default=DEFAULT_VERSION_CODE,
+                        help="MAGISK_VER_CODE of the synthetic APK (default: %(default)s)")
+    parser.add_argument("--arch", default="arm64-v8a", choices=ARCHITECTURES)
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Worker processes (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Patch every image this many times (default: 1)")
+    parser.add_argument("--cache", action="store_true",
+                        help="Use a payload cache shared by all runs")
+    parser.add_argument("--magiskboot",
+                        help="Real magiskboot to benchmark instead of the stand-in")
+    parser.add_argument("--xz-backend", default="lzma", choices=XZ_BACKENDS)
+    parser.add_argument("--cpio-backend", default="native", choices=CPIO_BACKENDS)
+    parser.add_argument("--hexpatch-backend", default="native", choices=HEXPATCH_BACKENDS)
+    parser.add_argument("--dtb-backend", default="native", choices=DTB_BACKENDS)
+    parser.add_argument("--work-dir", help="Keep fixtures and outputs here instead of a temp dir")
+    parser.add_argument("--results", help="Save results as JSON (default: "
+                                          "bench_results/bench_<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--startup-runs", type=int, default=STARTUP_RUNS,
+                        help="Cold starts of the CLI to time (default: %(default)s, 0 to skip)")
+    parser.add_argument("--startup-budget", type=float,
+                        help="Fail when the CLI startup p50 exceeds this many seconds or "
+                             "tkinter, requests or webbrowser load at import")
+    parser.add_argument("--startup-only", action="store_true",
+                        help="Only time the CLI startup, without patching")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+
+    startup = measure_startup(args.startup_runs) if args.startup_runs > 0 else None
+    budget_problems = check_startup_budget(startup, args.startup_budget) \
+        if startup and args.startup_budget else []
+    for problem in budget_problems:
+        print(f"Startup budget: {problem}", file=sys.stderr)
+    if args.startup_only:
+        if startup:
+            print(format_startup(startup))
+        return 0 if not budget_problems else 1
+
+    versions = [int(version) for version in args.versions.split(",")]
+    kernel_sizes = [parse_size(size) for size in args.kernel_sizes.split(",")]
+    ramdisk_sizes = [parse_size(size) for size in args.ramdisk_sizes.split(",")]
+    dtb_modes = {"both": [False, True], "yes": [True], "no": [False]}[args.dtb]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="magisk_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        fixtures = fixture_matrix(versions, kernel_sizes, ramdisk_sizes, dtb_modes)
+        fixture_dir = os.path.join(work_dir, "fixtures")
+        os.makedirs(fixture_dir, exist_ok=True)
+        for fixture in fixtures:
+            fixture.build(fixture_dir)
+        apk_path = build_apk(os.path.join(fixture_dir, "Magisk.apk"), args.version_code,
+                             args.payload_size)
+        magiskboot_path = os.path.abspath(args.magiskboot) if args.magiskboot \
+            else write_standin_magiskboot(work_dir)
+        print(f"Generated {len(fixtures)} boot images in {fixture_dir}", file=sys.stderr)
+
+        results = run_benchmark(fixtures, apk_path, magiskboot_path, work_dir, args.arch,
+                                args.jobs, args.repeat, args.cache,
+                                {"xz_backend": args.xz_backend,
+                                 "cpio_backend": args.cpio_backend,
+                                 "hexpatch_backend": args.hexpatch_backend,
+                                 "dtb_backend": args.dtb_backend})
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results["startup"] = startup
+    print(format_benchmark(results))
+
+    results_path = args.results or os.path.join(
+        "bench_results", f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    print(f"Results saved to: {results_path}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print()
+            print(compare_results(json.load(f), results))
+
+    return 0 if not results["failed"] and not budget_problems else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
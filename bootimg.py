@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Android boot image header parser
+Supports AOSP boot image header versions 0-4, the PXA variant of v0 and
+vendor_boot v3/v4.
+Sections are exposed as zero-copy memoryviews over an mmap of the image.
+"""
+
+import os
+import mmap
+import struct
+
+
+BOOT_MAGIC = b"ANDROID!"
+VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+AVB_FOOTER_MAGIC = b"AVBf"
+AVB_FOOTER_SIZE = 64
+FDT_MAGIC = b"\xd0\x0d\xfe\xed"
+MTK_MAGIC = b"\x88\x16\x88\x58"
+
+# Leading wrappers (DHTB, ChromeOS, ...) put the AOSP header a little later
+HEADER_SEARCH_LIMIT = 0x1000
+
+BOOT_V3_PAGE_SIZE = 4096
+# A v0 page size this large is the PXA header's address word, as magiskboot detects it
+PXA_PAGE_SIZE_MIN = 0x02000000
+PXA_HEADER_SIZE = 1640
+VENDOR_RAMDISK_ENTRY_SIZE = 108
+
+VENDOR_RAMDISK_TYPES = {0: "none", 1: "platform", 2: "recovery", 3: "dlkm"}
+
+# Leading bytes of the formats magiskboot can decompress
+COMPRESSION_MAGICS = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\x1f\x9e", "gzip"),
+    (b"\x02\x21\x4c\x18", "lz4_legacy"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+    (b"\x03\x21\x4c\x18", "lz4_lg"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x5d\x00\x00", "lzma"),
+    (b"BZh", "bzip2"),
+    (b"070701", "cpio"),
+    (b"070702", "cpio"),
+    (FDT_MAGIC, "dtb"),
+]
+
+
+class BootImageError(Exception):
+    """Raised when an image cannot be parsed as an Android boot image"""
+
+
+class Section:
+    """Byte range of one section inside the image"""
+
+    def __init__(self, name, offset, size):
+        self.name = name
+        self.offset = offset
+        self.size = size
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    def __repr__(self):
+        return f"Section({self.name!r}, offset={self.offset:#x}, size={self.size})"
+
+
+def _align(value, page_size):
+    return (value + page_size - 1) // page_size * page_size
+
+
+def _cstring(data):
+    return bytes(data).split(b"\0", 1)[0].decode("ascii", errors="replace")
+
+
+def detect_format(data):
+    """Return the compression or content format of a section from its magic"""
+    head = bytes(data[:8])
+    for magic, name in COMPRESSION_MAGICS:
+        if head.startswith(magic):
+            return name
+    if len(data) >= 0x3c and bytes(data[0x38:0x3c]) == b"ARMd":
+        return "raw_arm64"
+    if head.startswith(MTK_MAGIC):
+        return "mtk"
+    return "raw"
+
+
+def find_fdt(data, start=0, end=None):
+    """Return the offset of the first plausible FDT header in data[start:end], or -1
+
+    data is anything with find() and the buffer protocol, e.g. bytes or mmap.
+    The whole blob, not just its header, must fit before end.
+    """
+    size = len(data) if end is None else min(end, len(data))
+    offset = data.find(FDT_MAGIC, start, size)
+    while offset >= 0:
+        if offset + 40 <= size:
+            totalsize, off_struct, off_strings = struct.unpack_from(">III", data, offset + 4)
+            if 40 <= totalsize <= size - offset and off_struct < totalsize and off_strings < totalsize:
+                return offset
+        offset = data.find(FDT_MAGIC, offset + 4, size)
+    return -1
+
+
+class BootImage:
+    """Parsed boot or vendor_boot image backed by a read-only mmap
+
+    Use as a context manager, or call close() when done; section views
+    returned by view() are only valid while the image is open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sections = {}
+        self.vendor_ramdisks = []
+        self.kind = None
+        self.header_offset = 0
+        self.header_version = 0
+        self.page_size = 0
+        self.os_version = 0
+        self.name = ""
+        self.cmdline = ""
+        self.avb_footer = None
+        self.pxa = False
+
+        self._file = open(path, "rb")
+        try:
+            if os.fstat(self._file.fileno()).st_size == 0:
+                raise BootImageError("Empty image")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @property
+    def size(self):
+        return len(self._map)
+
+    def view(self, name):
+        """Return a zero-copy memoryview of a section"""
+        section = self.sections[name]
+        return memoryview(self._map)[section.offset:section.end]
+
+    def has(self, name):
+        return name in self.sections
+
+    def read(self, offset, size):
+        """Return a copy of size bytes at an absolute offset"""
+        return self._map[offset:offset + size]
+
+    def _u32(self, offset):
+        return struct.unpack_from("<I", self._map, self.header_offset + offset)[0]
+
+    def _raw(self, offset, length):
+        start = self.header_offset + offset
+        return self._map[start:start + length]
+
+    def _add_section(self, name, offset, size):
+        if size <= 0:
+            return offset
+        offset += self.header_offset
+        if offset + size > self.size:
+            raise BootImageError(f"Section {name} ({size} bytes at {offset:#x}) exceeds image size")
+        self.sections[name] = Section(name, offset, size)
+        return offset - self.header_offset + _align(size, self.page_size)
+
+    def _parse(self):
+        limit = min(self.size, HEADER_SEARCH_LIMIT)
+        boot_offset = self._map.find(BOOT_MAGIC, 0, limit)
+        vendor_offset = self._map.find(VENDOR_BOOT_MAGIC, 0, limit)
+
+        if boot_offset >= 0:
+            self.kind = "boot"
+            self.header_offset = boot_offset
+            self.header_version = self._u32(40)
+            if self._u32(36) >= PXA_PAGE_SIZE_MIN:
+                self._parse_boot_pxa()
+            elif self.header_version >= 3:
+                self._parse_boot_v3()
+            else:
+                self._parse_boot_v0()
+        elif vendor_offset >= 0:
+            self.kind = "vendor_boot"
+            self.header_offset = vendor_offset
+            self._parse_vendor_boot()
+        else:
+            raise BootImageError("No AOSP boot or vendor_boot header found")
+
+        self._parse_avb_footer()
+        self._find_kernel_dtb()
+
+    def _parse_boot_v0(self):
+        if self.header_version > 2:
+            raise BootImageError(f"Unsupported boot header version {self.header_version}")
+        (kernel_size, _, ramdisk_size, _, second_size, _, _, page_size,
+         _, os_version) = struct.unpack_from("<10I", self._map, self.header_offset + 8)
+
+        if page_size == 0 or page_size & (page_size - 1):
+            raise BootImageError(f"Invalid page size {page_size}")
+        self.page_size = page_size
+        self.os_version = os_version
+        self.name = _cstring(self._raw(48, 16))
+        self.cmdline = _cstring(self._raw(64, 512)) + _cstring(self._raw(608, 1024))
+
+        header_size = 1632
+        recovery_dtbo_size = dtb_size = 0
+        if self.header_version >= 1:
+            recovery_dtbo_size = self._u32(1632)
+            header_size = self._u32(1644) or header_size
+        if self.header_version >= 2:
+            dtb_size = self._u32(1648)
+
+        offset = _align(header_size, page_size)
+        offset = self._add_section("kernel", offset, kernel_size)
+        offset = self._add_section("ramdisk", offset, ramdisk_size)
+        offset = self._add_section("second", offset, second_size)
+        offset = self._add_section("recovery_dtbo", offset, recovery_dtbo_size)
+        self._add_section("dtb", offset, dtb_size)
+
+    def _parse_boot_pxa(self):
+        """v0 with an extra section after second, which magiskboot unpacks as extra"""
+        (kernel_size, _, ramdisk_size, _, second_size, _, extra_size, _, _,
+         page_size) = struct.unpack_from("<10I", self._map, self.header_offset + 8)
+
+        if page_size == 0 or page_size & (page_size - 1):
+            raise BootImageError(f"Invalid page size {page_size}")
+        self.pxa = True
+        self.header_version = 0
+        self.page_size = page_size
+        self.name = _cstring(self._raw(48, 24))
+        self.cmdline = _cstring(self._raw(72, 512)) + _cstring(self._raw(616, 1024))
+
+        offset = _align(PXA_HEADER_SIZE, page_size)
+        offset = self._add_section("kernel", offset, kernel_size)
+        offset = self._add_section("ramdisk", offset, ramdisk_size)
+        offset = self._add_section("second", offset, second_size)
+        self._add_section("extra", offset, extra_size)
+
+    def _parse_boot_v3(self):
+        if self.header_version > 4:
+            raise BootImageError(f"Unsupported boot header version {self.header_version}")
+        kernel_size, ramdisk_size, os_version, header_size = \
+            struct.unpack_from("<4I", self._map, self.header_offset + 8)
+
+        self.page_size = BOOT_V3_PAGE_SIZE
+        self.os_version = os_version
+        self.cmdline = _cstring(self._raw(44, 1536))
+
+        signature_size = self._u32(1580) if self.header_version >= 4 else 0
+
+        offset = _align(header_size or 1580, self.page_size)
+        offset = self._add_section("kernel", offset, kernel_size)
+        offset = self._add_section("ramdisk", offset, ramdisk_size)
+        self._add_section("signature", offset, signature_size)
+
+    def _parse_vendor_boot(self):
+        self.header_version = self._u32(8)
+        if self.header_version not in (3, 4):
+            raise BootImageError(f"Unsupported vendor_boot header version {self.header_version}")
+        page_size = self._u32(12)
+        if page_size == 0 or page_size & (page_size - 1):
+            raise BootImageError(f"Invalid page size {page_size}")
+        self.page_size = page_size
+        ramdisk_size = self._u32(24)
+        self.cmdline = _cstring(self._raw(28, 2048))
+        self.name = _cstring(self._raw(2080, 16))
+        header_size = self._u32(2096)
+        dtb_size = self._u32(2100)
+
+        table_size = entry_num = entry_size = bootconfig_size = 0
+        if self.header_version >= 4:
+            table_size, entry_num, entry_size, bootconfig_size = \
+                struct.unpack_from("<4I", self._map, self.header_offset + 2112)
+
+        offset = _align(header_size or 2112, page_size)
+        ramdisk_offset = offset
+        offset = self._add_section("ramdisk", offset, ramdisk_size)
+        offset = self._add_section("dtb", offset, dtb_size)
+        table_offset = offset
+        offset = self._add_section("vendor_ramdisk_table", offset, table_size)
+        self._add_section("bootconfig", offset, bootconfig_size)
+
+        if entry_num and entry_size >= VENDOR_RAMDISK_ENTRY_SIZE:
+            base = self.header_offset + table_offset
+            for index in range(entry_num):
+                entry = base + index * entry_size
+                size, rel_offset, ramdisk_type = struct.unpack_from("<3I", self._map, entry)
+                name = _cstring(self._map[entry + 12:entry + 44])
+                start = self.header_offset + ramdisk_offset + rel_offset
+                if start + size > self.size:
+                    raise BootImageError(f"Vendor ramdisk {name or index} exceeds image size")
+                self.vendor_ramdisks.append({
+                    "name": name,
+                    "type": VENDOR_RAMDISK_TYPES.get(ramdisk_type, str(ramdisk_type)),
+                    "offset": start,
+                    "size": size,
+                    "format": detect_format(self._map[start:start + 8]),
+                })
+
+    def _parse_avb_footer(self):
+        if self.size < AVB_FOOTER_SIZE:
+            return
+        footer = self.size - AVB_FOOTER_SIZE
+        if self._map[footer:footer + 4] != AVB_FOOTER_MAGIC:
+            return
+        major, minor, original_size, vbmeta_offset, vbmeta_size = \
+            struct.unpack_from(">IIQQQ", self._map, footer + 4)
+        self.avb_footer = {
+            "version": f"{major}.{minor}",
+            "original_image_size": original_size,
+            "vbmeta_offset": vbmeta_offset,
+            "vbmeta_size": vbmeta_size,
+        }
+
+    def _find_kernel_dtb(self):
+        """Locate a dtb appended to the kernel, which magiskboot splits into kernel_dtb"""
+        if "kernel" not in self.sections:
+            return
+        kernel = self.sections["kernel"]
+        # Like magiskboot, only the kernel bytes are searched
+        offset = find_fdt(self._map, kernel.offset, kernel.end)
+        if offset >= 0:
+            self.sections["kernel"] = Section("kernel", kernel.offset, offset - kernel.offset)
+            self.sections["kernel_dtb"] = Section("kernel_dtb", offset, kernel.end - offset)
+
+    def describe(self):
+        """Return a JSON-serializable description of the image"""
+        sections = {}
+        for name, section in self.sections.items():
+            sections[name] = {
+                "offset": section.offset,
+                "size": section.size,
+                "format": detect_format(self._map[section.offset:section.offset + 0x40]),
+            }
+
+        description = {
+            "path": self.path,
+            "size": self.size,
+            "kind": self.kind,
+            "header_version": self.header_version,
+            "header_offset": self.header_offset,
+            "page_size": self.page_size,
+            "os_version": self.os_version,
+            "name": self.name,
+            "cmdline": self.cmdline,
+            "sections": sections,
+        }
+        if self.pxa:
+            description["pxa"] = True
+        if self.vendor_ramdisks:
+            description["vendor_ramdisks"] = self.vendor_ramdisks
+        if self.avb_footer:
+            description["avb_footer"] = self.avb_footer
+        return description
+
+
+def inspect_boot_image(path):
+    """Parse path and return its description dict"""
+    with BootImage(path) as image:
+        return image.describe()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Subprocess layer for magiskboot and other helper commands
+Every call has a timeout, stops when its CancelToken is set, has its output
+read on a separate thread and takes one of a limited number of process
+slots, so parallel stages never start more processes than the runner allows.
+"""
+
+import os
+import signal
+import threading
+import subprocess
+from time import perf_counter
+
+
+# A magiskboot call handles one boot image; minutes mean it is stuck
+DEFAULT_TIMEOUT = 300
+POLL_INTERVAL = 0.05
+
+# Own process group on POSIX, so a timeout or cancel also kills grandchildren
+_POPEN_SESSION = {"start_new_session": True} if os.name == "posix" else {}
+
+
+class CommandCancelled(Exception):
+    """Raised when a command is started or running after its token was cancelled"""
+
+
+class CancelToken:
+    """Cooperative cancellation flag shared between the UI and workers"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise CommandCancelled("Cancelled")
+
+
+class CommandResult:
+    """Exit status and captured output of one command"""
+
+    def __init__(self, argv, returncode, output="", seconds=0.0, timed_out=False, error=""):
+        self.argv = argv
+        self.returncode = returncode
+        self.output = output
+        self.seconds = seconds
+        self.timed_out = timed_out
+        self.error = error
+
+
+def _kill(process):
+    try:
+        if _POPEN_SESSION:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass
+
+
+def _pump(stream, lines, on_line):
+    """Read a process pipe to the end on its own thread"""
+    for line in iter(stream.readline, ''):
+        lines.append(line)
+        if on_line:
+            on_line(line)
+
+
+class CommandRunner:
+    """Run commands with timeouts, cancellation and a cap on concurrent processes
+
+    One runner is shared by everything a PatchEngine starts, so concurrent
+    stages queue for max_processes slots. Cancelling the token kills the
+    running commands and makes every later run() raise CommandCancelled;
+    a cancelled runner stays cancelled.
+    """
+
+    def __init__(self, max_processes=None, timeout=DEFAULT_TIMEOUT, cancel_token=None):
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.timeout = timeout
+        self.cancel_token = cancel_token or CancelToken()
+        self._slots = threading.BoundedSemaphore(self.max_processes)
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def run(self, argv, cwd=None, env=None, timeout=None, on_line=None, merge_stderr=True):
+        """Run argv to completion and return its CommandResult
+
+        on_line is called with every output line as it arrives, from the
+        reader thread. stderr is merged into the output unless merge_stderr
+        is False, in which case it is discarded. A timeout kills the command
+        and returns returncode -1 with timed_out set.
+        """
+        self.cancel_token.check()
+        while not self._slots.acquire(timeout=POLL_INTERVAL):
+            self.cancel_token.check()
+        try:
+            return self._run(argv, cwd, env, timeout or self.timeout, on_line, merge_stderr)
+        finally:
+            self._slots.release()
+
+    def _run(self, argv, cwd, env, timeout, on_line, merge_stderr):
+        started = perf_counter()
+        try:
+            process = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if merge_stderr else subprocess.DEVNULL,
+                cwd=cwd,
+                env=env,
+                universal_newlines=True,
+                errors="replace",
+                **_POPEN_SESSION
+            )
+        except (OSError, ValueError) as e:
+            return CommandResult(argv, -1, seconds=perf_counter() - started, error=str(e))
+
+        lines = []
+        reader = threading.Thread(target=_pump, args=(process.stdout, lines, on_line), daemon=True)
+        reader.start()
+        with self._lock:
+            self._running.add(process)
+
+        timed_out = False
+        try:
+            while True:
+                try:
+                    process.wait(timeout=POLL_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if self.cancel_token.cancelled:
+                    _kill(process)
+                elif timeout and perf_counter() - started > timeout and not timed_out:
+                    timed_out = True
+                    _kill(process)
+        except BaseException:
+            # e.g. KeyboardInterrupt: the child has its own session and never saw it
+            _kill(process)
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(process)
+
+        # A grandchild that escaped the kill may still hold the pipe open
+        reader.join(timeout=1.0)
+        if not reader.is_alive():
+            process.stdout.close()
+
+        seconds = perf_counter() - started
+        self.cancel_token.check()
+        if timed_out:
+            return CommandResult(argv, -1, "".join(lines), seconds, timed_out=True,
+                                 error=f"Timed out after {timeout}s")
+        return CommandResult(argv, process.returncode, "".join(lines), seconds)
+
+    def cancel(self):
+        """Cancel the token and kill every running command now"""
+        self.cancel_token.cancel()
+        with self._lock:
+            running = list(self._running)
+        for process in running:
+            _kill(process)
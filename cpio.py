@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+In-memory newc cpio archive for ramdisk patching
+Mirrors the `magiskboot cpio` operations: test, add, mkdir, rm, extract,
+patch, backup and restore. The archive is loaded once, edited in memory
+and serialized once.
+"""
+
+import lzma
+import stat
+
+import xz_backend
+
+
+NEWC_MAGIC = b"070701"
+NEWC_CRC_MAGIC = b"070702"
+NEWC_HEADER_SIZE = 110
+TRAILER = "TRAILER!!!"
+
+# magiskboot numbers the inodes of a written archive from here
+FIRST_INODE = 300000
+
+# Return codes of `magiskboot cpio test`
+STOCK = 0
+MAGISK_PATCHED = 1
+UNSUPPORTED = 2
+
+UNSUPPORTED_FILES = ["sbin/launch_daemonsu.sh", "sbin/su", "init.xposed.rc",
+                     "boot/sbin/launch_daemonsu.sh"]
+MAGISK_FILES = [".backup/.magisk", "init.magisk.rc", "overlay/init.magisk.rc"]
+
+VERITY_PATTERNS = [b"verifyatboot", b"verify", b"avb_keys", b"avb", b"support_scfs", b"fsverity"]
+ENCRYPTION_PATTERNS = [b"forceencrypt", b"forcefdeorfbe", b"fileencryption"]
+
+
+class CpioError(Exception):
+    """Raised on a malformed archive or an invalid operation"""
+
+
+def _align4(value):
+    return (value + 3) & ~3
+
+
+def norm_path(path):
+    """Normalize an archive path the way magiskboot does"""
+    return "/".join(part for part in path.split("/") if part)
+
+
+def _match_pattern(buf, pos, patterns):
+    """Return the length of a flag pattern (with leading comma and =value) at pos, or 0"""
+    skip = 1 if buf[pos:pos + 1] == b"," else 0
+    for pattern in patterns:
+        if buf.startswith(pattern, pos + skip):
+            skip += len(pattern)
+            break
+    else:
+        return 0
+
+    if buf[pos + skip:pos + skip + 1] == b"=":
+        while pos + skip < len(buf) and buf[pos + skip] not in b" \n,\0":
+            skip += 1
+    return skip
+
+
+def remove_patterns(data, patterns, log=None):
+    """Return data with every matching fstab flag removed"""
+    buf = bytes(data)
+    out = bytearray()
+    pos = 0
+    while pos < len(buf):
+        length = _match_pattern(buf, pos, patterns)
+        if length:
+            if log:
+                log(f"Remove pattern [{buf[pos:pos + length].decode('utf-8', 'replace')}]")
+            pos += length
+        else:
+            out.append(buf[pos])
+            pos += 1
+    return bytes(out)
+
+
+def patch_verity(data, log=None):
+    """Strip dm-verity and AVB flags from fstab content"""
+    return remove_patterns(data, VERITY_PATTERNS, log)
+
+
+def patch_encryption(data, log=None):
+    """Strip forced encryption flags from fstab content"""
+    return remove_patterns(data, ENCRYPTION_PATTERNS, log)
+
+
+class CpioEntry:
+    """One archive member; data is bytes or a memoryview into the loaded archive"""
+
+    __slots__ = ["mode", "uid", "gid", "rdevmajor", "rdevminor", "data"]
+
+    def __init__(self, mode, data=b"", uid=0, gid=0, rdevmajor=0, rdevminor=0):
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.rdevmajor = rdevmajor
+        self.rdevminor = rdevminor
+        self.data = data
+
+    def copy(self):
+        """Shallow copy sharing the (immutable) data buffer"""
+        return CpioEntry(self.mode, self.data, self.uid, self.gid, self.rdevmajor, self.rdevminor)
+
+    @property
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+    @property
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+
+class Cpio:
+    """newc cpio archive held in memory as a name -> CpioEntry mapping"""
+
+    def __init__(self, entries=None, log=None):
+        self.entries = entries if entries is not None else {}
+        self.log = log or (lambda message: None)
+
+    @classmethod
+    def load(cls, path, log=None):
+        with open(path, "rb") as f:
+            return cls.parse(f.read(), log)
+
+    @classmethod
+    def parse(cls, data, log=None):
+        """Parse a newc archive; entry data are zero-copy views into data
+
+        Like magiskboot, parsing continues at the next header after each
+        trailer, since a ramdisk may be several archives concatenated.
+        """
+        view = memoryview(data)
+        entries = {}
+        pos = 0
+        while pos + NEWC_HEADER_SIZE <= len(data):
+            magic = bytes(view[pos:pos + 6])
+            if magic not in (NEWC_MAGIC, NEWC_CRC_MAGIC):
+                raise CpioError(f"Invalid cpio magic at offset {pos:#x}")
+            try:
+                fields = [int(bytes(view[pos + 6 + i * 8:pos + 14 + i * 8]), 16) for i in range(13)]
+            except ValueError:
+                raise CpioError(f"Invalid cpio header at offset {pos:#x}")
+            (_, mode, uid, gid, _, _, filesize, _, _,
+             rdevmajor, rdevminor, namesize, _) = fields
+
+            name_start = pos + NEWC_HEADER_SIZE
+            name = bytes(view[name_start:name_start + namesize - 1]).decode("utf-8", "surrogateescape")
+            data_start = _align4(name_start + namesize)
+            data_end = data_start + filesize
+            if data_end > len(data):
+                raise CpioError(f"Truncated cpio entry {name}")
+            pos = _align4(data_end)
+
+            if name == TRAILER:
+                pos = data.find(NEWC_MAGIC, pos)
+                if pos < 0:
+                    break
+                continue
+            if name in (".", ".."):
+                continue
+            entries[norm_path(name)] = CpioEntry(mode, view[data_start:data_end], uid, gid,
+                                                 rdevmajor, rdevminor)
+        return cls(entries, log)
+
+    def snapshot(self):
+        """Copy of the archive index that shares all entry data"""
+        return Cpio({name: entry.copy() for name, entry in self.entries.items()}, self.log)
+
+    def serialize(self):
+        """Return the archive as a list of byte chunks in magiskboot's layout"""
+        chunks = []
+        pos = 0
+        inode = FIRST_INODE
+
+        def header(ino, mode, uid, gid, size, rdevmajor, rdevminor, namesize):
+            fields = [ino, mode, uid, gid, 1, 0, size, 0, 0, rdevmajor, rdevminor, namesize, 0]
+            return NEWC_MAGIC + "".join(f"{value:08x}" for value in fields).encode()
+
+        for name in sorted(self.entries):
+            entry = self.entries[name]
+            encoded = name.encode("utf-8", "surrogateescape")
+            head = header(inode, entry.mode, entry.uid, entry.gid, len(entry.data),
+                          entry.rdevmajor, entry.rdevminor, len(encoded) + 1) + encoded + b"\0"
+            pos += len(head)
+            chunks.append(head + b"\0" * (_align4(pos) - pos))
+            pos = _align4(pos)
+            if len(entry.data):
+                chunks.append(entry.data)
+                pos += len(entry.data)
+                chunks.append(b"\0" * (_align4(pos) - pos))
+                pos = _align4(pos)
+            inode += 1
+
+        trailer = header(inode, 0o755, 0, 0, 0, 0, 0, len(TRAILER) + 1) + TRAILER.encode() + b"\0"
+        pos += len(trailer)
+        chunks.append(trailer + b"\0" * (_align4(pos) - pos))
+        return chunks
+
+    def dump(self, path):
+        """Write the archive to path in one pass"""
+        with open(path, "wb") as f:
+            f.writelines(self.serialize())
+
+    def exists(self, path):
+        return norm_path(path) in self.entries
+
+    def test(self):
+        """Return STOCK, MAGISK_PATCHED or UNSUPPORTED like `magiskboot cpio test`"""
+        if any(self.exists(path) for path in UNSUPPORTED_FILES):
+            return UNSUPPORTED
+        if any(self.exists(path) for path in MAGISK_FILES):
+            return MAGISK_PATCHED
+        return STOCK
+
+    def rm(self, path, recursive=False):
+        path = norm_path(path)
+        if self.entries.pop(path, None) is not None:
+            self.log(f"Removed entry [{path}]")
+        if recursive:
+            prefix = path + "/"
+            for name in [name for name in self.entries if name.startswith(prefix)]:
+                del self.entries[name]
+                self.log(f"Removed entry [{name}]")
+
+    def mkdir(self, mode, path):
+        path = norm_path(path)
+        self.entries[path] = CpioEntry(stat.S_IFDIR | mode)
+        self.log(f"Create directory [{path}] ({mode:04o})")
+
+    def add(self, mode, path, data):
+        """Add a regular file with data (bytes) or the content of a file path"""
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        path = norm_path(path)
+        self.entries[path] = CpioEntry(stat.S_IFREG | mode, data)
+        self.log(f"Add file [{path}] ({mode:04o})")
+
+    def extract(self, path, out_path):
+        path = norm_path(path)
+        if path not in self.entries:
+            raise CpioError(f"No such file in cpio: {path}")
+        with open(out_path, "wb") as f:
+            f.write(self.entries[path].data)
+        self.log(f"Extract [{path}] to [{out_path}]")
+
+    def patch(self, keep_verity=True, keep_force_encrypt=True):
+        """Remove verity and forced encryption flags from root fstab files"""
+        self.log(f"Patch with flag KEEPVERITY=[{str(keep_verity).lower()}] "
+                 f"KEEPFORCEENCRYPT=[{str(keep_force_encrypt).lower()}]")
+        for name in list(self.entries):
+            entry = self.entries[name]
+            fstab = (not keep_verity or not keep_force_encrypt) and entry.is_file \
+                and not name.startswith((".backup", "twrp", "recovery")) \
+                and name.startswith("fstab")
+
+            if not keep_verity:
+                if fstab:
+                    self.log(f"Found fstab file [{name}]")
+                    entry.data = patch_verity(entry.data, self.log)
+                elif name == "verity_key":
+                    del self.entries[name]
+                    continue
+            if not keep_force_encrypt and fstab:
+                entry.data = patch_encryption(entry.data, self.log)
+
+    def backup(self, origin, compress=True):
+        """Record the differences from origin under .backup
+
+        Changed or removed entries of origin are stored as .backup/<name>
+        (xz compressed as .backup/<name>.xz), and entries new in this
+        archive are listed in .backup/.rmlist.
+        """
+        backups = {".backup": CpioEntry(stat.S_IFDIR)}
+        rm_list = []
+
+        lhs = {name: entry for name, entry in origin.entries.items()
+               if name != ".backup" and not name.startswith(".backup/")}
+        self.rm(".backup", True)
+
+        for name in sorted(set(lhs) | set(self.entries)):
+            old = lhs.get(name)
+            new = self.entries.get(name)
+            if old is None:
+                self.log(f"Record new entry: [{name}] -> [.backup/.rmlist]")
+                rm_list.append(name)
+                continue
+            if new is not None and (old.data is new.data or old.data == new.data):
+                continue
+
+            backup = old.copy()
+            backup_name = f".backup/{name}"
+            if compress and backup.is_file:
+                backup.data = lzma.compress(bytes(backup.data), format=lzma.FORMAT_XZ,
+                                            check=xz_backend.MAGISK_XZ_CHECK,
+                                            filters=xz_backend.MAGISK_XZ_FILTERS)
+                backup_name += ".xz"
+            self.log(f"Backup [{name}] -> [{backup_name}]")
+            backups[backup_name] = backup
+
+        if rm_list:
+            data = "".join(f"{name}\0" for name in rm_list).encode("utf-8", "surrogateescape")
+            backups[".backup/.rmlist"] = CpioEntry(stat.S_IFREG, data)
+
+        self.entries.update(backups)
+
+    def restore(self):
+        """Undo a previous Magisk patch using the .backup entries"""
+        backups = {}
+        rm_list = b""
+        for name in [name for name in self.entries if name.startswith(".backup/")]:
+            entry = self.entries.pop(name)
+            if name == ".backup/.rmlist":
+                rm_list = bytes(entry.data)
+            elif name != ".backup/.magisk":
+                new_name = name[len(".backup/"):]
+                if new_name.endswith(".xz") and entry.is_file:
+                    try:
+                        entry = entry.copy()
+                        entry.data = lzma.decompress(bytes(entry.data))
+                        new_name = new_name[:-3]
+                    except lzma.LZMAError:
+                        pass
+                self.log(f"Restore [{name}] -> [{new_name}]")
+                backups[new_name] = entry
+
+        self.rm(".backup")
+        if not rm_list and not backups:
+            self.entries.clear()
+            return
+
+        for name in rm_list.split(b"\0"):
+            if name:
+                self.rm(name.decode("utf-8", "surrogateescape"))
+        self.entries.update(backups)
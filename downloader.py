@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Magisk release download manager
+Pooled HTTP session, parallel ranged segments with resume, ETag/tag_name
+caching of the releases API and the APK, and SHA256 verification.
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fastcopy import BUFFER_SIZE, hash_file
+from payload_cache import default_cache_dir
+
+
+# requests is imported on first use: the CLI imports this module on every run
+GITHUB_API = "https://api.github.com"
+MAGISK_REPO = "topjohnwu/Magisk"
+
+CHUNK_SIZE = 256 * 1024
+DEFAULT_SEGMENTS = 4
+# Files smaller than this are fetched as one stream
+MIN_SEGMENT_SIZE = 2 * 1024 * 1024
+PROGRESS_INTERVAL = 0.1
+REQUEST_TIMEOUT = 30
+
+
+class DownloadError(Exception):
+    """Raised when a release or file cannot be downloaded or verified"""
+
+
+def _pooled_session(pool_size):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = "magisk-boot-patcher"
+    return session
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class ProgressThrottle:
+    """Thread-safe byte counter that reports at most every interval seconds"""
+
+    def __init__(self, callback, total, done=0, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self._last < self.interval and self.done < self.total:
+                return
+            self._last = now
+            done = self.done
+        if self.callback:
+            self.callback(done, self.total)
+
+
+class MagiskDownloader:
+    """Download Magisk releases into a local cache
+
+    api_url defaults to $MAGISK_RELEASES_API or the GitHub API, so a local
+    HTTP server serving releases/latest and the assets can stand in for it.
+    """
+
+    def __init__(self, cache_dir=None, api_url=None, repo=MAGISK_REPO,
+                 segments=DEFAULT_SEGMENTS, session=None, log=None):
+        self.api_url = (api_url or os.environ.get("MAGISK_RELEASES_API") or GITHUB_API).rstrip("/")
+        self.repo = repo
+        self.segments = max(segments, 1)
+        self.cache_dir = os.path.join(cache_dir or default_cache_dir(), "downloads")
+        self.session = session or _pooled_session(self.segments)
+        self.log = log or (lambda message, level="INFO": None)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def latest_release(self):
+        """Return the latest release JSON, revalidated with its cached ETag
+
+        Falls back to the cached response when the API cannot be reached.
+        """
+        import requests
+
+        cache_path = os.path.join(self.cache_dir, "releases-latest.json")
+        cached = _read_json(cache_path)
+        headers = {"Accept": "application/vnd.github+json"}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        url = f"{self.api_url}/repos/{self.repo}/releases/latest"
+        try:
+            response = self.session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 304 and cached:
+                self.log("Release info unchanged (cached)", "INFO")
+                return cached["release"]
+            response.raise_for_status()
+            release = response.json()
+        except (requests.RequestException, ValueError) as e:
+            if cached:
+                self.log(f"Release API unavailable, using cached release info: {str(e)}", "WARNING")
+                return cached["release"]
+            raise DownloadError(f"Failed to fetch release info: {str(e)}")
+
+        _write_json(cache_path, {"etag": response.headers.get("ETag", ""), "release": release})
+        return release
+
+    @staticmethod
+    def apk_asset(release):
+        """Return name, url, size and sha256 of the Magisk APK asset of a release"""
+        for asset in release.get("assets", []):
+            if asset["name"].startswith("Magisk") and asset["name"].endswith(".apk"):
+                digest = asset.get("digest") or ""
+                return {
+                    "name": asset["name"],
+                    "url": asset["browser_download_url"],
+                    "size": asset.get("size", 0),
+                    "sha256": digest.split(":", 1)[1] if digest.startswith("sha256:") else "",
+                }
+        raise DownloadError("Could not find Magisk APK in release")
+
+    def download_latest(self, dest_dir=None, progress=None):
+        """Download the latest Magisk APK, returning (release, path)
+
+        The APK is kept in the cache under its tag_name and reused while it
+        is still the latest release; with dest_dir it is also copied there.
+        """
+        release = self.latest_release()
+        asset = self.apk_asset(release)
+        tag_dir = os.path.join(self.cache_dir, release["tag_name"])
+        os.makedirs(tag_dir, exist_ok=True)
+        path = os.path.join(tag_dir, asset["name"])
+
+        if self.is_cached(path, asset):
+            self.log(f"Using cached {asset['name']}", "SUCCESS")
+        else:
+            self.download(asset["url"], path, asset["size"], asset["sha256"], progress)
+
+        if dest_dir:
+            dest_path = os.path.join(dest_dir, asset["name"])
+            if os.path.abspath(dest_path) != os.path.abspath(path):
+                shutil.copyfile(path, dest_path)
+            path = dest_path
+        return release, path
+
+    def is_cached(self, path, asset):
+        meta = _read_json(path + ".json")
+        if not meta or not os.path.exists(path):
+            return False
+        if asset["sha256"] and meta.get("sha256") != asset["sha256"]:
+            return False
+        return hash_file(path).sha256 == meta.get("sha256")
+
+    def download(self, url, path, size=0, sha256="", progress=None):
+        """Download url to path with resume, verifying sha256 when known
+
+        Servers that accept ranges get the file in parallel segments;
+        interrupted downloads continue from their partial files.
+        """
+        import requests
+
+        head = self.session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+        head.raise_for_status()
+        total = int(head.headers.get("Content-Length", 0)) or size
+        etag = head.headers.get("ETag", "")
+        ranges = head.headers.get("Accept-Ranges", "") == "bytes" and total > 0
+
+        part_path = path + ".part"
+        # A resumed download of the wrong size is retried once from the first byte
+        for attempt in range(2):
+            try:
+                if ranges and self.segments > 1 and total >= MIN_SEGMENT_SIZE:
+                    self._download_segments(head.url, part_path, total, etag, progress)
+                else:
+                    self._download_stream(head.url, part_path, total, etag, ranges, progress)
+            except requests.RequestException as e:
+                raise DownloadError(f"Download failed: {str(e)} (partial download kept for resume)")
+
+            digest = hash_file(part_path)
+            if not total or digest.size == total:
+                break
+            os.remove(part_path)
+            if attempt:
+                raise DownloadError(f"Size mismatch: expected {total} bytes, got {digest.size}")
+            self.log(f"Size mismatch: expected {total} bytes, got {digest.size}; "
+                     f"restarting download", "WARNING")
+        if sha256 and digest.sha256 != sha256:
+            os.remove(part_path)
+            raise DownloadError(f"SHA256 mismatch: expected {sha256}, got {digest.sha256}")
+
+        os.replace(part_path, path)
+        _write_json(path + ".json", {"url": url, "etag": etag, "size": digest.size,
+                                     "sha256": digest.sha256})
+        self.log(f"SHA256: {digest.sha256}" + (" (verified)" if sha256 else ""), "INFO")
+        return path
+
+    def _download_stream(self, url, part_path, total, etag, ranges, progress):
+        done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if total and done > total:
+            # Not a prefix of this file: rewritten from the start below
+            self.log("Partial download is larger than the file, restarting", "WARNING")
+            done = 0
+        headers = {}
+        if ranges and done:
+            if done == total:
+                return
+            headers["Range"] = f"bytes={done}-"
+            if etag:
+                headers["If-Range"] = etag
+
+        with self.session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            restart = done > 0 and response.status_code == 416
+            if not restart:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    done = 0
+                elif done:
+                    self.log(f"Resuming download at {done} bytes", "INFO")
+                throttle = ProgressThrottle(progress, total, done)
+                with open(part_path, "ab" if done else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        throttle.add(len(chunk))
+
+        if restart:
+            # Range Not Satisfiable: the partial file does not fit the file on the server
+            self.log("Server rejected the resume range, restarting download", "WARNING")
+            os.remove(part_path)
+            self._download_stream(url, part_path, total, etag, ranges, progress)
+
+    def _download_segments(self, url, part_path, total, etag, progress):
+        """Fetch total bytes as parallel ranges into .segN files, then join them"""
+        state_path = part_path + ".json"
+        length = -(-total // self.segments)
+        ranges = [(start, min(start + length, total)) for start in range(0, total, length)]
+        state = {"url": url, "etag": etag, "size": total, "ranges": ranges}
+
+        previous = _read_json(state_path)
+        if previous and (previous.get("etag") != etag or previous.get("size") != total
+                         or previous.get("ranges") != [list(r) for r in ranges]):
+            # The file changed on the server: discard the old segments
+            for index in range(len(previous.get("ranges", []))):
+                if os.path.exists(f"{part_path}.seg{index}"):
+                    os.remove(f"{part_path}.seg{index}")
+        _write_json(state_path, state)
+
+        segment_paths = [f"{part_path}.seg{index}" for index in range(len(ranges))]
+        done = sum(os.path.getsize(p) for p in segment_paths if os.path.exists(p))
+        if done:
+            self.log(f"Resuming download at {done} bytes", "INFO")
+        throttle = ProgressThrottle(progress, total, done)
+
+        def fetch(segment_path, start, end):
+            have = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            if start + have > end:
+                # Longer than its range: refetched from the start of the segment
+                os.remove(segment_path)
+                have = 0
+            if start + have == end:
+                return
+            headers = {"Range": f"bytes={start + have}-{end - 1}"}
+            if etag:
+                headers["If-Range"] = etag
+            with self.session.get(url, headers=headers, stream=True,
+                                  timeout=REQUEST_TIMEOUT) as response:
+                restart = have > 0 and response.status_code == 416
+                if not restart:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise DownloadError("Server ignored the range request")
+                    with open(segment_path, "ab") as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                            throttle.add(len(chunk))
+
+            if restart:
+                self.log(f"Server rejected the resume range of {os.path.basename(segment_path)}, "
+                         f"refetching it", "WARNING")
+                os.remove(segment_path)
+                fetch(segment_path, start, end)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(fetch, segment_path, start, end)
+                       for segment_path, (start, end) in zip(segment_paths, ranges)]
+            for future in futures:
+                future.result()
+
+        with open(part_path, "wb") as out:
+            for segment_path in segment_paths:
+                with open(segment_path, "rb") as f:
+                    shutil.copyfileobj(f, out, BUFFER_SIZE)
+        for segment_path in segment_paths:
+            os.remove(segment_path)
+        os.remove(state_path)
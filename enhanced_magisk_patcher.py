@@ -5,23 +5,60 @@ Author: Based on CircleCashTeam's web implementation
 Version: 0.2.0
 """
 
-import tkinter as tk
-from tkinter import ttk, filedialog, scrolledtext, messagebox
 import subprocess
 import os
 import sys
-import zipfile
 import shutil
 import tempfile
 import threading
 import platform
-import requests
 from pathlib import Path
-import re
 import json
-import hashlib
+import argparse
 from datetime import datetime
-import webbrowser
+
+from apk_catalog import ApkCatalog, CatalogError, default_catalog_dir
+from apk_index import ApkError, load_apk_index
+from command_runner import DEFAULT_TIMEOUT, CancelToken, CommandRunner
+from patch_engine import (ARCHITECTURES, CPIO_BACKENDS, DTB_BACKENDS, HEXPATCH_BACKENDS,
+                          PatchCancelled, PatchEngine, PatchError, PatchOptions, console_log)
+from downloader import DEFAULT_SEGMENTS, DownloadError, MagiskDownloader
+from fastcopy import clone_and_hash
+from magiskboot_resolver import resolve_magiskboot
+from payload_cache import (DEFAULT_CACHE_SIZE, DEFAULT_RESULT_CACHE_SIZE, PayloadCache,
+                           ResultCache, default_cache_dir, parse_size)
+from patch_log import LogRecord, QueueLogSink, write_report
+from scratch import (DEFAULT_RAM_BUDGET, SCRATCH_BACKENDS, WORK_DIR_PREFIX, ScratchSpace,
+                     default_ram_dir)
+from stage_timer import PROFILERS
+from vbmeta import DISABLE_FLAGS, find_vbmeta_images, format_vbmeta_results, patch_vbmeta_images
+from xz_backend import XZ_BACKENDS
+
+# tkinter is bound by import_tk() when the GUI starts; headless commands
+# never import it
+tk = ttk = filedialog = scrolledtext = messagebox = None
+
+# Log pipeline: how often the UI drains queued records, how many it takes
+# per tick and how many lines the terminal widget keeps
+LOG_DRAIN_INTERVAL_MS = 50
+LOG_BATCH_SIZE = 500
+MAX_LOG_LINES = 5000
+# Delay after the first idle pass before startup checks run
+STARTUP_DELAY_MS = 1
+
+
+def import_tk():
+    """Import tkinter into the module globals used by the GUI"""
+    global tk, ttk, filedialog, scrolledtext, messagebox
+    import tkinter as tk
+    from tkinter import ttk, filedialog, scrolledtext, messagebox
+
+
+def open_url(url):
+    """Open url in the system browser"""
+    import webbrowser
+    webbrowser.open(url)
+
 
 class MagiskPatcherEnhanced:
     def __init__(self, root):
@@ -52,9 +89,22 @@ class MagiskPatcherEnhanced:
         # State
         self.temp_dir = None
         self.magiskboot_path = None
+        self.magiskboot_info = None
         self.boot_image_file = None
         self.magisk_apk_file = None
         self.is_patching = False
+        self.cancel_token = None
+        
+        # Release download manager, created on first use
+        self.downloader = None
+        
+        # Event log and report of the last patch run
+        self.last_events = None
+        self.last_report = None
+        
+        # Log records and UI updates queued by worker threads
+        self.ui_sink = QueueLogSink()
+        self.pending_status = None
         
         # Theme colors
         self.colors = {
@@ -70,6 +120,12 @@ class MagiskPatcherEnhanced:
         }
         
         self.setup_ui()
+        self.drain_ui_queue()
+        # Discovery and the welcome text wait until the window has been drawn
+        self.root.after_idle(self.root.after, STARTUP_DELAY_MS, self.finish_startup)
+        
+    def finish_startup(self):
+        """Look for magiskboot and greet the user, once the first frame is up"""
         self.check_requirements()
         self.show_welcome_message()
         
@@ -152,7 +208,7 @@ class MagiskPatcherEnhanced:
                               fg=self.colors['fg'],
                               bd=0,
                               padx=10,
-                              command=lambda: webbrowser.open("https://github.com/topjohnwu/Magisk"))
+                              command=lambda: open_url("https://github.com/topjohnwu/Magisk"))
         github_btn.pack(side=tk.RIGHT)
         
     def create_file_selection(self, parent):
@@ -333,7 +389,16 @@ class MagiskPatcherEnhanced:
                                 font=('Arial', 9),
                                 padx=10,
                                 command=self.save_log)
-        save_log_btn.pack(side=tk.LEFT)
+        save_log_btn.pack(side=tk.LEFT, padx=(0, 5))
+        
+        save_report_btn = tk.Button(control_frame,
+                                   text="Save Report",
+                                   bg=self.colors['surface_variant'],
+                                   fg=self.colors['fg'],
+                                   font=('Arial', 9),
+                                   padx=10,
+                                   command=self.save_report)
+        save_report_btn.pack(side=tk.LEFT)
         
     def create_status_bar(self, parent):
         """Create status bar"""
@@ -380,21 +445,52 @@ class MagiskPatcherEnhanced:
         widget.bind("<Leave>", on_leave)
         
     def log(self, message, level="INFO"):
-        """Log message to terminal"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
+        """Queue a log message for the terminal; safe to call from any thread"""
+        self.ui_sink(message, level)
         
+    def set_status(self, message):
+        """Update status bar message; safe to call from any thread"""
+        self.pending_status = message
+        
+    def call_in_ui(self, function, *args):
+        """Run function(*args) on the Tk thread"""
+        self.ui_sink.call(function, *args)
+        
+    def drain_ui_queue(self):
+        """Apply queued log records and UI updates in one batch, then reschedule"""
+        chunks = []
+        for item in self.ui_sink.drain(LOG_BATCH_SIZE):
+            if isinstance(item, LogRecord):
+                if item.level:
+                    chunks.extend([f"[{item.timestamp}] ", ("timestamp",),
+                                   f"[{item.level}] ", (item.level,)])
+                chunks.extend([f"{item.message}\n", ()])
+            else:
+                self.write_terminal(chunks)
+                chunks = []
+                item()
+        self.write_terminal(chunks)
+        
+        status, self.pending_status = self.pending_status, None
+        if status is not None:
+            self.status_label.config(text=status)
+            
+        self.root.after(LOG_DRAIN_INTERVAL_MS, self.drain_ui_queue)
+        
+    def write_terminal(self, chunks):
+        """Insert (text, tags) chunks into the terminal and trim old lines"""
+        if not chunks:
+            return
+            
         self.terminal.config(state=tk.NORMAL)
-        self.terminal.insert(tk.END, f"[{timestamp}] ", ("timestamp",))
-        self.terminal.insert(tk.END, f"[{level}] ", (level,))
-        self.terminal.insert(tk.END, f"{message}\n")
+        self.terminal.insert(tk.END, *chunks)
+        
+        lines = int(self.terminal.index("end-1c").split(".")[0])
+        if lines > MAX_LOG_LINES:
+            self.terminal.delete("1.0", f"{lines - MAX_LOG_LINES + 1}.0")
+            
         self.terminal.see(tk.END)
         self.terminal.config(state=tk.DISABLED)
-        self.root.update()
-        
-    def set_status(self, message):
-        """Update status bar message"""
-        self.status_label.config(text=message)
-        self.root.update()
         
     def clear_terminal(self):
         """Clear terminal output"""
@@ -416,6 +512,28 @@ class MagiskPatcherEnhanced:
                 f.write(content)
             self.log(f"Log saved to: {filename}", "SUCCESS")
             
+    def save_report(self):
+        """Save the JSON report of the last patch run and its event log"""
+        if not self.last_report:
+            messagebox.showinfo("No Report", "Patch a boot image first")
+            return
+            
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            filetypes=[("JSON files", "*.json"), ("All files", "*.*")],
+            initialfile=f"magisk_patch_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        
+        if filename:
+            self.write_report_files(filename)
+            
+    def write_report_files(self, report_path):
+        """Write the last report and, next to it, its JSON-lines events"""
+        write_report(self.last_report, report_path)
+        events_path = os.path.splitext(report_path)[0] + ".events.jsonl"
+        self.last_events.write_jsonl(events_path)
+        self.log(f"Report saved to: {report_path}", "SUCCESS")
+        
     def show_welcome_message(self):
         """Show welcome message"""
         self.log("=" * 60)
@@ -436,15 +554,12 @@ class MagiskPatcherEnhanced:
         self.set_status("Checking requirements...")
         self.log("Checking for magiskboot...", "INFO")
         
-        if platform.system() == "Windows":
-            magiskboot_name = "magiskboot.exe"
-        else:
-            magiskboot_name = "magiskboot"
-            
-        # Check in current directory
-        if os.path.exists(magiskboot_name):
-            self.magiskboot_path = os.path.abspath(magiskboot_name)
-            self.log(f"Found magiskboot at: {self.magiskboot_path}", "SUCCESS")
+        # $MAGISKBOOT, the config file, the current directory, then PATH
+        info = resolve_magiskboot()
+        if info:
+            self.magiskboot_info = info
+            self.magiskboot_path = info.path
+            self.log(f"Found magiskboot at: {info.describe()}", "SUCCESS")
             self.set_status("Ready")
         else:
             self.log("magiskboot not found!", "WARNING")
@@ -466,7 +581,7 @@ class MagiskPatcherEnhanced:
                 threading.Thread(target=self.run_download_script).start()
             else:
                 self.log("Please download magiskboot manually from Magisk releases", "WARNING")
-                webbrowser.open("https://github.com/topjohnwu/Magisk/releases")
+                open_url("https://github.com/topjohnwu/Magisk/releases")
                 
     def run_download_script(self):
         """Run magiskboot download script"""
@@ -476,7 +591,7 @@ class MagiskPatcherEnhanced:
             
             if result.returncode == 0:
                 self.log("Successfully downloaded magiskboot!", "SUCCESS")
-                self.check_requirements()
+                self.call_in_ui(self.check_requirements)
             else:
                 self.log("Failed to download magiskboot", "ERROR")
                 self.log(result.stderr, "ERROR")
@@ -494,67 +609,60 @@ class MagiskPatcherEnhanced:
         
     def _download_magisk_worker(self):
         """Worker thread for downloading Magisk"""
+        def on_progress(downloaded, total_size):
+            if total_size > 0:
+                progress = (downloaded / total_size) * 100
+                self.set_status(f"Downloading: {progress:.1f}%")
+                self.call_in_ui(self.set_progress, progress)
+                
         try:
-            # Get latest release info
-            api_url = "https://api.github.com/repos/topjohnwu/Magisk/releases/latest"
-            response = requests.get(api_url)
-            response.raise_for_status()
-            
-            release_info = response.json()
-            version = release_info['tag_name']
-            
-            # Find APK URL
-            apk_url = None
-            apk_name = None
-            for asset in release_info['assets']:
-                if asset['name'].startswith('Magisk') and asset['name'].endswith('.apk'):
-                    apk_url = asset['browser_download_url']
-                    apk_name = asset['name']
-                    break
-                    
-            if not apk_url:
-                self.log("Could not find Magisk APK in latest release", "ERROR")
-                return
+            if self.downloader is None:
+                self.downloader = MagiskDownloader(log=self.log)
                 
-            self.log(f"Found Magisk {version}: {apk_name}", "SUCCESS")
-            
-            # Download APK
-            self.progress.config(mode='determinate')
-            self.progress.start()
+            release = self.downloader.latest_release()
+            asset = self.downloader.apk_asset(release)
+            self.log(f"Found Magisk {release['tag_name']}: {asset['name']}", "SUCCESS")
             
-            response = requests.get(apk_url, stream=True)
-            response.raise_for_status()
-            
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded = 0
-            
-            filename = os.path.join(os.getcwd(), apk_name)
-            
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        if total_size > 0:
-                            progress = (downloaded / total_size) * 100
-                            self.progress['value'] = progress
-                            self.set_status(f"Downloading: {progress:.1f}%")
-                            
-            self.progress.stop()
-            self.progress.config(mode='indeterminate')
+            # Download APK (or reuse the cached one)
+            self.call_in_ui(self.progress.config, {'mode': 'determinate'})
+            release, filename = self.downloader.download_latest(os.getcwd(), on_progress)
+            self.call_in_ui(self.progress.config, {'mode': 'indeterminate', 'value': 0})
             
             self.log(f"Downloaded to: {filename}", "SUCCESS")
             self.set_status("Download complete")
             
+            # Mirror it into the catalog for offline use
+            try:
+                ApkCatalog().add(filename)
+            except (OSError, CatalogError) as e:
+                self.log(f"Could not add APK to the catalog: {str(e)}", "WARNING")
+            
             # Automatically select the downloaded APK
             self.magisk_apk_file = filename
-            self.magisk_apk_path.set(apk_name)
+            self.call_in_ui(self.magisk_apk_path.set, asset['name'])
             
         except Exception as e:
             self.log(f"Error downloading Magisk: {str(e)}", "ERROR")
-            self.progress.stop()
+            self.call_in_ui(self.progress.config, {'mode': 'indeterminate', 'value': 0})
             self.set_status("Download failed")
+            self.use_catalog_apk()
+            
+    def use_catalog_apk(self):
+        """Fall back to the newest APK in the local catalog"""
+        try:
+            catalog = ApkCatalog()
+            entry = catalog.get("latest")
+            filename = catalog.path_for(entry["version_code"])
+        except (OSError, CatalogError):
+            return
+            
+        self.log(f"Using Magisk {entry['version_name']} from the local catalog", "INFO")
+        self.magisk_apk_file = filename
+        self.call_in_ui(self.magisk_apk_path.set, os.path.basename(filename))
+            
+    def set_progress(self, value):
+        """Set the determinate progress bar value"""
+        self.progress['value'] = value
             
     def select_boot_image(self):
         """Select boot image file"""
@@ -592,30 +700,26 @@ class MagiskPatcherEnhanced:
             self.magisk_apk_path.set(os.path.basename(filename))
             self.log(f"Selected Magisk APK: {os.path.basename(filename)}", "SUCCESS")
             
-            # Try to get version info
+            # Index the APK once; patching reuses the memoized index
             try:
-                with zipfile.ZipFile(filename, 'r') as apk:
-                    if 'assets/util_functions.sh' in apk.namelist():
-                        with apk.open('assets/util_functions.sh') as f:
-                            content = f.read().decode('utf-8')
-                            match = re.search(r'MAGISK_VER="([^"]+)"', content)
-                            if match:
-                                version = match.group(1)
-                                self.log(f"Magisk version: {version}", "INFO")
-            except:
-                pass
+                index = load_apk_index(filename)
+                if index.version_name:
+                    self.log(f"Magisk version: {index.version_name} ({index.version_code})", "INFO")
+                self.log(f"Available architectures: {', '.join(index.archs)}", "INFO")
+            except (OSError, ApkError) as e:
+                self.log(f"Could not read APK: {str(e)}", "WARNING")
                 
     def clean_temp_files(self):
         """Clean temporary files"""
         self.log("Cleaning temporary files...", "INFO")
         
         temp_dirs = []
-        temp_dir_base = tempfile.gettempdir()
         
-        # Find Magisk patch temp directories
-        for item in os.listdir(temp_dir_base):
-            if item.startswith("magisk_patch_"):
-                temp_dirs.append(os.path.join(temp_dir_base, item))
+        # Find Magisk patch temp directories, on disk and in RAM scratch space
+        for temp_dir_base in filter(None, {tempfile.gettempdir(), default_ram_dir()}):
+            for item in os.listdir(temp_dir_base):
+                if item.startswith(WORK_DIR_PREFIX):
+                    temp_dirs.append(os.path.join(temp_dir_base, item))
                 
         if not temp_dirs:
             self.log("No temporary files found", "INFO")
@@ -635,7 +739,7 @@ class MagiskPatcherEnhanced:
     def patch_boot_image(self):
         """Start patching process"""
         if self.is_patching:
-            self.log("Patching already in progress!", "WARNING")
+            self.cancel_patch()
             return
             
         if not self.boot_image_file:
@@ -650,6 +754,18 @@ class MagiskPatcherEnhanced:
             messagebox.showerror("Error", "magiskboot not found!")
             return
             
+        try:
+            index = load_apk_index(self.magisk_apk_file)
+        except (OSError, ApkError) as e:
+            messagebox.showerror("Error", f"Invalid Magisk APK:\n\n{str(e)}")
+            return
+            
+        if not index.has_arch(self.arch_var.get()):
+            messagebox.showerror("Error",
+                                 f"Architecture {self.arch_var.get()} not available in this APK\n\n"
+                                 f"Try one of: {', '.join(index.archs)}")
+            return
+            
         # Confirm action
         result = messagebox.askyesno(
             "Confirm Patch",
@@ -664,248 +780,81 @@ class MagiskPatcherEnhanced:
             
         # Start patching in thread
         self.is_patching = True
-        thread = threading.Thread(target=self._patch_worker)
+        self.cancel_token = CancelToken()
+        self.clear_terminal()
+        self.progress.start()
+        self.patch_button.config(text="⛔ CANCEL")
+        self.set_status("Patching in progress...")
+        
+        thread = threading.Thread(target=self._patch_worker,
+                                  args=(self.get_patch_options(), self.arch_var.get()))
         thread.daemon = True
         thread.start()
         
-    def _patch_worker(self):
+    def cancel_patch(self):
+        """Ask the running patch to stop; magiskboot calls in flight are killed"""
+        if self.cancel_token and not self.cancel_token.cancelled:
+            self.cancel_token.cancel()
+            self.log("Cancelling...", "WARNING")
+            self.patch_button.config(state=tk.DISABLED, text="⏳ CANCELLING...")
+            self.set_status("Cancelling...")
+            
+    def get_patch_options(self):
+        """Collect patch options from the option checkboxes"""
+        return PatchOptions(
+            keep_verity=self.keep_verity.get(),
+            keep_force_encrypt=self.keep_force_encrypt.get(),
+            recovery_mode=self.recovery_mode.get(),
+            patch_vbmeta_flag=self.patch_vbmeta_flag.get(),
+            legacy_sar=self.legacy_sar.get()
+        )
+        
+    def _patch_worker(self, options, arch):
         """Worker thread for patching"""
-        self.progress.start()
-        self.patch_button.config(state=tk.DISABLED, text="⏳ PATCHING...")
-        self.set_status("Patching in progress...")
+        result = None
+        error = None
         
         try:
-            # Clear terminal
-            self.clear_terminal()
             self.log("=" * 60)
             self.log("Starting patch process...", "INFO")
             self.log("=" * 60)
             
-            # Create temp directory
-            self.temp_dir = tempfile.mkdtemp(prefix="magisk_patch_")
-            self.log(f"Working directory: {self.temp_dir}", "INFO")
-            
-            # Copy boot image
-            boot_path = os.path.join(self.temp_dir, "boot.img")
-            shutil.copy2(self.boot_image_file, boot_path)
-            self.log("Copied boot image to working directory", "SUCCESS")
-            
-            # Calculate SHA256 of original boot image
-            sha256 = self.calculate_sha256(self.boot_image_file)
-            self.log(f"Original boot SHA256: {sha256}", "INFO")
-            
-            # Extract files from APK
-            arch = self.arch_var.get()
-            self.log(f"Extracting files for architecture: {arch}", "INFO")
-            
-            needed_files = self.extract_from_apk(self.magisk_apk_file, arch, self.temp_dir)
-            
-            if not needed_files:
-                raise Exception("Failed to extract necessary files from APK")
-                
-            # Set environment variables
-            env = os.environ.copy()
-            env['KEEPVERITY'] = 'true' if self.keep_verity.get() else 'false'
-            env['KEEPFORCEENCRYPT'] = 'true' if self.keep_force_encrypt.get() else 'false'
-            env['RECOVERYMODE'] = 'true' if self.recovery_mode.get() else 'false'
-            env['PATCHVBMETAFLAG'] = 'true' if self.patch_vbmeta_flag.get() else 'false'
-            env['LEGACYSAR'] = 'true' if self.legacy_sar.get() else 'false'
+            engine = PatchEngine(self.magiskboot_path, log=self.log,
+                                 payload_cache=PayloadCache(), result_cache=ResultCache(),
+                                 runner=CommandRunner(cancel_token=self.cancel_token),
+                                 magiskboot_info=self.magiskboot_info)
             
-            self.log("Configuration:", "INFO")
-            for key in ['KEEPVERITY', 'KEEPFORCEENCRYPT', 'RECOVERYMODE', 'PATCHVBMETAFLAG', 'LEGACYSAR']:
-                self.log(f"  {key}: {env[key]}", "INFO")
-            
-            # Unpack boot image
-            self.log("", "")
-            self.log("Unpacking boot image...", "INFO")
-            result = self.run_command([self.magiskboot_path, "unpack", "boot.img"], 
-                                    cwd=self.temp_dir)
-            
-            if result != 0:
-                raise Exception("Failed to unpack boot image!")
-                
-            # Check ramdisk status
-            ramdisk_path = os.path.join(self.temp_dir, "ramdisk.cpio")
-            if os.path.exists(ramdisk_path):
-                self.log("Checking ramdisk status...", "INFO")
-                result = self.run_command([self.magiskboot_path, "cpio", "ramdisk.cpio", "test"], 
-                                        cwd=self.temp_dir)
-                
-                if result == 0:
-                    self.log("Stock boot image detected", "SUCCESS")
-                    shutil.copy2(ramdisk_path, ramdisk_path + ".orig")
-                elif result == 1:
-                    self.log("Magisk patched boot image detected", "WARNING")
-                    self.run_command([self.magiskboot_path, "cpio", "ramdisk.cpio", 
-                                    "extract .backup/.magisk config.orig", "restore"], 
-                                   cwd=self.temp_dir)
-                    shutil.copy2(ramdisk_path, ramdisk_path + ".orig")
-                else:
-                    raise Exception("Boot image patched by unsupported programs!")
-            else:
-                self.log("No ramdisk found (skip_initramfs)", "WARNING")
-            
-            # Get SHA1 from magiskboot
-            self.log("Getting boot image SHA1...", "INFO")
-            sha1_output = self.run_command_output([self.magiskboot_path, "sha1", "boot.img"], 
-                                                cwd=self.temp_dir)
-            sha1 = sha1_output.strip() if sha1_output else ""
-            
-            if sha1:
-                self.log(f"Boot image SHA1: {sha1}", "INFO")
-            
-            # Compress files
-            self.log("", "")
-            self.log("Compressing files...", "INFO")
-            
-            for filename in ["magisk", "magisk32", "magisk64", "init-ld"]:
-                if filename in needed_files:
-                    src_path = needed_files[filename]
-                    xz_path = os.path.join(self.temp_dir, f"{filename}.xz")
-                    self.log(f"Compressing {filename}...", "INFO")
-                    self.run_command([self.magiskboot_path, "compress=xz", src_path, xz_path])
-                    
-            # Compress stub.apk
-            if "stub.apk" in needed_files:
-                src_path = needed_files["stub.apk"]
-                xz_path = os.path.join(self.temp_dir, "stub.xz")
-                self.log("Compressing stub.apk...", "INFO")
-                self.run_command([self.magiskboot_path, "compress=xz", src_path, xz_path])
-            
-            # Create magiskinit
-            if "magiskinit" in needed_files:
-                shutil.copy2(needed_files["magiskinit"], 
-                           os.path.join(self.temp_dir, "magiskinit"))
-            
-            # Create config
-            config_path = os.path.join(self.temp_dir, "config")
-            with open(config_path, 'w') as f:
-                f.write(f"KEEPVERITY={env['KEEPVERITY']}\n")
-                f.write(f"KEEPFORCEENCRYPT={env['KEEPFORCEENCRYPT']}\n")
-                f.write(f"RECOVERYMODE={env['RECOVERYMODE']}\n")
-                f.write(f"PATCHVBMETAFLAG={env['PATCHVBMETAFLAG']}\n")
-                f.write(f"LEGACYSAR={env['LEGACYSAR']}\n")
-                if sha1:
-                    f.write(f"SHA1={sha1}\n")
-            
-            # Patch ramdisk
-            if os.path.exists(ramdisk_path):
-                self.log("", "")
-                self.log("Patching ramdisk...", "INFO")
-                
-                # Build cpio commands
-                cpio_commands = [
-                    self.magiskboot_path, "cpio", "ramdisk.cpio",
-                    "add 0750 init magiskinit",
-                    "mkdir 0750 overlay.d",
-                    "mkdir 0750 overlay.d/sbin"
-                ]
-                
-                # Add compressed files
-                for filename in ["magisk", "magisk32", "magisk64", "init-ld"]:
-                    xz_file = f"{filename}.xz"
-                    xz_path = os.path.join(self.temp_dir, xz_file)
-                    if os.path.exists(xz_path):
-                        cpio_commands.append(f"add 0644 overlay.d/sbin/{xz_file} {xz_file}")
-                        
-                # Add stub.xz
-                stub_xz = os.path.join(self.temp_dir, "stub.xz")
-                if os.path.exists(stub_xz):
-                    cpio_commands.append("add 0644 overlay.d/sbin/stub.xz stub.xz")
-                
-                # Add remaining commands
-                cpio_commands.extend([
-                    "patch",
-                    "backup ramdisk.cpio.orig",
-                    "mkdir 000 .backup",
-                    "add 000 .backup/.magisk config"
-                ])
-                
-                result = self.run_command(cpio_commands, cwd=self.temp_dir)
-                
-                if result != 0:
-                    raise Exception("Failed to patch ramdisk!")
-            
-            # Patch kernel if needed
-            kernel_path = os.path.join(self.temp_dir, "kernel")
-            if os.path.exists(kernel_path):
-                self.log("", "")
-                self.log("Patching kernel...", "INFO")
-                
-                kernel_patched = False
-                
-                # Apply kernel patches
-                patches = [
-                    ("49010054011440B93FA00F71E9000054010840B93FA00F7189000054001840B91FA00F7188010054",
-                     "A1020054011440B93FA00F7140020054010840B93FA00F71E0010054001840B91FA00F7181010054"),
-                    ("821B8012", "E2FF8F12"),
-                    ("70726F63615F636F6E66696700", "70726F63615F6D616769736B00")
-                ]
-                
-                for old_hex, new_hex in patches:
-                    result = self.run_command([self.magiskboot_path, "hexpatch", "kernel", 
-                                             old_hex, new_hex], cwd=self.temp_dir)
-                    if result == 0:
-                        kernel_patched = True
-                        self.log(f"Applied kernel patch: {old_hex[:16]}...", "SUCCESS")
-                
-                # Legacy SAR patch
-                if env['LEGACYSAR'] == 'true':
-                    result = self.run_command([self.magiskboot_path, "hexpatch", "kernel",
-                                             "736B69705F696E697472616D667300",
-                                             "77616E745F696E697472616D667300"], 
-                                            cwd=self.temp_dir)
-                    if result == 0:
-                        kernel_patched = True
-                        self.log("Applied legacy SAR patch", "SUCCESS")
-                
-                if not kernel_patched:
-                    os.remove(kernel_path)
-                    self.log("No kernel patches applied", "INFO")
-            
-            # Patch dtb if exists
-            for dt in ["dtb", "kernel_dtb", "extra"]:
-                dt_path = os.path.join(self.temp_dir, dt)
-                if os.path.exists(dt_path):
-                    self.log(f"", "")
-                    self.log(f"Checking {dt}...", "INFO")
-                    
-                    # Test dtb
-                    result = self.run_command([self.magiskboot_path, "dtb", dt, "test"], 
-                                            cwd=self.temp_dir)
-                    if result != 0:
-                        self.log(f"{dt} was patched by old Magisk", "WARNING")
-                    
-                    # Patch dtb
-                    result = self.run_command([self.magiskboot_path, "dtb", dt, "patch"], 
-                                            cwd=self.temp_dir)
-                    if result == 0:
-                        self.log(f"Patched {dt} successfully", "SUCCESS")
-            
-            # Repack boot image
-            self.log("", "")
-            self.log("Repacking boot image...", "INFO")
-            result = self.run_command([self.magiskboot_path, "repack", "boot.img"], 
-                                    cwd=self.temp_dir)
-            
-            if result != 0:
-                raise Exception("Failed to repack boot image!")
-                
-            # Check output
-            new_boot_path = os.path.join(self.temp_dir, "new-boot.img")
-            if not os.path.exists(new_boot_path):
-                raise Exception("Output boot image not found!")
-                
-            # Calculate SHA256 of patched image
-            new_sha256 = self.calculate_sha256(new_boot_path)
-            self.log(f"Patched boot SHA256: {new_sha256}", "INFO")
+            # Create temp directory
+            self.temp_dir = engine.make_work_dir(self.boot_image_file)
+            try:
+                result = engine.patch(self.boot_image_file, self.magisk_apk_file,
+                                      arch, options, work_dir=self.temp_dir)
+            finally:
+                self.call_in_ui(self._set_last_report, engine.events, engine.report)
             
-            # Save patched image
             self.log("", "")
             self.log("=" * 60)
             self.log("Patching completed successfully!", "SUCCESS")
             self.log("=" * 60)
             
+        except Exception as e:
+            error = e
+            
+        self.call_in_ui(self._patch_finished, result, error)
+        
+    def _set_last_report(self, events, report):
+        self.last_events = events
+        self.last_report = report
+        
+    def _patch_finished(self, result, error):
+        """Save the patched image and reset the UI; runs on the Tk thread"""
+        try:
+            if isinstance(error, PatchCancelled):
+                self.log("Patching cancelled", "WARNING")
+                return
+            if error:
+                raise error
+                
             # Ask where to save
             save_path = filedialog.asksaveasfilename(
                 defaultextension=".img",
@@ -914,8 +863,12 @@ class MagiskPatcherEnhanced:
             )
             
             if save_path:
-                shutil.copy2(new_boot_path, save_path)
+                digest = clone_and_hash(result.output_path, save_path, allow_link=True)
+                if digest.sha256 != result.sha256:
+                    raise PatchError("Saved image does not match the patched image!")
                 self.log(f"Saved to: {save_path}", "SUCCESS")
+                self.last_report["output"]["path"] = os.path.abspath(save_path)
+                self.write_report_files(os.path.splitext(save_path)[0] + ".report.json")
                 
                 # Show success dialog
                 size = os.path.getsize(save_path) / (1024 * 1024)
@@ -924,7 +877,7 @@ class MagiskPatcherEnhanced:
                     f"Boot image patched successfully!\n\n"
                     f"Output: {os.path.basename(save_path)}\n"
                     f"Size: {size:.2f} MB\n"
-                    f"SHA256: {new_sha256[:16]}...\n\n"
+                    f"SHA256: {result.sha256[:16]}...\n\n"
                     f"Flash this image to your device's boot partition."
                 )
             else:
@@ -947,180 +900,493 @@ class MagiskPatcherEnhanced:
             self.patch_button.config(state=tk.NORMAL, text="🚀 PATCH")
             self.set_status("Ready")
             self.is_patching = False
+
+
+def add_cache_arguments(parser):
+    """Add the payload cache options shared by the headless commands"""
+    parser.add_argument("--cache-dir", default=default_cache_dir(),
+                        help="Payload cache directory (default: %(default)s)")
+    parser.add_argument("--cache-size", type=parse_size, default=DEFAULT_CACHE_SIZE,
+                        help="Payload cache size cap, e.g. 512M or 2G (default: 512M)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always extract and compress the payload from the APK")
+
+
+def add_result_cache_arguments(parser):
+    """Add the options of the cache of finished images"""
+    parser.add_argument("--result-cache-size", type=parse_size, default=DEFAULT_RESULT_CACHE_SIZE,
+                        help="Result cache size cap for patched images (default: 2G)")
+    parser.add_argument("--no-result-cache", action="store_true",
+                        help="Always run the pipeline, even for inputs patched before")
+
+
+def add_backend_arguments(parser):
+    """Add the options selecting native or magiskboot implementations of stages"""
+    parser.add_argument("--xz-backend", default="lzma", choices=XZ_BACKENDS,
+                        help="Payload compressor: in-process lzma or magiskboot compress=xz "
+                             "(default: lzma)")
+    parser.add_argument("--cpio-backend", default="native", choices=CPIO_BACKENDS,
+                        help="Ramdisk editor: in-memory cpio or magiskboot cpio (default: native)")
+    parser.add_argument("--hexpatch-backend", default="native", choices=HEXPATCH_BACKENDS,
+                        help="Kernel patcher: in-process mmap or magiskboot hexpatch "
+                             "(default: native)")
+    parser.add_argument("--dtb-backend", default="native", choices=DTB_BACKENDS,
+                        help="Device tree patcher: in-process mmap or magiskboot dtb "
+                             "(default: native)")
+    parser.add_argument("--debug", action="store_true",
+                        help="Cross-check native results against magiskboot where possible")
+    parser.add_argument("--profile", choices=PROFILERS,
+                        help="Profile every pipeline stage with cProfile or tracemalloc")
+    parser.add_argument("--profile-dir",
+                        help="Directory for per-stage profiles (default: system temp directory)")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Seconds before a hung magiskboot call is killed "
+                             "(default: %(default)s)")
+    parser.add_argument("--scratch", default="disk", choices=SCRATCH_BACKENDS,
+                        help="Working directory backend: temp directory or RAM-backed "
+                             "/dev/shm (default: disk)")
+    parser.add_argument("--ram-budget", type=parse_size, default=DEFAULT_RAM_BUDGET,
+                        help="RAM scratch budget shared by all runs, e.g. 512M or 2G; runs over "
+                             "it use disk (default: 512M)")
+
+
+def add_option_arguments(parser):
+    """Add the PatchOptions flags"""
+    parser.add_argument("--no-keep-verity", dest="keep_verity", action="store_false",
+                        help="Remove AVB 2.0/dm-verity")
+    parser.add_argument("--no-keep-force-encrypt", dest="keep_force_encrypt",
+                        action="store_false", help="Remove forced encryption")
+    parser.add_argument("--recovery-mode", action="store_true",
+                        help="Patch for recovery installation")
+    parser.add_argument("--patch-vbmeta-flag", action="store_true",
+                        help="Patch vbmeta flags")
+    parser.add_argument("--legacy-sar", action="store_true",
+                        help="Old System-as-Root device")
+
+
+def patch_options(args):
+    """PatchOptions selected by the add_option_arguments flags"""
+    return PatchOptions(
+        keep_verity=args.keep_verity,
+        keep_force_encrypt=args.keep_force_encrypt,
+        recovery_mode=args.recovery_mode,
+        patch_vbmeta_flag=args.patch_vbmeta_flag,
+        legacy_sar=args.legacy_sar
+    )
+
+
+def add_catalog_argument(parser):
+    """Add the option locating the local release catalog"""
+    parser.add_argument("--catalog", default=default_catalog_dir(),
+                        help="Release catalog directory (default: $MAGISK_PATCHER_CATALOG "
+                             "or %(default)s)")
+
+
+def resolve_apk(args, payload_cache=None):
+    """Return the APK selected by --apk or --magisk-version
+
+    Catalog APKs come with their SHA256, which is handed to the payload
+    cache so it never rehashes them.
+    """
+    if args.apk:
+        return args.apk
+    catalog = ApkCatalog(args.catalog)
+    path = catalog.path_for(args.magisk_version)
+    if payload_cache:
+        catalog.prime(payload_cache)
+    return path
+
+
+def engine_options(args, magiskboot_info=None):
+    """PatchEngine keyword arguments selected on the command line
+
+    With a resolved magiskboot_info, stages it cannot run use their
+    native backend.
+    """
+    return {"xz_backend": args.xz_backend, "cpio_backend": args.cpio_backend,
+            "hexpatch_backend": args.hexpatch_backend, "dtb_backend": args.dtb_backend,
+            "debug": args.debug,
+            "profile": args.profile, "profile_dir": args.profile_dir,
+            "scratch": ScratchSpace(args.scratch, args.ram_budget),
+            "command_timeout": args.timeout, "magiskboot_info": magiskboot_info}
+
+
+def build_arg_parser():
+    """Build the command line parser for headless use"""
+    parser = argparse.ArgumentParser(
+        description="Magisk Boot Patcher v0.2.0 (starts the GUI when no command is given)")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    patch_parser = subparsers.add_parser("patch", help="Patch a boot image without the GUI")
+    patch_parser.add_argument("--boot", required=True, help="Boot image to patch")
+    apk_group = patch_parser.add_mutually_exclusive_group(required=True)
+    apk_group.add_argument("--apk", help="Magisk APK")
+    apk_group.add_argument("--magisk-version",
+                           help="Take the APK from the catalog: version code, name or 'latest'")
+    add_catalog_argument(patch_parser)
+    patch_parser.add_argument("--arch", default="arm64-v8a", choices=ARCHITECTURES,
+                              help="Device architecture (default: arm64-v8a)")
+    patch_parser.add_argument("--output", "-o",
+                              help="Output image (default: magisk_patched_<timestamp>.img)")
+    patch_parser.add_argument("--magiskboot", help="Path to magiskboot (default: $MAGISKBOOT, the config "
+                                   "file, the current directory, then PATH)")
+    add_option_arguments(patch_parser)
+    add_cache_arguments(patch_parser)
+    add_result_cache_arguments(patch_parser)
+    add_backend_arguments(patch_parser)
+    patch_parser.add_argument("--verify-xz", action="store_true",
+                              help="Check the lzma backend against magiskboot before compressing")
+    patch_parser.add_argument("--events",
+                              help="Write JSON-lines patch events to this file ('-' for stderr)")
+    patch_parser.add_argument("--report", help="Write the JSON patch report to this file")
+    
+    inspect_parser = subparsers.add_parser("inspect",
+                                           help="Describe boot image headers and sections as JSON")
+    inspect_parser.add_argument("images", nargs="+", help="Boot or vendor_boot images")
+    
+    batch_parser = subparsers.add_parser("batch", help="Patch every job of a JSON manifest in parallel")
+    batch_parser.add_argument("--manifest", required=True, help="JSON manifest of patch jobs")
+    batch_parser.add_argument("--output-dir", default="patched",
+                              help="Directory for patched images and job logs (default: patched)")
+    batch_parser.add_argument("--jobs", "-j", type=int, default=None,
+                              help="Number of worker processes (default: all cores)")
+    batch_parser.add_argument("--magiskboot", help="Path to magiskboot (default: $MAGISKBOOT, the config "
+                                   "file, the current directory, then PATH)")
+    batch_parser.add_argument("--results", help="Write per-job results as JSON to this file")
+    add_catalog_argument(batch_parser)
+    add_cache_arguments(batch_parser)
+    add_result_cache_arguments(batch_parser)
+    batch_parser.add_argument("--vbmeta-dir",
+                              help="Also disable AVB flags in every .img of this directory")
+    add_backend_arguments(batch_parser)
+    
+    plan_parser = subparsers.add_parser(
+        "plan", help="Predict what patching would do to each image, read-only and in parallel")
+    plan_parser.add_argument("images", nargs="+", help="Boot images or directories of .img files")
+    plan_apk_group = plan_parser.add_mutually_exclusive_group()
+    plan_apk_group.add_argument("--apk", help="Magisk APK to check the architecture against")
+    plan_apk_group.add_argument("--magisk-version",
+                                help="Take the APK from the catalog: version code, name or "
+                                     "'latest'")
+    add_catalog_argument(plan_parser)
+    plan_parser.add_argument("--arch", default="arm64-v8a", choices=ARCHITECTURES,
+                             help="Device architecture (default: arm64-v8a)")
+    add_option_arguments(plan_parser)
+    plan_parser.add_argument("--jobs", "-j", type=int, default=None,
+                             help="Number of worker processes (default: all cores)")
+    plan_parser.add_argument("--results", help="Write the plan of every image as JSON to this file")
+    
+    vbmeta_parser = subparsers.add_parser(
+        "vbmeta", help="Set the AVB flags of vbmeta images or images with an AVB footer")
+    vbmeta_parser.add_argument("paths", nargs="+", help="Images or directories of .img files")
+    vbmeta_parser.add_argument("--flags", type=lambda value: int(value, 0), default=DISABLE_FLAGS,
+                               help="Flags to write (default: %(default)s, verity and "
+                                    "verification disabled)")
+    vbmeta_parser.add_argument("--jobs", "-j", type=int, default=None,
+                               help="Number of images patched at once (default: all cores)")
+    vbmeta_parser.add_argument("--dry-run", action="store_true",
+                               help="Only report the current flags")
+    
+    prepare_parser = subparsers.add_parser(
+        "prepare", help="Extract and compress the payloads of several ABIs in one pass")
+    prepare_parser.add_argument("--apk", required=True, help="Magisk APK")
+    prepare_parser.add_argument("--arch", action="append", choices=ARCHITECTURES,
+                                help="Architecture to prepare, repeatable (default: all in the APK)")
+    prepare_parser.add_argument("--output-dir",
+                                help="Also keep the payloads here, one directory per architecture")
+    prepare_parser.add_argument("--magiskboot",
+                                help="Path to magiskboot, for --xz-backend magiskboot")
+    add_cache_arguments(prepare_parser)
+    add_backend_arguments(prepare_parser)
+    
+    download_parser = subparsers.add_parser("download", help="Download the latest Magisk APK")
+    download_parser.add_argument("--output-dir", default=".",
+                                 help="Directory to copy the APK to (default: current directory)")
+    download_parser.add_argument("--api-url",
+                                 help="Releases API base URL (default: $MAGISK_RELEASES_API "
+                                      "or https://api.github.com)")
+    download_parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS,
+                                 help="Parallel ranged segments (default: %(default)s)")
+    download_parser.add_argument("--cache-dir", default=default_cache_dir(),
+                                 help="Download cache directory (default: %(default)s)")
+    download_parser.add_argument("--add-to-catalog", action="store_true",
+                                 help="Also add the APK to the release catalog")
+    add_catalog_argument(download_parser)
+    
+    catalog_parser = subparsers.add_parser("catalog", help="Manage the local release catalog")
+    add_catalog_argument(catalog_parser)
+    catalog_actions = catalog_parser.add_subparsers(dest="catalog_action", required=True)
+    catalog_add = catalog_actions.add_parser("add", help="Add APKs or directories of APKs")
+    catalog_add.add_argument("paths", nargs="+", help="Magisk APKs or directories")
+    catalog_actions.add_parser("list", help="List catalog versions as JSON")
+    catalog_remove = catalog_actions.add_parser("remove", help="Remove a version")
+    catalog_remove.add_argument("version", help="Version code, name or 'latest'")
+    catalog_prepare = catalog_actions.add_parser(
+        "prepare", help="Fill the payload cache for a version and record its cache keys")
+    catalog_prepare.add_argument("version", help="Version code, name or 'latest'")
+    catalog_prepare.add_argument("--arch", action="append", choices=ARCHITECTURES,
+                                 help="Architecture to prepare, repeatable "
+                                      "(default: all in the APK)")
+    catalog_prepare.add_argument("--magiskboot",
+                                 help="Path to magiskboot, for --xz-backend magiskboot")
+    catalog_prepare.add_argument("--cache-dir", default=default_cache_dir(),
+                                 help="Payload cache directory (default: %(default)s)")
+    catalog_prepare.add_argument("--cache-size", type=parse_size, default=DEFAULT_CACHE_SIZE,
+                                 help="Payload cache size cap, e.g. 512M or 2G (default: 512M)")
+    add_backend_arguments(catalog_prepare)
+    
+    return parser
+
+
+def run_download_command(args):
+    """Download the latest Magisk APK, returning the process exit code"""
+    def on_progress(downloaded, total_size):
+        if total_size > 0:
+            print(f"\rDownloading: {downloaded * 100 / total_size:5.1f}%",
+                  end="\n" if downloaded >= total_size else "", file=sys.stderr)
             
-    def run_command(self, cmd, cwd=None):
-        """Run command and capture output"""
-        try:
-            if isinstance(cmd, str):
-                cmd = cmd.split()
-                
-            # Log command
-            self.log(f"$ {' '.join(cmd)}", "DEBUG")
-            
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                cwd=cwd,
-                universal_newlines=True
-            )
-            
-            for line in iter(process.stdout.readline, ''):
-                if line:
-                    self.log(line.strip())
-                    
-            process.wait()
-            return process.returncode
-            
-        except Exception as e:
-            self.log(f"Command failed: {str(e)}", "ERROR")
-            return -1
+    downloader = MagiskDownloader(args.cache_dir, api_url=args.api_url, segments=args.segments,
+                                  log=console_log)
+    try:
+        os.makedirs(args.output_dir, exist_ok=True)
+        release, path = downloader.download_latest(args.output_dir, on_progress)
+        if args.add_to_catalog:
+            entry = ApkCatalog(args.catalog).add(path)
+            print(f"Added {entry['version_name']} ({entry['version_code']}) to the catalog",
+                  file=sys.stderr)
+    except (OSError, DownloadError, CatalogError) as e:
+        print(f"\nError: {str(e)}", file=sys.stderr)
+        return 1
+        
+    print(f"{release['tag_name']}  {os.path.abspath(path)}")
+    return 0
+
+
+def run_batch_command(args):
+    """Run the batch command, returning the process exit code"""
+    from batch_patcher import format_results, load_manifest, run_batch
+    
+    # Resolved and probed once here; workers get the result with the engine options
+    magiskboot = resolve_magiskboot(args.magiskboot)
+    if not magiskboot:
+        print("magiskboot not found!", file=sys.stderr)
+        return 2
+        
+    try:
+        jobs = load_manifest(args.manifest, os.path.abspath(args.output_dir),
+                             catalog=ApkCatalog(args.catalog))
+    except (OSError, ValueError, PatchError) as e:
+        print(f"Invalid manifest: {str(e)}", file=sys.stderr)
+        return 2
+        
+    vbmeta_images = find_vbmeta_images(args.vbmeta_dir) if args.vbmeta_dir else []
+    vbmeta_records = []
+    
+    def on_result(record):
+        print(f"[{record['status'].upper()}] {record['name']} ({record['seconds']:.2f}s)",
+              file=sys.stderr)
+        
+    records = run_batch(jobs, magiskboot.path, max_workers=args.jobs,
+                        on_result=on_result,
+                        cache_dir=None if args.no_cache else args.cache_dir,
+                        cache_size=args.cache_size,
+                        result_cache_size=None if args.no_result_cache else args.result_cache_size,
+                        engine_options=engine_options(args, magiskboot),
+                        vbmeta_images=vbmeta_images, on_vbmeta=vbmeta_records.append)
+    print(format_results(records))
+    if vbmeta_records:
+        print("")
+        print(format_vbmeta_results(vbmeta_records))
+    
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(records, f, indent=2)
             
-    def run_command_output(self, cmd, cwd=None):
-        """Run command and return output"""
+    vbmeta_failed = any(r["status"] == "failed" for r in vbmeta_records)
+    return 0 if all(r["status"] == "ok" for r in records) and not vbmeta_failed else 1
+
+
+def run_plan_command(args):
+    """Plan every image without patching it, returning the exit code"""
+    from plan import find_images, format_plan, plan_images
+    
+    apk_path = None
+    if args.apk or args.magisk_version:
         try:
-            if isinstance(cmd, str):
-                cmd = cmd.split()
-                
-            result = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd)
-            return result.stdout.strip()
+            apk_path = resolve_apk(args)
+        except CatalogError as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            return 2
             
-        except Exception as e:
-            return ""
+    records = plan_images(find_images(args.images), apk_path, args.arch, patch_options(args),
+                          max_workers=args.jobs)
+    print(format_plan(records))
+    
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(records, f, indent=2)
             
-    def extract_from_apk(self, apk_path, arch, temp_dir):
-        """Extract necessary files from Magisk APK"""
-        self.log("Extracting files from APK...", "INFO")
-        
-        needed_files = {}
-        
+    return 0 if all(r["action"] in ("patch", "repatch") for r in records) else 1
+
+
+def run_vbmeta_command(args):
+    """Patch or inspect the vbmeta flags of every given image, returning the exit code"""
+    paths = []
+    for path in args.paths:
+        paths.extend(find_vbmeta_images(path) if os.path.isdir(path) else [path])
+    
+    records = patch_vbmeta_images(paths, args.flags, args.jobs, args.dry_run)
+    print(format_vbmeta_results(records))
+    # Directories may hold images without vbmeta; those are only skipped
+    patched = any(r["status"] == "ok" for r in records)
+    return 0 if patched and not any(r["status"] == "failed" for r in records) else 1
+
+
+def run_prepare_command(args):
+    """Fill the payload cache for every requested ABI, returning the exit code"""
+    magiskboot = resolve_magiskboot(args.magiskboot)
+    if args.xz_backend == "magiskboot" and not magiskboot:
+        print("magiskboot not found!", file=sys.stderr)
+        return 2
+        
+    payload_cache = None if args.no_cache else PayloadCache(args.cache_dir, args.cache_size)
+    if not payload_cache and not args.output_dir:
+        print("Nothing to do: --no-cache given without --output-dir", file=sys.stderr)
+        return 2
+        
+    output_dir = os.path.abspath(args.output_dir) if args.output_dir else None
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        
+    engine = PatchEngine(magiskboot.path if magiskboot else None,
+                         payload_cache=payload_cache, **engine_options(args, magiskboot))
+    prepared = engine.prepare_payloads(args.apk, args.arch, output_dir)
+    for arch, ready in prepared.items():
+        print(f"{'ok' if ready else 'failed'}  {arch}")
+        
+    return 0 if prepared and all(prepared.values()) else 1
+
+
+def run_catalog_command(args):
+    """Add, list, remove or prepare catalog versions, returning the exit code"""
+    catalog = ApkCatalog(args.catalog)
+    try:
+        if args.catalog_action == "add":
+            for path in args.paths:
+                added = catalog.add_directory(path) if os.path.isdir(path) else [catalog.add(path)]
+                for entry in added:
+                    print(f"{entry['version_code']}  {entry['version_name']}  {entry['sha256']}")
+        elif args.catalog_action == "list":
+            print(json.dumps(catalog.versions(), indent=2))
+        elif args.catalog_action == "remove":
+            entry = catalog.remove(args.version)
+            print(f"Removed {entry['version_name']} ({entry['version_code']})")
+        elif args.catalog_action == "prepare":
+            return prepare_catalog_version(catalog, args)
+    except (OSError, CatalogError) as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def prepare_catalog_version(catalog, args):
+    """Cache the payloads of a catalog version and record where they went"""
+    magiskboot = resolve_magiskboot(args.magiskboot)
+    if args.xz_backend == "magiskboot" and not magiskboot:
+        print("magiskboot not found!", file=sys.stderr)
+        return 2
+        
+    entry = catalog.get(args.version)
+    apk_path = catalog.path_for(entry["version_code"])
+    payload_cache = PayloadCache(args.cache_dir, args.cache_size)
+    payload_cache.remember_sha256(apk_path, entry["sha256"])
+    
+    engine = PatchEngine(magiskboot.path if magiskboot else None,
+                         payload_cache=payload_cache, **engine_options(args, magiskboot))
+    prepared = engine.prepare_payloads(apk_path, args.arch)
+    catalog.record_payloads(entry["version_code"],
+                            {arch: payload_cache.key_for(apk_path, arch)
+                             for arch, ready in prepared.items() if ready})
+    for arch, ready in prepared.items():
+        print(f"{'ok' if ready else 'failed'}  {arch}")
+        
+    return 0 if prepared and all(prepared.values()) else 1
+
+
+def run_inspect_command(args):
+    """Print the parsed header of each image as JSON, returning the exit code"""
+    from bootimg import BootImageError, inspect_boot_image
+    
+    descriptions = []
+    status = 0
+    for path in args.images:
         try:
-            with zipfile.ZipFile(apk_path, 'r') as apk:
-                # Get Magisk version
-                magisk_ver = 0
-                magisk_ver_name = ""
-                
-                try:
-                    with apk.open('assets/util_functions.sh') as f:
-                        content = f.read().decode('utf-8')
-                        
-                        # Version code
-                        match = re.search(r'MAGISK_VER_CODE=(\d+)', content)
-                        if match:
-                            magisk_ver = int(match.group(1))
-                            
-                        # Version name
-                        match = re.search(r'MAGISK_VER="([^"]+)"', content)
-                        if match:
-                            magisk_ver_name = match.group(1)
-                            
-                    self.log(f"Magisk version: {magisk_ver_name} ({magisk_ver})", "INFO")
-                except:
-                    self.log("Could not determine Magisk version", "WARNING")
-                
-                # List all lib files
-                available_libs = {}
-                for file_info in apk.filelist:
-                    if file_info.filename.startswith('lib/') and file_info.filename.endswith('.so'):
-                        parts = file_info.filename.split('/')
-                        if len(parts) == 3:  # lib/arch/file.so
-                            arch_name = parts[1]
-                            lib_name = parts[2]
-                            
-                            if arch_name not in available_libs:
-                                available_libs[arch_name] = []
-                            available_libs[arch_name].append(lib_name)
-                
-                self.log(f"Available architectures: {', '.join(available_libs.keys())}", "INFO")
-                
-                # Extract needed files
-                for file_info in apk.filelist:
-                    filename = file_info.filename
-                    parts = filename.split('/')
-                    
-                    if len(parts) < 2:
-                        continue
-                        
-                    file_name = parts[-1]
-                    parent_dir = parts[-2] if len(parts) > 1 else ""
-                    
-                    # Handle architecture-specific files
-                    if file_name.startswith('lib') and file_name.endswith('.so'):
-                        # Skip unnecessary files
-                        if file_name in ['libmagiskboot.so', 'libbusybox.so', 'libmagiskpolicy.so']:
-                            continue
-                            
-                        if parent_dir == arch:
-                            output_name = file_name.replace('lib', '').replace('.so', '')
-                            output_path = os.path.join(temp_dir, output_name)
-                            
-                            with apk.open(filename) as src, open(output_path, 'wb') as dst:
-                                dst.write(src.read())
-                                
-                            needed_files[output_name] = output_path
-                            self.log(f"Extracted: {output_name}", "SUCCESS")
-                            
-                        # Handle 32-bit compatibility for old Magisk
-                        elif magisk_ver < 28000:
-                            if arch == "arm64-v8a" and file_name == "libmagisk32.so" and parent_dir == "armeabi-v7a":
-                                output_name = "magisk32"
-                                output_path = os.path.join(temp_dir, output_name)
-                                
-                                with apk.open(filename) as src, open(output_path, 'wb') as dst:
-                                    dst.write(src.read())
-                                    
-                                needed_files[output_name] = output_path
-                                self.log(f"Extracted: {output_name} (32-bit compat)", "SUCCESS")
-                                
-                            elif arch == "x86_64" and file_name == "libmagisk32.so" and parent_dir == "x86":
-                                output_name = "magisk32"
-                                output_path = os.path.join(temp_dir, output_name)
-                                
-                                with apk.open(filename) as src, open(output_path, 'wb') as dst:
-                                    dst.write(src.read())
-                                    
-                                needed_files[output_name] = output_path
-                                self.log(f"Extracted: {output_name} (32-bit compat)", "SUCCESS")
-                    
-                    # Extract stub.apk
-                    elif file_name == "stub.apk":
-                        output_path = os.path.join(temp_dir, "stub.apk")
-                        
-                        with apk.open(filename) as src, open(output_path, 'wb') as dst:
-                            dst.write(src.read())
-                            
-                        needed_files["stub.apk"] = output_path
-                        self.log(f"Extracted: stub.apk", "SUCCESS")
-                        
-                # Check if we got the required files
-                required_files = ["magiskinit"]
-                missing_files = [f for f in required_files if f not in needed_files]
-                
-                if missing_files:
-                    self.log(f"Missing required files: {', '.join(missing_files)}", "ERROR")
-                    
-                    # Check if wrong architecture
-                    if arch not in available_libs:
-                        self.log(f"Architecture {arch} not available in this APK", "ERROR")
-                        self.log(f"Try one of: {', '.join(available_libs.keys())}", "WARNING")
-                    
-                    return None
-                    
-        except Exception as e:
-            self.log(f"Failed to extract from APK: {str(e)}", "ERROR")
-            return None
+            descriptions.append(inspect_boot_image(path))
+        except (OSError, BootImageError) as e:
+            descriptions.append({"path": path, "error": str(e)})
+            status = 1
+            
+    print(json.dumps(descriptions, indent=2))
+    return status
+
+
+def run_patch_command(args):
+    """Run the headless patch command, returning the process exit code"""
+    magiskboot = resolve_magiskboot(args.magiskboot)
+    if not magiskboot:
+        print("magiskboot not found!", file=sys.stderr)
+        return 2
+        
+    options = patch_options(args)
+    output = args.output or f"magisk_patched_{datetime.now().strftime('%Y%m%d_%H%M%S')}.img"
+    
+    # Checked up front: a bad --output would otherwise only fail after the whole pipeline
+    if not os.path.isfile(args.boot):
+        print(f"Error: Boot image not found: {args.boot}", file=sys.stderr)
+        return 2
+    output_dir = os.path.dirname(os.path.abspath(output))
+    if not os.path.isdir(output_dir) or not os.access(output_dir, os.W_OK):
+        print(f"Error: Output directory does not exist or is not writable: {output_dir}",
+              file=sys.stderr)
+        return 2
+    
+    payload_cache = None if args.no_cache else PayloadCache(args.cache_dir, args.cache_size)
+    result_cache = None
+    if not args.no_result_cache:
+        result_cache = ResultCache(args.cache_dir, args.result_cache_size)
+    try:
+        apk_path = resolve_apk(args, payload_cache)
+    except CatalogError as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 2
+    
+    event_stream = None
+    if args.events == "-":
+        event_stream = sys.stderr
+    elif args.events:
+        event_stream = open(args.events, 'w')
+        
+    engine = None
+    try:
+        engine = PatchEngine(magiskboot.path, payload_cache=payload_cache,
+                             result_cache=result_cache, verify_xz=args.verify_xz,
+                             event_stream=event_stream, **engine_options(args, magiskboot))
+        result = engine.patch(args.boot, apk_path, args.arch, options, output_path=output)
+    except (OSError, PatchError) as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if event_stream and event_stream is not sys.stderr:
+            event_stream.close()
+        if args.report and engine and engine.report:
+            write_report(engine.report, args.report)
             
-        return needed_files
-        
-    def calculate_sha256(self, filepath):
-        """Calculate SHA256 hash of file"""
-        sha256_hash = hashlib.sha256()
-        with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+    print(f"{result.sha256}  {result.output_path}")
+    return 0
+
 
-def main():
+def run_gui():
+    """Start the Tk user interface"""
     # Enable DPI awareness on Windows
     if platform.system() == "Windows":
         try:
@@ -1129,9 +1395,34 @@ def main():
         except:
             pass
     
+    import_tk()
     root = tk.Tk()
     app = MagiskPatcherEnhanced(root)
     root.mainloop()
 
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    
+    if args.command == "patch":
+        return run_patch_command(args)
+    if args.command == "batch":
+        return run_batch_command(args)
+    if args.command == "inspect":
+        return run_inspect_command(args)
+    if args.command == "prepare":
+        return run_prepare_command(args)
+    if args.command == "download":
+        return run_download_command(args)
+    if args.command == "catalog":
+        return run_catalog_command(args)
+    if args.command == "vbmeta":
+        return run_vbmeta_command(args)
+    if args.command == "plan":
+        return run_plan_command(args)
+        
+    run_gui()
+    return 0
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Single-pass file copy and hashing
+SHA256, SHA1 and size are computed while the file is copied, so every
+byte is read from disk once. Hardlinks and reflinks skip the copy entirely
+where the filesystem allows it.
+"""
+
+import os
+import sys
+import mmap
+import shutil
+import hashlib
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+BUFFER_SIZE = 1024 * 1024
+
+# ioctl(dst, FICLONE, src) shares the extents of src (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+
+class FileDigest:
+    """Size and digests of a file"""
+
+    def __init__(self, size, sha256, sha1):
+        self.size = size
+        self.sha256 = sha256
+        self.sha1 = sha1
+
+    def __repr__(self):
+        return f"FileDigest(size={self.size}, sha256={self.sha256})"
+
+
+def _kernel_copy_available():
+    # sendfile() to a regular file is Linux-only; copy_file_range needs Linux 4.5+
+    return hasattr(os, "copy_file_range") or (hasattr(os, "sendfile") and sys.platform == "linux")
+
+
+def _kernel_copy(in_fd, out_fd, offset, count):
+    """Copy count bytes at offset between descriptors without a userspace buffer"""
+    while count > 0:
+        if hasattr(os, "copy_file_range"):
+            copied = os.copy_file_range(in_fd, out_fd, count, offset, offset)
+        else:
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            copied = os.sendfile(out_fd, in_fd, offset, count)
+        if copied == 0:
+            raise OSError("Unexpected end of file during copy")
+        offset += copied
+        count -= copied
+
+
+def _copy_mapped(fsrc, fdst, size, sha256, sha1):
+    with mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            for offset in range(0, size, BUFFER_SIZE):
+                with view[offset:offset + BUFFER_SIZE] as chunk:
+                    sha256.update(chunk)
+                    sha1.update(chunk)
+                    _kernel_copy(fsrc.fileno(), fdst.fileno(), offset, len(chunk))
+        finally:
+            view.release()
+
+
+def _copy_buffered(fsrc, fdst, sha256, sha1):
+    size = 0
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read = fsrc.readinto(buffer)
+        if not read:
+            break
+        chunk = view[:read]
+        sha256.update(chunk)
+        sha1.update(chunk)
+        fdst.write(chunk)
+        size += read
+    return size
+
+
+def copy_and_hash(src, dst):
+    """Copy src to dst and return its FileDigest, reading src once
+
+    Where the platform allows it the data is copied in the kernel with
+    copy_file_range/sendfile while the hashes run over an mmap of src;
+    otherwise a 1 MiB buffer is used for both.
+    """
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = False
+        if size and _kernel_copy_available():
+            try:
+                _copy_mapped(fsrc, fdst, size, sha256, sha1)
+                copied = True
+            except OSError:
+                # e.g. EXDEV or an unsupported filesystem: start over buffered
+                sha256 = hashlib.sha256()
+                sha1 = hashlib.sha1()
+                fdst.seek(0)
+                fdst.truncate()
+        if not copied:
+            fsrc.seek(0)
+            size = _copy_buffered(fsrc, fdst, sha256, sha1)
+
+    shutil.copymode(src, dst)
+    return FileDigest(size, sha256.hexdigest(), sha1.hexdigest())
+
+
+def hash_file(path):
+    """Return the FileDigest of path using large buffers"""
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+    size = 0
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            sha256.update(view[:read])
+            sha1.update(view[:read])
+            size += read
+    return FileDigest(size, sha256.hexdigest(), sha1.hexdigest())
+
+
+def _reflink(src, dst):
+    """Create dst as a copy-on-write clone of src, returning False if unsupported"""
+    if not fcntl or sys.platform != "linux":
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def _clone_without_copy(src, dst, allow_link):
+    """Link or reflink src to dst, returning the method used or None"""
+    tmp_path = dst + ".clone"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    if allow_link:
+        try:
+            os.link(src, tmp_path)
+            os.replace(tmp_path, dst)
+            return "link"
+        except OSError:
+            pass
+    if _reflink(src, tmp_path):
+        shutil.copymode(src, tmp_path)
+        os.replace(tmp_path, dst)
+        return "reflink"
+    return None
+
+
+def clone_file(src, dst, allow_link=False):
+    """Make dst a copy of src, sharing data with it where the filesystem can
+
+    A hardlink is tried first with allow_link, which is only safe for files
+    that nobody rewrites in place; then a copy-on-write reflink; then a
+    plain copy. Returns "link", "reflink" or "copy".
+    """
+    method = _clone_without_copy(src, dst, allow_link)
+    if method:
+        return method
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return "copy"
+
+
+def clone_and_hash(src, dst, allow_link=False):
+    """clone_file() that also returns the FileDigest of src
+
+    A linked or reflinked file is hashed in place; otherwise the copy and
+    hash share one read as in copy_and_hash().
+    """
+    if _clone_without_copy(src, dst, allow_link):
+        return hash_file(dst)
+    return copy_and_hash(src, dst)
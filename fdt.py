@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+In-process device tree test and patch
+Finds every flattened device tree in a dtb, kernel_dtb or extra file in one
+scan of an mmap, indexes the /chosen and fstab nodes of each, and applies
+the edits of `magiskboot dtb <file> test` and `dtb <file> patch` in place.
+"""
+
+import os
+import mmap
+import struct
+
+from cpio import patch_verity
+
+
+FDT_MAGIC = b"\xd0\x0d\xfe\xed"
+FDT_HEADER_SIZE = 40
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+SKIP_INITRAMFS = b"skip_initramfs"
+WANT = b"want"
+
+
+class FdtError(Exception):
+    """Raised when a device tree blob is malformed"""
+
+
+class FdtProperty:
+    """A property; offset is the absolute position of its value in the file"""
+
+    __slots__ = ["name", "offset", "length"]
+
+    def __init__(self, name, offset, length):
+        self.name = name
+        self.offset = offset
+        self.length = length
+
+
+class FdtNode:
+    """A node of a parsed device tree"""
+
+    def __init__(self, name):
+        self.name = name
+        self.props = {}
+        self.children = []
+
+    def child(self, name):
+        for node in self.children:
+            if node.name == name:
+                return node
+        return None
+
+    def find(self, name):
+        """Depth-first search for the first node called name, like magiskboot's find_fstab"""
+        if self.name == name:
+            return self
+        for node in self.children:
+            found = node.find(name)
+            if found:
+                return found
+        return None
+
+
+def _align4(value):
+    return (value + 3) & ~3
+
+
+def _cstring(data, offset, end):
+    nul = data.find(b"\0", offset, end)
+    if nul < 0:
+        raise FdtError(f"Unterminated string at {offset:#x}")
+    return bytes(data[offset:nul]), nul
+
+
+class FdtBlob:
+    """One device tree found at offset in a larger buffer
+
+    Only the structure is indexed; property values stay in the buffer and
+    are addressed by absolute offset, so edits go straight to the mapping.
+    """
+
+    def __init__(self, data, offset):
+        if len(data) - offset < FDT_HEADER_SIZE:
+            raise FdtError("Truncated FDT header")
+        (magic, totalsize, off_struct, off_strings, _, version, _, _,
+         size_strings, size_struct) = struct.unpack_from(">10I", data, offset)
+        if magic != 0xd00dfeed or totalsize > len(data) - offset or totalsize < FDT_HEADER_SIZE:
+            raise FdtError(f"Bad FDT header at {offset:#x}")
+        if off_struct >= totalsize or off_strings >= totalsize:
+            raise FdtError(f"FDT blocks outside the blob at {offset:#x}")
+
+        self.offset = offset
+        self.size = totalsize
+        self._strings = offset + off_strings
+        self._strings_end = offset + (off_strings + size_strings if version >= 3 else totalsize)
+        struct_end = offset + (off_struct + size_struct if version >= 17 else totalsize)
+        self.root = self._parse(data, offset + off_struct, min(struct_end, offset + totalsize))
+        self.chosen = self.root.child(b"chosen")
+        self.fstab = self.root.find(b"fstab")
+
+    def _parse(self, data, pos, end):
+        # Tokens are 4-byte aligned relative to the blob, which may sit anywhere
+        align = lambda position: self.offset + _align4(position - self.offset)
+        root = None
+        stack = []
+        while pos + 4 <= end:
+            token, = struct.unpack_from(">I", data, pos)
+            pos += 4
+            if token == FDT_BEGIN_NODE:
+                name, nul = _cstring(data, pos, end)
+                pos = align(nul + 1)
+                node = FdtNode(name)
+                if stack:
+                    stack[-1].children.append(node)
+                elif root is None:
+                    root = node
+                else:
+                    raise FdtError("Multiple root nodes")
+                stack.append(node)
+            elif token == FDT_END_NODE:
+                if not stack:
+                    raise FdtError(f"Unbalanced end of node at {pos - 4:#x}")
+                stack.pop()
+            elif token == FDT_PROP:
+                if not stack or pos + 8 > end:
+                    raise FdtError(f"Misplaced property at {pos - 4:#x}")
+                length, name_offset = struct.unpack_from(">II", data, pos)
+                value_offset = pos + 8
+                if value_offset + length > end:
+                    raise FdtError(f"Property overruns the structure block at {pos - 4:#x}")
+                name, _ = _cstring(data, self._strings + name_offset, self._strings_end)
+                stack[-1].props[name] = FdtProperty(name, value_offset, length)
+                pos = align(value_offset + length)
+            elif token == FDT_NOP:
+                continue
+            elif token == FDT_END:
+                break
+            else:
+                raise FdtError(f"Unknown FDT token {token:#x} at {pos - 4:#x}")
+
+        if root is None or stack:
+            raise FdtError("Incomplete device tree")
+        return root
+
+
+def scan_fdts(data):
+    """Return every device tree in data, in file order
+
+    Like magiskboot, the scan looks for the FDT magic anywhere and skips
+    over each valid blob; candidates that fail to parse are ignored.
+    """
+    blobs = []
+    pos = data.find(FDT_MAGIC)
+    while pos >= 0:
+        try:
+            blob = FdtBlob(data, pos)
+        except (FdtError, struct.error):
+            pos = data.find(FDT_MAGIC, pos + 1)
+            continue
+        blobs.append(blob)
+        pos = data.find(FDT_MAGIC, pos + blob.size)
+    return blobs
+
+
+def _value(data, prop):
+    return bytes(data[prop.offset:prop.offset + prop.length])
+
+
+def dtb_test(data, blobs):
+    """False when an fstab has a system partition mounted at /system_root
+
+    That is how Magisk before v19 patched the dtb, which cannot be undone.
+    """
+    for blob in blobs:
+        if not blob.fstab:
+            continue
+        for node in blob.fstab.children:
+            prop = node.props.get(b"mnt_point")
+            if node.name == b"system" and prop and \
+                    _value(data, prop).split(b"\0", 1)[0] == b"/system_root":
+                return False
+    return True
+
+
+def dtb_patch(data, blobs, keep_verity=True, log=None):
+    """Edit data in place like `magiskboot dtb <file> patch`, returning whether it changed
+
+    skip_initramfs in /chosen bootargs becomes want_initramfs and, unless
+    keep_verity, verity flags are removed from every fstab fsmgr_flags. The
+    property keeps its length; the freed tail is filled with NULs.
+    """
+    log = log or (lambda message: None)
+    patched = False
+    for blob in blobs:
+        bootargs = blob.chosen.props.get(b"bootargs") if blob.chosen else None
+        if bootargs:
+            skip = _value(data, bootargs).find(SKIP_INITRAMFS)
+            if skip >= 0:
+                log("Patch [skip_initramfs] -> [want_initramfs]")
+                data[bootargs.offset + skip:bootargs.offset + skip + len(WANT)] = WANT
+                patched = True
+
+        if keep_verity or not blob.fstab:
+            continue
+        for node in blob.fstab.children:
+            flags = node.props.get(b"fsmgr_flags")
+            if not flags:
+                continue
+            value = _value(data, flags)
+            stripped = patch_verity(value, log)
+            if len(stripped) != len(value):
+                data[flags.offset:flags.offset + flags.length] = \
+                    stripped + b"\0" * (len(value) - len(stripped))
+                patched = True
+    return patched
+
+
+def check_and_patch(path, keep_verity=True, log=None):
+    """Test and patch a dtb file in one mapping
+
+    Returns (test passed, patched, number of device trees found). The test
+    runs on the original contents, as `dtb test` runs before `dtb patch`.
+    """
+    if os.path.getsize(path) == 0:
+        return True, False, 0
+
+    with open(path, "r+b") as f, mmap.mmap(f.fileno(), 0) as data:
+        blobs = scan_fdts(data)
+        test = dtb_test(data, blobs)
+        patched = dtb_patch(data, blobs, keep_verity, log)
+        if patched:
+            data.flush()
+    return test, patched, len(blobs)
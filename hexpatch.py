@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+In-process kernel hexpatching
+Applies several `magiskboot hexpatch` patterns over one writable mmap of the
+kernel and reports the offsets each pattern matched, or only finds them.
+"""
+
+import os
+import mmap
+
+
+class HexPatch:
+    """A named search/replace pair given as hex strings"""
+
+    def __init__(self, old_hex, new_hex, name=None):
+        self.old = bytes.fromhex(old_hex)
+        self.new = bytes.fromhex(new_hex)
+        if not self.old or len(self.old) != len(self.new):
+            raise ValueError(f"Pattern and replacement must be non-empty and equally long: {old_hex}")
+        self.name = name or old_hex
+
+    def __repr__(self):
+        return f"HexPatch({self.name!r})"
+
+
+def apply_hexpatches(path, patches):
+    """Apply every patch to the file at path in one mapping
+
+    Patterns are applied in order with the same semantics as consecutive
+    `magiskboot hexpatch` calls: every non-overlapping occurrence is replaced,
+    and later patterns see the result of earlier ones. The scan itself is
+    C-level memory search over the mapping, so the file is read from disk
+    once and written back once.
+
+    Returns a mapping of patch name to the list of patched offsets.
+    """
+    matches = {patch.name: [] for patch in patches}
+    if os.path.getsize(path) == 0:
+        return matches
+
+    with open(path, "r+b") as f, mmap.mmap(f.fileno(), 0) as data:
+        for patch in patches:
+            offset = data.find(patch.old)
+            while offset >= 0:
+                data[offset:offset + len(patch.new)] = patch.new
+                matches[patch.name].append(offset)
+                offset = data.find(patch.old, offset + len(patch.old))
+
+        if any(matches.values()):
+            data.flush()
+
+    return matches
+
+
+def find_hexpatches(data, patches):
+    """Return the offsets apply_hexpatches would patch in data, without writing
+
+    Each pattern is searched in the original bytes; this equals the applied
+    result unless a replacement creates a match for a later pattern, which
+    none of the kernel patches do.
+    """
+    matches = {}
+    for patch in patches:
+        offsets = []
+        offset = data.find(patch.old)
+        while offset >= 0:
+            offsets.append(offset)
+            offset = data.find(patch.old, offset + len(patch.old))
+        matches[patch.name] = offsets
+    return matches
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+magiskboot discovery and capability probing
+Finds magiskboot through an explicit path, $MAGISKBOOT, the config file,
+the current directory or PATH, runs it once to learn its version and
+subcommands, and caches that probe by path, mtime and SHA256 so later
+runs and batch workers skip both the hash and the subprocess.
+"""
+
+import os
+import re
+import json
+import shutil
+import tempfile
+import threading
+
+from command_runner import CommandRunner
+from fastcopy import hash_file
+from patch_engine import find_magiskboot
+from payload_cache import default_cache_dir
+
+
+MAGISKBOOT_ENV = "MAGISKBOOT"
+CONFIG_ENV = "MAGISK_PATCHER_CONFIG"
+PROBE_CACHE = "magiskboot_probes.json"
+PROBE_CACHE_VERSION = 1
+PROBE_TIMEOUT = 10
+
+# `MagiskBoot v20.4(20400) - ...` up to v25, `MagiskBoot (27.0) - ...` later
+VERSION_PATTERN = re.compile(r"MagiskBoot\s*v?\(?\s*([0-9][0-9A-Za-z.\-]*)(?:[\s:(]+(\d{5}))?")
+# Actions are listed with two leading spaces, their descriptions with more
+COMMAND_PATTERN = re.compile(r"^  ([a-z][a-z0-9]*)\b", re.MULTILINE)
+
+# Engine backend option -> (magiskboot subcommand it runs, native replacement)
+STAGE_COMMANDS = {
+    "xz_backend": ("compress", "lzma"),
+    "cpio_backend": ("cpio", "native"),
+    "hexpatch_backend": ("hexpatch", "native"),
+    "dtb_backend": ("dtb", "native"),
+}
+
+
+def default_config_path():
+    """Return the config file path, honouring MAGISK_PATCHER_CONFIG and XDG_CONFIG_HOME"""
+    if os.environ.get(CONFIG_ENV):
+        return os.environ[CONFIG_ENV]
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "magisk_patcher", "config.json")
+
+
+def load_config(path=None):
+    """Return the config file as a dict; a missing or unreadable file is empty"""
+    try:
+        with open(path or default_config_path(), 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+def find_candidates(explicit=None, config_path=None):
+    """Return (source, path) for every place magiskboot is looked for, in order"""
+    candidates = []
+    if explicit:
+        candidates.append(("argument", explicit))
+    if os.environ.get(MAGISKBOOT_ENV):
+        candidates.append(("env", os.environ[MAGISKBOOT_ENV]))
+    configured = load_config(config_path).get("magiskboot")
+    if configured:
+        candidates.append(("config", os.path.expanduser(configured)))
+    in_cwd = find_magiskboot()
+    if in_cwd:
+        candidates.append(("cwd", in_cwd))
+    # which() also tries magiskboot.exe on Windows, through PATHEXT
+    on_path = shutil.which("magiskboot")
+    if on_path:
+        candidates.append(("path", on_path))
+    return candidates
+
+
+class MagiskbootInfo:
+    """A resolved magiskboot and what its probe found
+
+    commands is None when the usage text could not be parsed; the binary
+    is then assumed to support everything, as before probing existed.
+    """
+
+    def __init__(self, path, source="", sha256="", version="", version_code=0, commands=None):
+        self.path = path
+        self.source = source
+        self.sha256 = sha256
+        self.version = version
+        self.version_code = version_code
+        self.commands = commands
+
+    def supports(self, command):
+        return self.commands is None or command in self.commands
+
+    def select_backends(self, options):
+        """Return (options, fallbacks) with magiskboot backends it cannot run made native
+
+        options are PatchEngine keyword arguments; fallbacks lists the
+        option names that were changed.
+        """
+        selected = dict(options)
+        fallbacks = []
+        for name, (command, native) in STAGE_COMMANDS.items():
+            if selected.get(name) == "magiskboot" and not self.supports(command):
+                selected[name] = native
+                fallbacks.append(name)
+        return selected, fallbacks
+
+    def describe(self):
+        version = self.version or "unknown version"
+        if self.version_code:
+            version += f" ({self.version_code})"
+        return f"{self.path} [{version}, from {self.source}]"
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+def parse_usage(output):
+    """Return (version, version code, subcommands or None) from magiskboot usage text"""
+    version, version_code = "", 0
+    match = VERSION_PATTERN.search(output)
+    if match:
+        version = match.group(1)
+        version_code = int(match.group(2) or 0)
+    commands = sorted(set(COMMAND_PATTERN.findall(output)))
+    return version, version_code, commands or None
+
+
+def probe_magiskboot(path, runner=None):
+    """Run magiskboot without arguments and parse the usage it prints"""
+    result = (runner or CommandRunner()).run([path], timeout=PROBE_TIMEOUT)
+    if result.error or result.timed_out:
+        return "", 0, None
+    return parse_usage(result.output)
+
+
+class ProbeCache:
+    """JSON file of probe results keyed by path, size and mtime
+
+    Each entry also records the binary's SHA256, so a binary that was
+    copied or touched is only rehashed, not run again.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), PROBE_CACHE)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != PROBE_CACHE_VERSION:
+            return {}
+        return data.get("probes", {})
+
+    def _save(self, probes):
+        """Write atomically; concurrent writers lose entries, never the file"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".probes-", dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"version": PROBE_CACHE_VERSION, "probes": probes}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _stat_key(path, stat):
+        return f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def resolve(self, path, source, runner=None):
+        """Return the MagiskbootInfo of path, probing it only when nothing matches"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = self._stat_key(path, stat)
+        with self._lock:
+            probes = self._load()
+        if key in probes:
+            return MagiskbootInfo.from_dict(dict(probes[key], path=path, source=source))
+
+        sha256 = hash_file(path).sha256
+        same_binary = next((entry for entry in probes.values() if entry["sha256"] == sha256), None)
+        if same_binary:
+            info = MagiskbootInfo.from_dict(dict(same_binary, path=path, source=source))
+        else:
+            version, version_code, commands = probe_magiskboot(path, runner)
+            info = MagiskbootInfo(path, source, sha256, version, version_code, commands)
+
+        with self._lock:
+            probes = self._load()
+            # Older entries for this path describe a binary that is gone
+            probes = {k: v for k, v in probes.items() if v["path"] != path}
+            probes[key] = info.to_dict()
+            try:
+                self._save(probes)
+            except OSError:
+                pass
+        return info
+
+
+def resolve_magiskboot(explicit=None, cache_dir=None, config_path=None, runner=None):
+    """Return the MagiskbootInfo of the first magiskboot found, or None
+
+    An explicit path that does not exist is not replaced by another
+    candidate: the caller asked for that binary.
+    """
+    cache = ProbeCache(cache_dir)
+    for source, path in find_candidates(explicit, config_path):
+        if os.path.isfile(path):
+            try:
+                return cache.resolve(path, source, runner)
+            except OSError:
+                continue
+        if source == "argument":
+            return None
+    return None
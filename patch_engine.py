@@ -0,0 +1,976 @@
+#!/usr/bin/env python3
+"""
+Headless Magisk boot image patch engine
+Runs the full patch pipeline without any GUI dependency
+"""
+
+import os
+import sys
+import lzma
+import shutil
+import zipfile
+import tempfile
+import platform
+from datetime import datetime
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import xz_backend
+from apk_index import ApkError, load_apk_index
+from bootimg import BootImage, BootImageError
+from command_runner import DEFAULT_TIMEOUT, CommandCancelled, CommandRunner
+from cpio import MAGISK_PATCHED, STOCK, UNSUPPORTED, Cpio, CpioError
+from fdt import FdtError, check_and_patch
+from hexpatch import HexPatch, apply_hexpatches
+from fastcopy import clone_and_hash, clone_file, hash_file
+from patch_log import EventLog
+from scratch import ScratchSpace, estimate_scratch
+from stage_timer import StageTimer
+from vbmeta import DISABLE_FLAGS, VbmetaError, patch_vbmeta_flags
+
+
+ARCHITECTURES = ["arm64-v8a", "armeabi-v7a", "x86_64", "x86"]
+
+# Kernel hexpatches applied to every kernel (old, new)
+KERNEL_PATCHES = [
+    ("49010054011440B93FA00F71E9000054010840B93FA00F7189000054001840B91FA00F7188010054",
+     "A1020054011440B93FA00F7140020054010840B93FA00F71E0010054001840B91FA00F7181010054"),
+    ("821B8012", "E2FF8F12"),
+    ("70726F63615F636F6E66696700", "70726F63615F6D616769736B00")
+]
+
+# skip_initramfs -> want_initramfs, only for legacy SAR devices
+LEGACY_SAR_PATCH = ("736B69705F696E697472616D667300", "77616E745F696E697472616D667300")
+
+OVERLAY_BINARIES = ["magisk", "magisk32", "magisk64", "init-ld"]
+# Payload files without which a patch cannot start
+REQUIRED_PAYLOADS = ["magiskinit"]
+CPIO_BACKENDS = ["native", "magiskboot"]
+HEXPATCH_BACKENDS = ["native", "magiskboot"]
+DTB_BACKENDS = ["native", "magiskboot"]
+DTB_FILES = ["dtb", "kernel_dtb", "extra"]
+
+# `cpio test` return codes as reported in events
+RAMDISK_STATES = {STOCK: "stock", MAGISK_PATCHED: "magisk", UNSUPPORTED: "unsupported"}
+
+
+class PatchError(Exception):
+    """Raised when a patch step fails"""
+
+
+class PatchCancelled(PatchError):
+    """Raised when a run is cancelled through its runner's CancelToken"""
+
+
+class PatchOptions:
+    """Patch flags passed to magiskboot and written to the ramdisk config"""
+
+    FLAGS = ['KEEPVERITY', 'KEEPFORCEENCRYPT', 'RECOVERYMODE', 'PATCHVBMETAFLAG', 'LEGACYSAR']
+
+    def __init__(self, keep_verity=True, keep_force_encrypt=True, recovery_mode=False,
+                 patch_vbmeta_flag=False, legacy_sar=False):
+        self.keep_verity = keep_verity
+        self.keep_force_encrypt = keep_force_encrypt
+        self.recovery_mode = recovery_mode
+        self.patch_vbmeta_flag = patch_vbmeta_flag
+        self.legacy_sar = legacy_sar
+
+    @classmethod
+    def from_dict(cls, values):
+        """Build options from a mapping of keyword names, e.g. from a manifest"""
+        unknown = set(values) - set(cls().__dict__)
+        if unknown:
+            raise PatchError(f"Unknown patch options: {', '.join(sorted(unknown))}")
+        return cls(**values)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def as_flags(self):
+        """Return the flags as a KEY -> 'true'/'false' mapping"""
+        values = [self.keep_verity, self.keep_force_encrypt, self.recovery_mode,
+                  self.patch_vbmeta_flag, self.legacy_sar]
+        return {key: 'true' if value else 'false' for key, value in zip(self.FLAGS, values)}
+
+    def __repr__(self):
+        flags = ", ".join(f"{k}={v}" for k, v in self.as_flags().items())
+        return f"PatchOptions({flags})"
+
+
+class PatchResult:
+    """Outcome of a successful patch run"""
+
+    def __init__(self, output_path, sha256, original_sha256, sha1="", report=None):
+        # sha256 and report are filled in once the patched image is hashed or saved
+        self.output_path = output_path
+        self.sha256 = sha256
+        self.original_sha256 = original_sha256
+        self.sha1 = sha1
+        self.report = report
+
+
+def console_log(message, level="INFO"):
+    """Default log sink for headless runs"""
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    if level:
+        print(f"[{timestamp}] [{level}] {message}", file=sys.stderr)
+    else:
+        print(message, file=sys.stderr)
+
+
+def find_magiskboot(search_dir=None):
+    """Return the absolute path of magiskboot in search_dir, or None"""
+    if platform.system() == "Windows":
+        magiskboot_name = "magiskboot.exe"
+    else:
+        magiskboot_name = "magiskboot"
+
+    path = os.path.join(search_dir or os.getcwd(), magiskboot_name)
+    if os.path.exists(path):
+        return os.path.abspath(path)
+    return None
+
+
+def kernel_patches(legacy_sar=False):
+    """The HexPatches applied to a kernel, named as they are reported"""
+    patches = [HexPatch(old_hex, new_hex, name=f"{old_hex[:16]}...")
+               for old_hex, new_hex in KERNEL_PATCHES]
+    if legacy_sar:
+        patches.append(HexPatch(*LEGACY_SAR_PATCH, name="legacy SAR"))
+    return patches
+
+
+def calculate_sha256(filepath):
+    """Calculate SHA256 hash of file"""
+    return hash_file(filepath).sha256
+
+
+def _total_size(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+class PatchEngine:
+    """Patch pipeline: copy, extract, unpack, cpio patch, hexpatch, dtb, repack, vbmeta"""
+
+    def __init__(self, magiskboot_path, log=None, payload_cache=None, xz_backend="lzma",
+                 verify_xz=False, cpio_backend="native", hexpatch_backend="native", debug=False,
+                 event_stream=None, profile=None, profile_dir=None, result_cache=None,
+                 scratch=None, runner=None, command_timeout=DEFAULT_TIMEOUT, dtb_backend="native",
+                 magiskboot_info=None):
+        self.magiskboot_path = magiskboot_path
+        self.log = log or console_log
+        self.payload_cache = payload_cache
+        # Finished images keyed by all inputs, see payload_cache.ResultCache
+        self.result_cache = result_cache
+        self.xz_backend = xz_backend
+        self.verify_xz = verify_xz
+        self.cpio_backend = cpio_backend
+        self.hexpatch_backend = hexpatch_backend
+        self.dtb_backend = dtb_backend
+        self.debug = debug
+        # JSON-lines events of the current run go to event_stream, if set
+        self.event_stream = event_stream
+        self.events = EventLog(event_stream)
+        self.report = None
+        # Opt-in per-stage profiler, see stage_timer.PROFILERS
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.timer = None
+        # Where working directories go, see scratch.ScratchSpace
+        self.scratch = scratch or ScratchSpace()
+        self._work_dir_backends = {}
+        # Every subprocess goes through one runner: timeouts, cancel, process slots
+        self.runner = runner or CommandRunner(timeout=command_timeout)
+        # Probed version and subcommands, see magiskboot_resolver.MagiskbootInfo
+        self.magiskboot_info = magiskboot_info
+        if magiskboot_info:
+            self._select_backends(magiskboot_info)
+
+    def _select_backends(self, info):
+        """Run stages natively where the probed magiskboot lacks their subcommand"""
+        backends = {"xz_backend": self.xz_backend, "cpio_backend": self.cpio_backend,
+                    "hexpatch_backend": self.hexpatch_backend, "dtb_backend": self.dtb_backend}
+        selected, fallbacks = info.select_backends(backends)
+        for name in fallbacks:
+            self.log(f"This magiskboot cannot run the {name.split('_')[0]} stage, "
+                     f"using {selected[name]}", "WARNING")
+            setattr(self, name, selected[name])
+
+    def supports(self, command):
+        """Whether magiskboot has a subcommand; unknown without a probe"""
+        return self.magiskboot_info is None or self.magiskboot_info.supports(command)
+
+    def patch(self, boot_image, apk_path, arch, options=None, output_path=None, work_dir=None):
+        """Patch boot_image with the Magisk payload from apk_path
+
+        The patched image is copied to output_path when given, otherwise it
+        stays in the working directory and the caller owns its cleanup.
+
+        Every run emits a fresh event stream (self.events); its folded
+        report is kept in self.report, also when the run fails.
+
+        With a result cache, a run whose inputs were patched before returns
+        the stored image and report without running the pipeline.
+        """
+        options = options or PatchOptions()
+        own_work_dir = work_dir is None
+        if own_work_dir:
+            work_dir = self.make_work_dir(boot_image)
+        else:
+            os.makedirs(work_dir, exist_ok=True)
+
+        self.timer = StageTimer(self.profile, self.profile_dir)
+        self.events = EventLog(self.event_stream, timer=self.timer)
+        self.report = None
+        self.events.emit("run_start", boot=os.path.abspath(boot_image),
+                         apk=os.path.abspath(apk_path), arch=arch, options=options.to_dict(),
+                         backends={"xz": self.xz_backend, "cpio": self.cpio_backend,
+                                   "hexpatch": self.hexpatch_backend, "dtb": self.dtb_backend},
+                         magiskboot=self.magiskboot_info.to_dict() if self.magiskboot_info
+                         else {"path": self.magiskboot_path})
+        self.events.emit("scratch", path=work_dir,
+                         backend=self._work_dir_backends.pop(os.path.abspath(work_dir), "caller"))
+        started = perf_counter()
+
+        try:
+            cache_key = None
+            input_digest = None
+            if self.result_cache:
+                with self.stage("result_cache"):
+                    # Hashed once here; a miss copies the image without hashing it again
+                    input_digest = hash_file(boot_image)
+                    cache_key = self.result_key(input_digest.sha256, apk_path, arch, options)
+                    cached = self.restore_result(cache_key, output_path, work_dir)
+                if cached:
+                    result, report = cached
+                    self.events.emit("run_end", status="ok",
+                                     seconds=round(perf_counter() - started, 6))
+                    report["output"] = self.events.build_report().get("output", {})
+                    report["result_cache"] = {"hit": True, "key": cache_key,
+                                              "seconds": round(perf_counter() - started, 6)}
+                    result.report = self.report = report
+                    return result
+
+            result = self._run_pipeline(boot_image, apk_path, arch, options, work_dir,
+                                        input_digest)
+
+            # Hash the patched image while saving it, or on its own
+            with self.stage("save") as stage:
+                if output_path:
+                    # new-boot.img is never modified again, so it may be hardlinked out
+                    digest = clone_and_hash(result.output_path, output_path, allow_link=True)
+                    result.output_path = os.path.abspath(output_path)
+                else:
+                    digest = hash_file(result.output_path)
+                stage["bytes"] = digest.size
+            result.sha256 = digest.sha256
+            self.events.emit("output", path=result.output_path, size=digest.size,
+                             sha256=digest.sha256, sha1=digest.sha1)
+            self.log(f"Patched boot SHA256: {result.sha256}", "INFO")
+            if output_path:
+                self.log(f"Saved to: {output_path}", "SUCCESS")
+
+            self.log_stage_summary()
+            self.events.emit("run_end", status="ok",
+                             seconds=round(perf_counter() - started, 6))
+            result.report = self.report = self.events.build_report()
+            if cache_key:
+                self.store_result(cache_key, result)
+            return result
+        except BaseException as e:
+            self.log_stage_summary()
+            self.events.emit("run_end", status="failed", error=str(e),
+                             seconds=round(perf_counter() - started, 6))
+            self.report = self.events.build_report()
+            raise
+        finally:
+            if own_work_dir and output_path and os.path.exists(work_dir):
+                try:
+                    shutil.rmtree(work_dir)
+                    self.log("Cleaned up temporary files", "INFO")
+                except OSError:
+                    pass
+
+    def stage(self, name):
+        """Measure a pipeline stage, stopping first if the run was cancelled"""
+        if self.runner.cancel_token.cancelled:
+            raise PatchCancelled("Patch cancelled")
+        return self.events.stage(name)
+
+    def cancel(self):
+        """Cancel the current run from another thread, killing running commands"""
+        self.runner.cancel()
+
+    def make_work_dir(self, boot_image):
+        """Create a working directory for patching boot_image on the scratch backend"""
+        work_dir, backend = self.scratch.make_work_dir(estimate_scratch(boot_image))
+        if self.scratch.backend == "ram" and backend != "ram":
+            self.log("RAM scratch space unavailable or over budget, using disk", "WARNING")
+        self._work_dir_backends[os.path.abspath(work_dir)] = backend
+        return work_dir
+
+    def log_stage_summary(self):
+        """Log the time and resources spent per stage of the last run"""
+        if not self.timer or not self.timer.stages:
+            return
+        self.log("", "")
+        self.log("Stage summary:", "INFO")
+        for line in self.timer.summary().splitlines():
+            self.log(line, "")
+        if self.profile:
+            self.log(f"{self.profile} profiles written to: {self.timer.profile_dir}", "INFO")
+
+    def _run_pipeline(self, boot_image, apk_path, arch, options, work_dir, input_digest=None):
+        self.log(f"Working directory: {work_dir}", "INFO")
+        flags = options.as_flags()
+        env = os.environ.copy()
+        env.update(flags)
+
+        events = self.events
+
+        # Copy boot image, hashing it in the same pass unless it was hashed already
+        boot_path = os.path.join(work_dir, "boot.img")
+        with self.stage("copy") as stage:
+            if input_digest:
+                clone_file(boot_image, boot_path)
+            else:
+                input_digest = clone_and_hash(boot_image, boot_path)
+            stage["bytes"] = input_digest.size
+        events.emit("input", path=os.path.abspath(boot_image), size=input_digest.size,
+                    sha256=input_digest.sha256, sha1=input_digest.sha1)
+        original_sha256 = input_digest.sha256
+        self.log("Copied boot image to working directory", "SUCCESS")
+        self.log(f"Original boot SHA256: {original_sha256}", "INFO")
+
+        # Extract files from APK, or take them from the payload cache
+        with self.stage("extract") as stage:
+            cached_payload = self.lookup_payload(apk_path, arch)
+            if cached_payload:
+                self.log(f"Using cached payload for architecture: {arch}", "SUCCESS")
+                needed_files = self.payload_cache.restore(cached_payload, work_dir)
+            else:
+                self.log(f"Extracting files for architecture: {arch}", "INFO")
+                needed_files = self.extract_from_apk(apk_path, arch, work_dir)
+                if not needed_files:
+                    raise PatchError("Failed to extract necessary files from APK")
+            stage["bytes"] = _total_size(needed_files.values())
+        events.emit("payload", source="cache" if cached_payload else "apk",
+                    files=sorted(needed_files))
+
+        self.log("Configuration:", "INFO")
+        for key, value in flags.items():
+            self.log(f"  {key}: {value}", "INFO")
+
+        self.describe_image(boot_path)
+
+        # Unpack boot image
+        self.log("", "")
+        self.log("Unpacking boot image...", "INFO")
+        with self.stage("unpack") as stage:
+            if self.magiskboot(["unpack", "boot.img"], work_dir, env) != 0:
+                raise PatchError("Failed to unpack boot image!")
+            stage["bytes"] = input_digest.size
+
+        ramdisk_path = os.path.join(work_dir, "ramdisk.cpio")
+        with self.stage("ramdisk_check"):
+            ramdisk = self.check_ramdisk(ramdisk_path, work_dir, env)
+
+        sha1 = self.boot_sha1(input_digest, work_dir)
+
+        if not cached_payload:
+            with self.stage("compress") as stage:
+                self.compress_payloads(needed_files, work_dir, env)
+                self.store_payload(apk_path, arch, needed_files, work_dir)
+                stage["bytes"] = _total_size(needed_files.values())
+
+        # Create magiskinit
+        magiskinit_path = os.path.join(work_dir, "magiskinit")
+        if "magiskinit" in needed_files and \
+                os.path.abspath(needed_files["magiskinit"]) != os.path.abspath(magiskinit_path):
+            clone_file(needed_files["magiskinit"], magiskinit_path, allow_link=True)
+
+        self.write_config(os.path.join(work_dir, "config"), flags, sha1)
+
+        if os.path.exists(ramdisk_path):
+            with self.stage("ramdisk_patch") as stage:
+                self.patch_ramdisk(work_dir, env, ramdisk, options)
+                stage["bytes"] = os.path.getsize(ramdisk_path)
+
+        kernel_path = os.path.join(work_dir, "kernel")
+        if os.path.exists(kernel_path):
+            with self.stage("kernel") as stage:
+                stage["bytes"] = os.path.getsize(kernel_path)
+                self.patch_kernel(kernel_path, work_dir, env, options.legacy_sar)
+
+        with self.stage("dtb"):
+            self.patch_dtbs(work_dir, env)
+
+        # Repack boot image
+        self.log("", "")
+        self.log("Repacking boot image...", "INFO")
+        with self.stage("repack") as stage:
+            if self.magiskboot(["repack", "boot.img"], work_dir, env) != 0:
+                raise PatchError("Failed to repack boot image!")
+            if os.path.exists(os.path.join(work_dir, "new-boot.img")):
+                stage["bytes"] = os.path.getsize(os.path.join(work_dir, "new-boot.img"))
+
+        new_boot_path = os.path.join(work_dir, "new-boot.img")
+        if not os.path.exists(new_boot_path):
+            raise PatchError("Output boot image not found!")
+
+        if options.patch_vbmeta_flag:
+            with self.stage("vbmeta"):
+                self.patch_vbmeta(new_boot_path)
+
+        return PatchResult(new_boot_path, "", original_sha256, sha1)
+
+    def describe_image(self, boot_path):
+        """Log the boot image layout parsed natively, before magiskboot unpacks it"""
+        try:
+            with BootImage(boot_path) as image:
+                description = image.describe()
+        except (OSError, BootImageError) as e:
+            self.log(f"Could not parse boot image header: {str(e)}", "WARNING")
+            return None
+
+        self.log(f"Image: {description['kind']} header v{description['header_version']}, "
+                 f"page size {description['page_size']}", "INFO")
+        for name, section in description["sections"].items():
+            self.log(f"  {name}: {section['size']} bytes ({section['format']})", "INFO")
+        if description["kind"] == "vendor_boot":
+            self.log("vendor_boot image: magiskboot decides how its ramdisks are patched", "WARNING")
+        elif "ramdisk" not in description["sections"]:
+            self.log("Header declares no ramdisk", "WARNING")
+        return description
+
+    def result_key(self, boot_sha256, apk_path, arch, options):
+        """Result cache key of a run; the APK hash is shared with the payload cache
+
+        The backends are part of the key: lzma and magiskboot xz output, for
+        one, are not guaranteed to be byte-identical.
+        """
+        if self.payload_cache:
+            apk_sha256 = self.payload_cache.apk_sha256(apk_path)
+        else:
+            apk_sha256 = self.result_cache.file_sha256(apk_path)
+        tool_sha256 = ""
+        info = self.magiskboot_info
+        if info and info.sha256 and info.path == os.path.abspath(self.magiskboot_path or ""):
+            tool_sha256 = info.sha256
+        elif self.magiskboot_path and os.path.exists(self.magiskboot_path):
+            tool_sha256 = self.result_cache.file_sha256(self.magiskboot_path)
+        backends = {"xz": self.xz_backend, "cpio": self.cpio_backend,
+                    "hexpatch": self.hexpatch_backend, "dtb": self.dtb_backend}
+        key = self.result_cache.key_for(boot_sha256, apk_sha256, arch, options.as_flags(),
+                                        tool_sha256, backends)
+        self.events.emit("result_cache", key=key)
+        return key
+
+    def restore_result(self, key, output_path, work_dir):
+        """Copy a cached image to output_path (or work_dir/new-boot.img)
+
+        Returns (PatchResult, stored report), or None on a miss or when the
+        entry fails its integrity check.
+        """
+        try:
+            info = self.result_cache.get(key)
+            if not info:
+                return None
+            dst_path = output_path or os.path.join(work_dir, "new-boot.img")
+            digest = clone_and_hash(self.result_cache.file_path(info, "image"), dst_path)
+            if digest.sha256 != info["metadata"].get("sha256"):
+                self.log("Cached result is corrupt, patching again", "WARNING")
+                self.result_cache.remove(key)
+                os.remove(dst_path)
+                return None
+            report = self.result_cache.load_report(info)
+        except (OSError, ValueError) as e:
+            self.log(f"Result cache unavailable: {str(e)}", "WARNING")
+            return None
+
+        self.log("Identical inputs were patched before, using the cached result", "SUCCESS")
+        self.log(f"Patched boot SHA256: {digest.sha256}", "INFO")
+        if output_path:
+            self.log(f"Saved to: {output_path}", "SUCCESS")
+        self.events.emit("output", path=os.path.abspath(dst_path), size=digest.size,
+                         sha256=digest.sha256, sha1=digest.sha1)
+        original = report.get("input", {})
+        result = PatchResult(os.path.abspath(dst_path), digest.sha256,
+                             original.get("sha256", ""), original.get("sha1", ""))
+        return result, report
+
+    def store_result(self, key, result):
+        """Save a finished image and its report to the result cache"""
+        try:
+            self.result_cache.store(key, result.output_path, result.sha256, self.report)
+        except OSError as e:
+            self.log(f"Failed to cache result: {str(e)}", "WARNING")
+
+    def lookup_payload(self, apk_path, arch):
+        """Return the cached payload entry for (APK, arch), or None"""
+        if not self.payload_cache:
+            return None
+        try:
+            return self.payload_cache.lookup(apk_path, arch)
+        except OSError as e:
+            self.log(f"Payload cache unavailable: {str(e)}", "WARNING")
+            return None
+
+    def store_payload(self, apk_path, arch, needed_files, work_dir):
+        """Save extracted binaries and their xz payloads to the payload cache"""
+        if not self.payload_cache:
+            return
+        files = dict(needed_files)
+        for filename in OVERLAY_BINARIES + ["stub"]:
+            xz_path = os.path.join(work_dir, f"{filename}.xz")
+            if os.path.exists(xz_path):
+                files[f"{filename}.xz"] = xz_path
+        try:
+            self.payload_cache.store(apk_path, arch, files)
+            self.log(f"Cached payload for architecture: {arch}", "INFO")
+        except OSError as e:
+            self.log(f"Failed to cache payload: {str(e)}", "WARNING")
+
+    def prepare_payload(self, apk_path, arch):
+        """Extract and compress the payload for (APK, arch) into the payload cache"""
+        return self.prepare_payloads(apk_path, [arch]).get(arch, False)
+
+    def prepare_payloads(self, apk_path, archs=None, output_dir=None):
+        """Extract and compress the payloads of several architectures at once
+
+        All architectures (default: every ABI in the APK) are inflated in one
+        parallel pass over the APK, then compressed and stored in the payload
+        cache. Used to warm the cache once before a batch fans out to
+        workers. With output_dir the payloads are also kept there, one
+        directory per architecture.
+
+        Returns a mapping of arch to whether its payload is ready.
+        """
+        try:
+            index = load_apk_index(apk_path)
+        except (OSError, ApkError) as e:
+            self.log(f"Failed to read APK: {str(e)}", "ERROR")
+            return {}
+
+        archs = archs or index.archs
+        prepared = {}
+        missing = []
+        for arch in archs:
+            if output_dir is None and self.lookup_payload(apk_path, arch):
+                prepared[arch] = True
+            elif not index.has_arch(arch):
+                self.log(f"Architecture {arch} not available in this APK", "ERROR")
+                prepared[arch] = False
+            else:
+                missing.append(arch)
+        if not missing:
+            return prepared
+
+        self.log(f"Extracting payloads for: {', '.join(missing)}", "INFO")
+        work_dir = output_dir or tempfile.mkdtemp(prefix="magisk_patch_")
+        try:
+            payloads = index.extract_archs(missing, work_dir)
+            for arch in missing:
+                needed_files = payloads[arch]
+                if "magiskinit" not in needed_files:
+                    self.log(f"Missing required files for {arch}: magiskinit", "ERROR")
+                    prepared[arch] = False
+                    continue
+                arch_dir = os.path.join(work_dir, arch)
+                self.compress_payloads(needed_files, arch_dir)
+                self.store_payload(apk_path, arch, needed_files, arch_dir)
+                prepared[arch] = True
+        except (OSError, zipfile.BadZipFile) as e:
+            self.log(f"Failed to extract from APK: {str(e)}", "ERROR")
+            for arch in missing:
+                prepared.setdefault(arch, False)
+        finally:
+            if output_dir:
+                shutil.rmtree(os.path.join(output_dir, ".members"), ignore_errors=True)
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        return prepared
+
+    def check_ramdisk(self, ramdisk_path, work_dir, env):
+        """Detect stock or Magisk patched ramdisk and keep the original for backup
+
+        With the native cpio backend this returns (ramdisk, origin) archives
+        held in memory; the magiskboot backend copies ramdisk.cpio.orig
+        instead and returns None.
+        """
+        if not os.path.exists(ramdisk_path):
+            self.log("No ramdisk found (skip_initramfs)", "WARNING")
+            self.events.emit("ramdisk", state="absent")
+            return None
+
+        self.log("Checking ramdisk status...", "INFO")
+        if self.cpio_backend == "native":
+            return self._check_ramdisk_native(ramdisk_path, work_dir)
+
+        result = self.magiskboot(["cpio", "ramdisk.cpio", "test"], work_dir, env)
+        self.events.emit("ramdisk", state=RAMDISK_STATES.get(result, "unsupported"), code=result)
+
+        if result == 0:
+            self.log("Stock boot image detected", "SUCCESS")
+            clone_file(ramdisk_path, ramdisk_path + ".orig")
+        elif result == 1:
+            self.log("Magisk patched boot image detected", "WARNING")
+            self.magiskboot(["cpio", "ramdisk.cpio", "extract .backup/.magisk config.orig", "restore"],
+                            work_dir, env)
+            clone_file(ramdisk_path, ramdisk_path + ".orig")
+        else:
+            raise PatchError("Boot image patched by unsupported programs!")
+        return None
+
+    def _check_ramdisk_native(self, ramdisk_path, work_dir):
+        try:
+            ramdisk = Cpio.load(ramdisk_path, log=lambda message: self.log(message, "DEBUG"))
+        except CpioError as e:
+            raise PatchError(f"Failed to read ramdisk: {str(e)}")
+
+        result = ramdisk.test()
+        self.events.emit("ramdisk", state=RAMDISK_STATES[result], code=result,
+                         entries=len(ramdisk.entries))
+        if result == STOCK:
+            self.log("Stock boot image detected", "SUCCESS")
+        elif result == MAGISK_PATCHED:
+            self.log("Magisk patched boot image detected", "WARNING")
+            if ramdisk.exists(".backup/.magisk"):
+                ramdisk.extract(".backup/.magisk", os.path.join(work_dir, "config.orig"))
+            ramdisk.restore()
+        else:
+            raise PatchError("Boot image patched by unsupported programs!")
+
+        # The backup diff is taken against this index, no copy of the archive
+        return ramdisk, ramdisk.snapshot()
+
+    def boot_sha1(self, input_digest, work_dir):
+        """Return the stock boot image SHA1 to record in the config
+
+        This is the SHA1 taken while staging boot.img, which is what
+        `magiskboot sha1 boot.img` prints. When re-patching a Magisk image the
+        stock SHA1 is read back from the restored config.orig instead.
+        """
+        sha1 = input_digest.sha1
+        config_orig = os.path.join(work_dir, "config.orig")
+        if os.path.exists(config_orig):
+            with open(config_orig, 'r', errors='replace') as f:
+                for line in f:
+                    if line.startswith("SHA1="):
+                        sha1 = line.strip()[len("SHA1="):]
+                        self.log("Using stock SHA1 from previous Magisk config", "INFO")
+                        break
+            return sha1
+
+        if self.debug and self.supports("sha1"):
+            reference = self.run_command_output([self.magiskboot_path, "sha1", "boot.img"],
+                                                cwd=work_dir)
+            if reference == sha1:
+                self.log("SHA1 matches magiskboot sha1", "DEBUG")
+            else:
+                self.log(f"SHA1 mismatch: native {sha1}, magiskboot {reference}", "WARNING")
+                sha1 = reference or sha1
+
+        self.log(f"Boot image SHA1: {sha1}", "INFO")
+        return sha1
+
+    def compress_payloads(self, needed_files, work_dir, env=None):
+        """Compress the overlay binaries and stub.apk with xz"""
+        self.log("", "")
+        self.log("Compressing files...", "INFO")
+
+        files = []
+        for filename in OVERLAY_BINARIES:
+            if filename in needed_files:
+                files.append((filename, needed_files[filename],
+                              os.path.join(work_dir, f"{filename}.xz")))
+        if "stub.apk" in needed_files:
+            files.append(("stub.apk", needed_files["stub.apk"], os.path.join(work_dir, "stub.xz")))
+
+        backend = self.xz_backend
+        if backend == "lzma" and self.verify_xz and files and self.supports("compress"):
+            try:
+                compatible = xz_backend.verify_compatibility(self.magiskboot_path, files[0][1],
+                                                             self.runner)
+            except CommandCancelled:
+                raise PatchCancelled("Patch cancelled")
+            if compatible:
+                self.log("lzma output matches magiskboot compress=xz", "SUCCESS")
+            else:
+                self.log("lzma output differs from magiskboot, using magiskboot", "WARNING")
+                backend = "magiskboot"
+
+        if backend == "lzma":
+            for filename, _, _ in files:
+                self.log(f"Compressing {filename}...", "INFO")
+            try:
+                xz_backend.compress_many((src, dst) for _, src, dst in files)
+            except (OSError, lzma.LZMAError) as e:
+                raise PatchError(f"Failed to compress payload: {str(e)}")
+        else:
+            for filename, _, _ in files:
+                self.log(f"Compressing {filename}...", "INFO")
+            self.magiskboot_many([["compress=xz", src_path, xz_path]
+                                  for _, src_path, xz_path in files], work_dir, env)
+
+    def write_config(self, config_path, flags, sha1=""):
+        """Write the .backup/.magisk config file"""
+        with open(config_path, 'w') as f:
+            for key, value in flags.items():
+                f.write(f"{key}={value}\n")
+            if sha1:
+                f.write(f"SHA1={sha1}\n")
+
+    def patch_ramdisk(self, work_dir, env, ramdisk=None, options=None):
+        """Install magiskinit and the overlay payloads into ramdisk.cpio"""
+        self.log("", "")
+        self.log("Patching ramdisk...", "INFO")
+
+        if ramdisk is not None:
+            self._patch_ramdisk_native(work_dir, ramdisk, options or PatchOptions())
+            return
+
+        cpio_commands = [
+            "cpio", "ramdisk.cpio",
+            "add 0750 init magiskinit",
+            "mkdir 0750 overlay.d",
+            "mkdir 0750 overlay.d/sbin"
+        ]
+
+        # Add compressed files
+        for filename in OVERLAY_BINARIES + ["stub"]:
+            xz_file = f"{filename}.xz"
+            if os.path.exists(os.path.join(work_dir, xz_file)):
+                cpio_commands.append(f"add 0644 overlay.d/sbin/{xz_file} {xz_file}")
+
+        cpio_commands.extend([
+            "patch",
+            "backup ramdisk.cpio.orig",
+            "mkdir 000 .backup",
+            "add 000 .backup/.magisk config"
+        ])
+
+        if self.magiskboot(cpio_commands, work_dir, env) != 0:
+            raise PatchError("Failed to patch ramdisk!")
+
+    def _patch_ramdisk_native(self, work_dir, ramdisk, options):
+        ramdisk, origin = ramdisk
+        try:
+            ramdisk.add(0o750, "init", os.path.join(work_dir, "magiskinit"))
+            ramdisk.mkdir(0o750, "overlay.d")
+            ramdisk.mkdir(0o750, "overlay.d/sbin")
+
+            # Add compressed files
+            for filename in OVERLAY_BINARIES + ["stub"]:
+                xz_path = os.path.join(work_dir, f"{filename}.xz")
+                if os.path.exists(xz_path):
+                    ramdisk.add(0o644, f"overlay.d/sbin/{filename}.xz", xz_path)
+
+            ramdisk.patch(options.keep_verity, options.keep_force_encrypt)
+            ramdisk.backup(origin)
+            ramdisk.mkdir(0o000, ".backup")
+            ramdisk.add(0o000, ".backup/.magisk", os.path.join(work_dir, "config"))
+            ramdisk.dump(os.path.join(work_dir, "ramdisk.cpio"))
+        except (OSError, CpioError) as e:
+            raise PatchError(f"Failed to patch ramdisk: {str(e)}")
+
+    def patch_kernel(self, kernel_path, work_dir, env, legacy_sar=False):
+        """Apply kernel hexpatches, dropping the kernel if nothing matched
+
+        Returns a mapping of applied pattern to the offsets it matched.
+        """
+        self.log("", "")
+        self.log("Patching kernel...", "INFO")
+
+        patches = kernel_patches(legacy_sar)
+        if self.hexpatch_backend == "native":
+            try:
+                matches = apply_hexpatches(kernel_path, patches)
+            except OSError as e:
+                raise PatchError(f"Failed to patch kernel: {str(e)}")
+        else:
+            matches = {}
+            for patch in patches:
+                result = self.magiskboot(["hexpatch", "kernel", patch.old.hex().upper(),
+                                          patch.new.hex().upper()], work_dir, env)
+                matches[patch.name] = [-1] if result == 0 else []
+
+        applied = {name: offsets for name, offsets in matches.items() if offsets}
+        for name, offsets in applied.items():
+            if name == "legacy SAR":
+                self.log("Applied legacy SAR patch", "SUCCESS")
+            else:
+                self.log(f"Applied kernel patch: {name}", "SUCCESS")
+            if offsets[0] >= 0:
+                self.log(f"  at {', '.join(f'{offset:#x}' for offset in offsets)}", "DEBUG")
+
+        self.events.emit("kernel", matches=applied, patched=bool(applied))
+        if not applied:
+            os.remove(kernel_path)
+            self.log("No kernel patches applied", "INFO")
+        return applied
+
+    def patch_dtbs(self, work_dir, env):
+        """Test and patch every device tree blob produced by unpack
+
+        The dtb, kernel_dtb and extra files are independent, so each runs
+        its test and patch on its own thread; their logs are replayed in
+        DTB_FILES order afterwards. The native backend does both in one
+        mmap pass per file.
+        """
+        present = [dt for dt in DTB_FILES if os.path.exists(os.path.join(work_dir, dt))]
+        keep_verity = (env or {}).get("KEEPVERITY", "true") == "true"
+
+        def check(dt):
+            lines = []
+            log = lambda message, level="INFO": lines.append((message, level))
+            if self.dtb_backend == "native":
+                try:
+                    passed, patched, _ = check_and_patch(os.path.join(work_dir, dt), keep_verity,
+                                                         log=log)
+                except (OSError, FdtError) as e:
+                    raise PatchError(f"Failed to patch {dt}: {str(e)}")
+                return (0 if passed else 1), patched, lines
+            test = self.magiskboot(["dtb", dt, "test"], work_dir, env, log=log)
+            patched = self.magiskboot(["dtb", dt, "patch"], work_dir, env, log=log) == 0
+            return test, patched, lines
+
+        for dt, (test, patched, lines) in zip(present, self._map_concurrent(check, present)):
+            self.log("", "")
+            self.log(f"Checking {dt}...", "INFO")
+            for message, level in lines:
+                self.log(message, level)
+            if test != 0:
+                self.log(f"{dt} was patched by old Magisk", "WARNING")
+            if patched:
+                self.log(f"Patched {dt} successfully", "SUCCESS")
+            self.events.emit("dtb", file=dt, test=test, patched=patched)
+
+    def patch_vbmeta(self, image_path):
+        """Disable AVB verification in the vbmeta behind the image's AVB footer
+
+        Images without a footer carry no vbmeta and are left alone; their
+        vbmeta partition has to be patched separately.
+        """
+        try:
+            offset, source, old_flags = patch_vbmeta_flags(image_path, DISABLE_FLAGS)
+        except VbmetaError as e:
+            self.log(f"No vbmeta to patch: {str(e)}", "INFO")
+            self.events.emit("vbmeta", found=False, patched=False)
+            return False
+        except OSError as e:
+            raise PatchError(f"Failed to patch vbmeta flags: {str(e)}")
+
+        if old_flags != DISABLE_FLAGS:
+            self.log(f"Patched vbmeta flags {old_flags:#x} -> {DISABLE_FLAGS:#x}", "SUCCESS")
+        self.events.emit("vbmeta", found=True, source=source, offset=offset,
+                         old_flags=old_flags, flags=DISABLE_FLAGS,
+                         patched=old_flags != DISABLE_FLAGS)
+        return old_flags != DISABLE_FLAGS
+
+    def _map_concurrent(self, func, items):
+        """Map func over items on threads, bounded by the runner's process slots"""
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(len(items), self.runner.max_processes)) as pool:
+            return list(pool.map(func, items))
+
+    def magiskboot(self, args, cwd, env=None, log=None):
+        """Run a magiskboot subcommand"""
+        return self.run_command([self.magiskboot_path] + args, cwd=cwd, env=env, log=log)
+
+    def magiskboot_many(self, calls, cwd, env=None):
+        """Run independent magiskboot subcommands concurrently, returning their exit codes
+
+        Output is buffered per call and logged in call order.
+        """
+        def run(args):
+            lines = []
+            returncode = self.magiskboot(args, cwd, env,
+                                         log=lambda message, level="INFO": lines.append((message, level)))
+            return returncode, lines
+
+        returncodes = []
+        for returncode, lines in self._map_concurrent(run, calls):
+            for message, level in lines:
+                self.log(message, level)
+            returncodes.append(returncode)
+        return returncodes
+
+    def run_command(self, cmd, cwd=None, env=None, log=None, timeout=None):
+        """Run command through the runner, logging its output line by line
+
+        Returns the exit code, or -1 when the command could not start or
+        timed out. Raises PatchCancelled when the run was cancelled.
+        """
+        if isinstance(cmd, str):
+            cmd = cmd.split()
+        log = log or self.log
+
+        # Log command
+        log(f"$ {' '.join(cmd)}", "DEBUG")
+        try:
+            result = self.runner.run(cmd, cwd=cwd, env=env, timeout=timeout,
+                                     on_line=lambda line: log(line.strip()))
+        except CommandCancelled:
+            self.events.emit("command", argv=cmd, returncode=-1, error="cancelled")
+            raise PatchCancelled("Patch cancelled")
+
+        fields = {"argv": cmd, "returncode": result.returncode, "seconds": round(result.seconds, 6)}
+        if result.error:
+            log(f"Command failed: {result.error}", "ERROR")
+            fields["error"] = result.error
+        if result.timed_out:
+            fields["timed_out"] = True
+        self.events.emit("command", **fields)
+        return result.returncode
+
+    def run_command_output(self, cmd, cwd=None, env=None):
+        """Run command and return its stdout, or "" if it failed"""
+        if isinstance(cmd, str):
+            cmd = cmd.split()
+        try:
+            result = self.runner.run(cmd, cwd=cwd, env=env, merge_stderr=False)
+        except CommandCancelled:
+            raise PatchCancelled("Patch cancelled")
+        return "" if result.error else result.output.strip()
+
+    def extract_from_apk(self, apk_path, arch, temp_dir):
+        """Extract necessary files from Magisk APK"""
+        self.log("Extracting files from APK...", "INFO")
+
+        try:
+            index = load_apk_index(apk_path)
+
+            if index.version_code or index.version_name:
+                self.log(f"Magisk version: {index.version_name} ({index.version_code})", "INFO")
+            else:
+                self.log("Could not determine Magisk version", "WARNING")
+            self.log(f"Available architectures: {', '.join(index.archs)}", "INFO")
+
+            members = index.payload_members(arch)
+            needed_files = index.extract(members, temp_dir)
+            for output_name, info in members.items():
+                if output_name == "magisk32" and f"/{arch}/" not in info.filename:
+                    self.log(f"Extracted: {output_name} (32-bit compat)", "SUCCESS")
+                else:
+                    self.log(f"Extracted: {output_name}", "SUCCESS")
+
+        except (OSError, ApkError, zipfile.BadZipFile) as e:
+            self.log(f"Failed to extract from APK: {str(e)}", "ERROR")
+            return None
+
+        # Check if we got the required files
+        missing_files = [f for f in REQUIRED_PAYLOADS if f not in needed_files]
+
+        if missing_files:
+            self.log(f"Missing required files: {', '.join(missing_files)}", "ERROR")
+
+            # Check if wrong architecture
+            if not index.has_arch(arch):
+                self.log(f"Architecture {arch} not available in this APK", "ERROR")
+                self.log(f"Try one of: {', '.join(index.archs)}", "WARNING")
+
+            return None
+
+        return needed_files
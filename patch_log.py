@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Log records and structured events for the patch pipeline
+Workers push records into a queue and the UI drains them in batches;
+each run also emits a JSON-lines event stream and a final report.
+"""
+
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class LogRecord:
+    """One log line: wall-clock time, level and message"""
+
+    __slots__ = ["created", "level", "message"]
+
+    def __init__(self, message, level="INFO", created=None):
+        self.created = created if created is not None else time.time()
+        self.level = level
+        self.message = message
+
+    @property
+    def timestamp(self):
+        return time.strftime("%H:%M:%S", time.localtime(self.created))
+
+    def format(self):
+        if not self.level:
+            return self.message
+        return f"[{self.timestamp}] [{self.level}] {self.message}"
+
+
+class QueueLogSink:
+    """Log callable that never blocks: records go into a queue for a consumer
+
+    Besides log records the queue may carry plain callables, which lets
+    worker threads hand UI updates to the thread that drains it.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def __call__(self, message, level="INFO"):
+        self.queue.put(LogRecord(message, level))
+
+    def call(self, function, *args):
+        """Queue function(*args) to run on the draining thread"""
+        self.queue.put(lambda: function(*args))
+
+    def drain(self, limit):
+        """Return up to limit queued items without waiting"""
+        items = []
+        try:
+            while len(items) < limit:
+                items.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
+
+class EventLog:
+    """Structured JSON-lines event stream of one patch run
+
+    Every event is kept in memory and, when a text stream is given, also
+    written to it as one JSON object per line. build_report() folds the
+    events into the final machine-readable report. With a StageTimer,
+    every stage_end also carries the stage's resource metrics.
+    """
+
+    def __init__(self, stream=None, run_id=None, timer=None):
+        self.stream = stream
+        self.run_id = run_id
+        self.timer = timer
+        self.events = []
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        record = {"ts": round(time.time(), 6), "event": event}
+        if self.run_id:
+            record["run"] = self.run_id
+        record.update(fields)
+        with self._lock:
+            self.events.append(record)
+            if self.stream:
+                self.stream.write(json.dumps(record, default=str) + "\n")
+                self.stream.flush()
+        return record
+
+    @contextmanager
+    def stage(self, name):
+        """Emit stage_start/stage_end around a block
+
+        The block receives a dict; fields put there (e.g. bytes) are added
+        to the stage_end event.
+        """
+        self.emit("stage_start", stage=name)
+        started = time.perf_counter()
+        info = {}
+        metrics = None
+        try:
+            with self.timer.measure(name) if self.timer else nullcontext() as metrics:
+                yield info
+        except BaseException as e:
+            info.update(status="failed", error=str(e))
+            raise
+        finally:
+            if metrics is not None:
+                info["metrics"] = metrics.to_dict()
+            self.emit("stage_end", stage=name, status=info.pop("status", "ok"),
+                      seconds=round(time.perf_counter() - started, 6), **info)
+
+    def write_jsonl(self, path):
+        with open(path, "w") as f:
+            for record in self.events:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def build_report(self):
+        return build_report(self.events)
+
+
+def build_report(events):
+    """Fold an event list into the final patch report"""
+    report = {
+        "status": "unknown",
+        "error": "",
+        "seconds": 0.0,
+        "stages": {},
+        "commands": [],
+        "bytes_processed": 0,
+    }
+
+    for record in events:
+        event = record["event"]
+        fields = {key: value for key, value in record.items() if key not in ("ts", "event", "run")}
+
+        if event == "run_start":
+            report.update(fields)
+            report["started"] = record["ts"]
+        elif event == "run_end":
+            report["status"] = fields.get("status", "unknown")
+            report["error"] = fields.get("error", "")
+            report["seconds"] = fields.get("seconds", 0.0)
+        elif event == "stage_end":
+            stage = dict(fields)
+            name = stage.pop("stage")
+            report["stages"][name] = stage
+            report["bytes_processed"] += stage.get("bytes", 0)
+        elif event == "command":
+            report["commands"].append(fields)
+        elif event in ("input", "output", "payload", "ramdisk", "kernel", "vbmeta", "scratch"):
+            report[event] = fields
+        elif event == "dtb":
+            report.setdefault("dtb", {})[fields.pop("file")] = fields
+        elif event == "result_cache":
+            report["result_cache"] = dict(fields, hit=False)
+
+    return report
+
+
+def write_report(report, path):
+    """Write a patch report as indented JSON"""
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+        f.write("\n")
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+On-disk caches for the patch pipeline
+Entries are directories of files, evicted least-recently-used under a size cap
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from fastcopy import clone_file
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+DEFAULT_RESULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+ENTRY_INFO = "entry.json"
+
+# Bump when a pipeline change alters the bytes of patched images
+RESULT_CACHE_VERSION = "2"
+
+
+def default_cache_dir():
+    """Return the cache root, honouring MAGISK_PATCHER_CACHE and XDG_CACHE_HOME"""
+    if os.environ.get("MAGISK_PATCHER_CACHE"):
+        return os.environ["MAGISK_PATCHER_CACHE"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "magisk_patcher")
+
+
+def _sha256_file(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def parse_size(text):
+    """Parse a size such as 512M or 2G into bytes"""
+    text = str(text).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+class DiskLRUCache:
+    """Directory-per-entry cache with LRU eviction under a size cap
+
+    Entries are published with an atomic rename so concurrent batch workers
+    can fill the same cache; the loser of a race simply discards its copy.
+    Recency is tracked through the entry directory mtime.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_CACHE_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """Return the entry info for key and mark it recently used, or None"""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, ENTRY_INFO), 'r') as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        for filename in info["files"].values():
+            if not os.path.exists(os.path.join(entry_dir, filename)):
+                self.remove(key)
+                return None
+
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        info["path"] = entry_dir
+        return info
+
+    def file_path(self, info, name):
+        """Return the absolute path of a named file in an entry"""
+        return os.path.join(info["path"], info["files"][name])
+
+    def put(self, key, files, metadata=None):
+        """Store files (name -> source path) under key and return the entry info"""
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=self.root)
+        try:
+            stored = {}
+            size = 0
+            for name, src_path in files.items():
+                filename = os.path.basename(src_path)
+                clone_file(src_path, os.path.join(staging, filename))
+                stored[name] = filename
+                size += os.path.getsize(src_path)
+
+            info = {"key": key, "files": stored, "size": size, "created": time.time(),
+                    "metadata": metadata or {}}
+            with open(os.path.join(staging, ENTRY_INFO), 'w') as f:
+                json.dump(info, f, indent=2)
+
+            try:
+                os.rename(staging, self._entry_dir(key))
+            except OSError:
+                # Another worker published the same entry first
+                shutil.rmtree(staging, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        self.evict(keep=key)
+        return self.get(key)
+
+    def remove(self, key):
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def entries(self):
+        """Return (mtime, size, key) for every published entry"""
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith("."):
+                continue
+            entry_dir = self._entry_dir(key)
+            try:
+                with open(os.path.join(entry_dir, ENTRY_INFO), 'r') as f:
+                    size = json.load(f).get("size", 0)
+                entries.append((os.path.getmtime(entry_dir), size, key))
+            except (OSError, ValueError):
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits max_bytes"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+
+
+class PayloadCache(DiskLRUCache):
+    """Extracted binaries and xz payloads of a Magisk APK, keyed by APK SHA256 + arch"""
+
+    def __init__(self, root=None, max_bytes=DEFAULT_CACHE_SIZE):
+        super().__init__(os.path.join(root or default_cache_dir(), "payloads"), max_bytes)
+        self._apk_hashes = {}
+
+    def apk_sha256(self, apk_path):
+        """SHA256 of an APK, memoized per path, size and mtime"""
+        stat = os.stat(apk_path)
+        memo_key = (os.path.abspath(apk_path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._apk_hashes:
+            self._apk_hashes[memo_key] = _sha256_file(apk_path)
+        return self._apk_hashes[memo_key]
+
+    def remember_sha256(self, apk_path, sha256):
+        """Seed the APK hash memo with a known SHA256, e.g. from the release catalog"""
+        stat = os.stat(apk_path)
+        self._apk_hashes[(os.path.abspath(apk_path), stat.st_size, stat.st_mtime_ns)] = sha256
+
+    def key_for(self, apk_path, arch):
+        return f"{self.apk_sha256(apk_path)}-{arch}"
+
+    def lookup(self, apk_path, arch):
+        return self.get(self.key_for(apk_path, arch))
+
+    def store(self, apk_path, arch, files):
+        return self.put(self.key_for(apk_path, arch), files,
+                        {"apk": os.path.basename(apk_path), "arch": arch})
+
+    def restore(self, info, work_dir):
+        """Link or copy a cached payload into work_dir, returning name -> path
+
+        The pipeline only reads payload files, so hardlinks to the entry are safe.
+        """
+        restored = {}
+        for name in info["files"]:
+            dst = os.path.join(work_dir, info["files"][name])
+            clone_file(self.file_path(info, name), dst, allow_link=True)
+            restored[name] = dst
+        return restored
+
+
+class ResultCache(DiskLRUCache):
+    """Patched images and their reports, keyed by every input of a patch run
+
+    The key covers the boot image and APK contents, the arch, the five patch
+    flags and the magiskboot binary, so a hit is the image a fresh run would
+    produce. Each entry records the image SHA256, checked when it is restored.
+    """
+
+    def __init__(self, root=None, max_bytes=DEFAULT_RESULT_CACHE_SIZE):
+        super().__init__(os.path.join(root or default_cache_dir(), "results"), max_bytes)
+        self._hashes = {}
+
+    def file_sha256(self, path):
+        """SHA256 of a file, memoized per path, size and mtime"""
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._hashes:
+            self._hashes[memo_key] = _sha256_file(path)
+        return self._hashes[memo_key]
+
+    @staticmethod
+    def key_for(boot_sha256, apk_sha256, arch, flags, tool_sha256="", backends=None):
+        """Hash the inputs of a run; flags is PatchOptions.as_flags()
+
+        backends maps each stage to the backend that ran it.
+        """
+        parts = [RESULT_CACHE_VERSION, boot_sha256, apk_sha256, arch, tool_sha256]
+        parts.extend(f"{key}={flags[key]}" for key in sorted(flags))
+        backends = backends or {}
+        parts.extend(f"backend:{stage}={backends[stage]}" for stage in sorted(backends))
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def store(self, key, image_path, image_sha256, report):
+        """Store a patched image and its report under key"""
+        fd, report_path = tempfile.mkstemp(prefix=".report-", suffix=".json", dir=self.root)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+            return self.put(key, {"image": image_path, "report": report_path},
+                            {"sha256": image_sha256})
+        finally:
+            os.remove(report_path)
+
+    def load_report(self, info):
+        with open(self.file_path(info, "report"), 'r') as f:
+            return json.load(f)
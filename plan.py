@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Read-only patch plan
+Predicts what a patch run would do to each boot image without magiskboot
+and without writing anything: the `cpio test` result of the ramdisk, the
+kernel hexpatches that would match, the dtb files unpack would produce and
+whether the APK carries the payload for the architecture.
+"""
+
+import os
+import bz2
+import zlib
+import lzma
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from apk_index import ApkError, load_apk_index
+from bootimg import BootImage, BootImageError, detect_format
+from cpio import Cpio, CpioError
+from fdt import dtb_patch, dtb_test, scan_fdts
+from hexpatch import find_hexpatches
+from patch_engine import DTB_FILES, RAMDISK_STATES, REQUIRED_PAYLOADS, PatchOptions, kernel_patches
+from vbmeta import DISABLE_FLAGS, VBMETA_HEADER_SIZE, VBMETA_MAGIC, read_header
+
+try:
+    import lz4.block
+    import lz4.frame
+except ImportError:  # optional: lz4 sections are then reported as unknown
+    lz4 = None
+
+
+# MTK images wrap the kernel and ramdisk in a 512-byte header
+MTK_HEADER_SIZE = 512
+LZ4_LEGACY_MAGIC = b"\x02\x21\x4c\x18"
+LZ4_LEGACY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Images per worker task; planning one image takes milliseconds
+PLAN_CHUNK_SIZE = 16
+
+
+class PlanError(Exception):
+    """Raised when a section cannot be decoded for planning"""
+
+
+def _decompress_lz4_legacy(data):
+    out = []
+    pos = len(LZ4_LEGACY_MAGIC)
+    while pos + 4 <= len(data):
+        size, = struct.unpack_from("<I", data, pos)
+        if size == 0 or bytes(data[pos:pos + 4]) == LZ4_LEGACY_MAGIC or pos + 4 + size > len(data):
+            break
+        out.append(lz4.block.decompress(bytes(data[pos + 4:pos + 4 + size]),
+                                        uncompressed_size=LZ4_LEGACY_BLOCK_SIZE))
+        pos += 4 + size
+    return b"".join(out)
+
+
+def decompress(data, fmt):
+    """Decode a section the way magiskboot unpack does, returning bytes
+
+    Only the first stream is decoded; anything after it is ignored, as the
+    plan only needs the archive or kernel it holds.
+    """
+    try:
+        if fmt == "gzip":
+            return zlib.decompressobj(wbits=31).decompress(data)
+        if fmt in ("xz", "lzma"):
+            return lzma.LZMADecompressor(lzma.FORMAT_XZ if fmt == "xz" else lzma.FORMAT_ALONE) \
+                .decompress(data)
+        if fmt == "bzip2":
+            return bz2.BZ2Decompressor().decompress(data)
+        if fmt in ("lz4", "lz4_legacy", "lz4_lg"):
+            if lz4 is None:
+                raise PlanError(f"{fmt} needs the lz4 module")
+            if fmt == "lz4":
+                return lz4.frame.decompress(data)
+            return _decompress_lz4_legacy(data)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError, RuntimeError, ValueError) as e:
+        raise PlanError(f"Cannot decompress {fmt}: {str(e)}")
+    return bytes(data)
+
+
+def _unwrap(view):
+    """Return (data view, format) with an MTK header skipped"""
+    fmt = detect_format(view)
+    if fmt == "mtk":
+        view = view[MTK_HEADER_SIZE:]
+        fmt = detect_format(view)
+    return view, fmt
+
+
+def plan_ramdisk(image):
+    """Predict `cpio test` on the image's ramdisk"""
+    if not image.has("ramdisk"):
+        return {"state": "absent"}
+    view, fmt = _unwrap(image.view("ramdisk"))
+    try:
+        ramdisk = Cpio.parse(decompress(view, fmt))
+    except (PlanError, CpioError) as e:
+        return {"state": "unknown", "format": fmt, "error": str(e)}
+    finally:
+        view.release()
+    code = ramdisk.test()
+    return {"state": RAMDISK_STATES[code], "code": code, "format": fmt,
+            "entries": len(ramdisk.entries)}
+
+
+def plan_kernel(image, legacy_sar=False):
+    """Predict which kernel hexpatches would match the unpacked kernel"""
+    if not image.has("kernel"):
+        return {"state": "absent"}
+    view, fmt = _unwrap(image.view("kernel"))
+    try:
+        kernel = decompress(view, fmt)
+    except PlanError as e:
+        return {"state": "unknown", "format": fmt, "error": str(e)}
+    finally:
+        view.release()
+    matches = find_hexpatches(kernel, kernel_patches(legacy_sar))
+    applied = {name: offsets for name, offsets in matches.items() if offsets}
+    return {"state": "present", "format": fmt, "matches": applied, "patched": bool(applied)}
+
+
+def plan_dtbs(image, keep_verity=True):
+    """Predict `dtb test` and `dtb patch` for each dtb file unpack would write
+
+    These are dtb, kernel_dtb and, for PXA headers, extra. The patch runs on
+    an in-memory copy of the section, never on the image.
+    """
+    dtbs = {}
+    for name in DTB_FILES:
+        if not image.has(name):
+            continue
+        data = bytearray(image.view(name))
+        blobs = scan_fdts(data)
+        test = dtb_test(data, blobs)
+        dtbs[name] = {"fdts": len(blobs), "test": 0 if test else 1,
+                      "patched": dtb_patch(data, blobs, keep_verity)}
+    return dtbs
+
+
+def plan_vbmeta(image):
+    """Flags of the vbmeta behind the AVB footer, if any"""
+    if not image.avb_footer:
+        return {"found": False}
+    offset = image.avb_footer["vbmeta_offset"]
+    header = image.read(offset, VBMETA_HEADER_SIZE)
+    if len(header) < VBMETA_HEADER_SIZE or header[:4] != VBMETA_MAGIC:
+        return {"found": False}
+    flags = read_header(header, 0)["flags"]
+    return {"found": True, "source": "footer", "offset": offset, "flags": flags,
+            "patched": flags != DISABLE_FLAGS}
+
+
+def plan_apk(apk_path, arch):
+    """Whether apk_path has the payload extract_from_apk needs for arch"""
+    try:
+        index = load_apk_index(apk_path)
+    except (OSError, ApkError) as e:
+        return {"arch": arch, "present": False, "error": str(e)}
+    members = index.payload_members(arch)
+    missing = [name for name in REQUIRED_PAYLOADS if name not in members]
+    return {"arch": arch, "present": index.has_arch(arch) and not missing,
+            "version_code": index.version_code, "version_name": index.version_name,
+            "archs": index.archs, "payloads": sorted(members), "missing": missing}
+
+
+def plan_image(boot_image, options=None):
+    """Predict the patch of one image; errors are reported in the record"""
+    options = options or PatchOptions()
+    record = {"path": boot_image, "status": "failed", "error": ""}
+    try:
+        with BootImage(boot_image) as image:
+            record["image"] = {"kind": image.kind, "header_version": image.header_version,
+                               "size": image.size}
+            record["ramdisk"] = plan_ramdisk(image)
+            record["kernel"] = plan_kernel(image, options.legacy_sar)
+            record["dtb"] = plan_dtbs(image, options.keep_verity)
+            if options.patch_vbmeta_flag:
+                record["vbmeta"] = plan_vbmeta(image)
+    except (OSError, BootImageError) as e:
+        record["error"] = str(e)
+        return record
+
+    record["status"] = "ok"
+    return record
+
+
+def predict_action(record, apk=None):
+    """Return (action, reason) for a planned image
+
+    action is "patch" for a stock image, "repatch" for one Magisk patched
+    before, "fail" where the pipeline would stop and "unknown" when the
+    ramdisk could not be decoded here.
+    """
+    if record["status"] != "ok":
+        return "fail", record["error"]
+    if apk is not None and not apk["present"]:
+        return "fail", apk.get("error") or f"Architecture {apk['arch']} not available in the APK"
+
+    state = record["ramdisk"]["state"]
+    if state == "unsupported":
+        return "fail", "Boot image patched by unsupported programs"
+    if state == "unknown":
+        return "unknown", record["ramdisk"]["error"]
+    if state == "magisk":
+        return "repatch", "Magisk patched boot image"
+    if state == "absent":
+        return "patch", "No ramdisk (skip_initramfs)"
+    return "patch", "Stock boot image"
+
+
+def plan_images(boot_images, apk_path=None, arch="arm64-v8a", options=None, max_workers=None):
+    """Plan many images over a process pool, returning records in input order
+
+    The APK is indexed once; each record gets the apk prediction plus an
+    "action" and "reason" from predict_action.
+    """
+    options = options or PatchOptions()
+    apk = plan_apk(apk_path, arch) if apk_path else None
+
+    if len(boot_images) <= 1:
+        records = [plan_image(path, options) for path in boot_images]
+    else:
+        max_workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(boot_images))) as pool:
+            records = list(pool.map(plan_image, boot_images, [options] * len(boot_images),
+                                    chunksize=PLAN_CHUNK_SIZE))
+
+    for record in records:
+        if apk is not None:
+            record["apk"] = apk
+        record["action"], record["reason"] = predict_action(record, apk)
+    return records
+
+
+def find_images(paths):
+    """Expand directories to the .img files directly inside them, sorted by name"""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.endswith(".img") and os.path.isfile(os.path.join(path, name)))
+        else:
+            images.append(path)
+    return images
+
+
+def format_plan(records):
+    """Format plan records as a plain text table"""
+    headers = ["IMAGE", "ACTION", "RAMDISK", "KERNEL PATCHES", "DTB", "REASON"]
+    rows = []
+    for r in records:
+        if r["status"] != "ok":
+            rows.append([r["path"], r["action"], "", "", "", r["reason"]])
+            continue
+        kernel = r["kernel"]
+        patches = str(len(kernel["matches"])) if kernel["state"] == "present" else kernel["state"]
+        dtbs = ",".join(name + ("!" if dtb["test"] else "") for name, dtb in r["dtb"].items())
+        rows.append([r["path"], r["action"], r["ramdisk"]["state"], patches, dtbs or "-",
+                     r["reason"]])
+
+    widths = [max(len(str(row[i])) for row in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+
+    counts = {}
+    for r in records:
+        counts[r["action"]] = counts.get(r["action"], 0) + 1
+    lines.append("")
+    lines.append(", ".join(f"{count} {action}" for action, count in sorted(counts.items())))
+    return "\n".join(lines)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Scratch space for patch working directories
+Working directories go to a RAM-backed filesystem (/dev/shm or another
+tmpfs) while they fit a RAM budget, and to the regular temp directory
+otherwise.
+"""
+
+import os
+import tempfile
+
+
+SCRATCH_BACKENDS = ["disk", "ram"]
+DEFAULT_RAM_BUDGET = 512 * 1024 * 1024
+WORK_DIR_PREFIX = "magisk_patch_"
+
+# A run holds boot.img, its unpacked sections, ramdisk.cpio.orig and
+# new-boot.img at once, plus the payload binaries and their xz copies
+BOOT_IMAGE_FACTOR = 4
+PAYLOAD_ALLOWANCE = 64 * 1024 * 1024
+
+
+def default_ram_dir():
+    """Return a writable RAM-backed directory, honouring MAGISK_PATCHER_RAM_DIR"""
+    candidates = [os.environ.get("MAGISK_PATCHER_RAM_DIR"), "/dev/shm"]
+    if hasattr(os, "getuid"):
+        candidates.append(f"/run/user/{os.getuid()}")
+    for path in candidates:
+        if path and os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+
+def estimate_scratch(boot_image):
+    """Bytes a patch of boot_image needs in its working directory"""
+    try:
+        size = os.path.getsize(boot_image)
+    except OSError:
+        size = 0
+    return size * BOOT_IMAGE_FACTOR + PAYLOAD_ALLOWANCE
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchSpace:
+    """Create working directories on the selected scratch backend
+
+    The RAM budget covers every working directory in ram_dir, including
+    those of other batch workers, so parallel jobs share it. A run that
+    would exceed the budget or the free space of ram_dir gets a disk
+    directory instead.
+    """
+
+    def __init__(self, backend="disk", ram_budget=DEFAULT_RAM_BUDGET, ram_dir=None, disk_dir=None):
+        if backend not in SCRATCH_BACKENDS:
+            raise ValueError(f"Unknown scratch backend: {backend}")
+        self.backend = backend
+        self.ram_budget = ram_budget
+        self.ram_dir = ram_dir
+        self.disk_dir = disk_dir
+
+    def ram_in_use(self, ram_dir):
+        """Bytes held by the working directories currently in ram_dir"""
+        total = 0
+        for name in os.listdir(ram_dir):
+            if name.startswith(WORK_DIR_PREFIX):
+                total += _tree_size(os.path.join(ram_dir, name))
+        return total
+
+    def ram_fits(self, ram_dir, needed):
+        try:
+            stat = os.statvfs(ram_dir)
+            free = stat.f_bavail * stat.f_frsize
+            return needed <= free and self.ram_in_use(ram_dir) + needed <= self.ram_budget
+        except OSError:
+            return False
+
+    def make_work_dir(self, needed=0):
+        """Create a working directory, returning (path, backend used)"""
+        if self.backend == "ram":
+            ram_dir = self.ram_dir or default_ram_dir()
+            if ram_dir and self.ram_fits(ram_dir, needed):
+                return tempfile.mkdtemp(prefix=WORK_DIR_PREFIX, dir=ram_dir), "ram"
+        return tempfile.mkdtemp(prefix=WORK_DIR_PREFIX, dir=self.disk_dir), "disk"
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Per-stage resource accounting for the patch pipeline
+Each stage records wall time, CPU time (including magiskboot children),
+peak RSS and I/O bytes, with optional cProfile or tracemalloc capture.
+"""
+
+import os
+import sys
+import time
+import cProfile
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+PROFILERS = ["cprofile", "tracemalloc"]
+
+# Lines of profile output kept per stage
+PROFILE_TOP = 25
+
+
+def _read_proc(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def _io_counters():
+    """Bytes read and written by this process and its reaped children"""
+    counters = {}
+    for line in _read_proc("/proc/self/io").splitlines():
+        key, _, value = line.partition(":")
+        counters[key] = int(value)
+    # rchar/wchar count every read()/write(), including page cache hits
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def _reset_peak_rss():
+    """Reset the kernel high-water mark so the next stage reports its own peak"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes"""
+    for line in _read_proc("/proc/self/status").splitlines():
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    return 0
+
+
+def _child_peak_rss():
+    """Largest peak RSS of any reaped child (magiskboot) in bytes"""
+    if not resource:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cpu_time():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageMetrics:
+    """Resources used by one stage"""
+
+    FIELDS = ["wall", "cpu", "peak_rss", "child_peak_rss", "read_bytes", "write_bytes"]
+
+    def __init__(self, name, wall=0.0, cpu=0.0, peak_rss=0, child_peak_rss=0,
+                 read_bytes=0, write_bytes=0, profile=""):
+        self.name = name
+        self.wall = wall
+        self.cpu = cpu
+        self.peak_rss = peak_rss
+        self.child_peak_rss = child_peak_rss
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.profile = profile
+
+    def to_dict(self):
+        values = {key: getattr(self, key) for key in self.FIELDS}
+        values["wall"] = round(self.wall, 6)
+        values["cpu"] = round(self.cpu, 6)
+        if self.profile:
+            values["profile"] = self.profile
+        return values
+
+
+class StageTimer:
+    """Measure pipeline stages and keep their metrics in order
+
+    profile selects an opt-in profiler ("cprofile" or "tracemalloc") run
+    around every stage; its report is written to profile_dir as a pstats
+    .prof file or a .txt list of the top allocation sites.
+    """
+
+    def __init__(self, profile=None, profile_dir=None):
+        if profile and profile not in PROFILERS:
+            raise ValueError(f"Unknown profiler: {profile}")
+        self.profile = profile
+        self.profile_dir = profile_dir or os.path.join(tempfile.gettempdir(),
+                                                       "magisk_patch_profiles")
+        self.stages = []
+
+    @contextmanager
+    def measure(self, name):
+        metrics = StageMetrics(name)
+        profiler = self._start_profile()
+
+        peak_reset = _reset_peak_rss()
+        read_start, write_start = _io_counters()
+        cpu_start = _cpu_time()
+        wall_start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.wall = time.perf_counter() - wall_start
+            metrics.cpu = _cpu_time() - cpu_start
+            read_end, write_end = _io_counters()
+            metrics.read_bytes = read_end - read_start
+            metrics.write_bytes = write_end - write_start
+            metrics.peak_rss = _peak_rss() if peak_reset or not self.stages else 0
+            metrics.child_peak_rss = _child_peak_rss()
+            metrics.profile = self._stop_profile(name, profiler)
+            self.stages.append(metrics)
+
+    def _start_profile(self):
+        if self.profile == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        if self.profile == "tracemalloc":
+            if tracemalloc.is_tracing():
+                tracemalloc.clear_traces()
+                tracemalloc.reset_peak()
+                return False
+            tracemalloc.start()
+            return True
+        return None
+
+    def _stop_profile(self, name, profiler):
+        """Stop profiling a stage and return where its report went"""
+        if profiler is None:
+            return ""
+
+        if self.profile == "cprofile":
+            profiler.disable()
+            path = self._profile_path(name, ".prof")
+            profiler.dump_stats(path)
+            return path
+
+        # profiler is True when tracing was started for this stage
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if profiler:
+            tracemalloc.stop()
+        lines = [f"Peak traced memory: {peak} bytes"]
+        lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:PROFILE_TOP])
+        path = self._profile_path(name, ".txt")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def _profile_path(self, name, suffix):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(self.profile_dir, f"{os.getpid()}-{len(self.stages):02d}-{name}{suffix}")
+
+    def summary(self):
+        return format_summary(self.stages)
+
+
+def _format_bytes(value):
+    for unit in ["B", "K", "M", "G"]:
+        if abs(value) < 1024 or unit == "G":
+            return f"{value:.0f}{unit}" if unit == "B" else f"{value:.1f}{unit}"
+        value /= 1024
+
+
+def format_summary(stages):
+    """Format stage metrics as a plain text table"""
+    headers = ["STAGE", "WALL", "CPU", "PEAK RSS", "CHILD RSS", "READ", "WRITTEN"]
+    rows = [[s.name, f"{s.wall:.3f}s", f"{s.cpu:.3f}s",
+             _format_bytes(s.peak_rss) if s.peak_rss else "-",
+             _format_bytes(s.child_peak_rss) if s.child_peak_rss else "-",
+             _format_bytes(s.read_bytes), _format_bytes(s.write_bytes)] for s in stages]
+    rows.append(["total", f"{sum(s.wall for s in stages):.3f}s",
+                 f"{sum(s.cpu for s in stages):.3f}s",
+                 _format_bytes(max((s.peak_rss for s in stages), default=0)),
+                 _format_bytes(max((s.child_peak_rss for s in stages), default=0)),
+                 _format_bytes(sum(s.read_bytes for s in stages)),
+                 _format_bytes(sum(s.write_bytes for s in stages))])
+
+    widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+             for row in [headers] + rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    lines.insert(len(lines) - 1, lines[1])
+    return "\n".join(lines)
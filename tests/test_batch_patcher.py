@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from batch_patcher import load_manifest
+from patch_engine import PatchError
+
+
+def write_manifest(tmp_path, jobs):
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps({"defaults": {"apk": "Magisk.apk"}, "jobs": jobs}))
+    return str(path)
+
+
+def test_duplicate_names_get_free_suffixes(tmp_path):
+    manifest = write_manifest(tmp_path, [{"boot": "boot.img"}, {"boot": "boot_1.img"},
+                                         {"boot": "x/boot.img"}, {"boot": "z/boot.img"}])
+    jobs = load_manifest(manifest, str(tmp_path / "out"))
+    names = [job.name for job in jobs]
+    assert names == ["boot", "boot_1", "boot_2", "boot_3"]
+    assert len({job.output_path for job in jobs}) == len(jobs)
+
+
+def test_shared_output_is_rejected(tmp_path):
+    out = tmp_path / "out"
+    manifest = write_manifest(tmp_path, [{"boot": "a.img", "output": "patched.img"},
+                                         {"boot": "b.img", "output": str(out / "patched.img")}])
+    with pytest.raises(PatchError, match="both write"):
+        load_manifest(manifest, str(out))
@@ -0,0 +1,78 @@
+import struct
+
+from bootimg import BootImage, find_fdt
+
+PAGE_SIZE = 2048
+
+
+def fdt_blob(size=64):
+    # Header only: find_fdt checks the magic, totalsize and block offsets
+    header = b"\xd0\x0d\xfe\xed" + struct.pack(">9I", size, 40, 48, 40, 17, 16, 0, 0, 0)
+    return header + bytes(size - len(header))
+
+
+def page_align(data):
+    return data + bytes(-len(data) % PAGE_SIZE)
+
+
+def boot_v0(kernel, ramdisk):
+    header = b"ANDROID!" + struct.pack("<10I", len(kernel), 0x8000, len(ramdisk), 0x1000000,
+                                       0, 0, 0x100, PAGE_SIZE, 0, 0)
+    header += bytes(1632 - len(header))
+    return page_align(header) + page_align(kernel) + page_align(ramdisk)
+
+
+def test_find_fdt_bounded_by_end():
+    data = b"K" * 100 + fdt_blob(64) + b"R" * 100
+    assert find_fdt(data) == 100
+    assert find_fdt(data, 0, 164) == 100
+    # The blob must fit before end, not only its header
+    assert find_fdt(data, 0, 150) == -1
+    assert find_fdt(data, 0, 90) == -1
+    assert find_fdt(data, 101) == -1
+
+
+def test_kernel_dtb_split(tmp_path):
+    path = tmp_path / "boot.img"
+    path.write_bytes(boot_v0(b"\x00" * 4000 + fdt_blob(96), b"ramdisk"))
+    with BootImage(str(path)) as image:
+        assert image.sections["kernel"].size == 4000
+        assert image.sections["kernel_dtb"].size == 96
+
+
+def test_ramdisk_fdt_is_not_kernel_dtb(tmp_path):
+    path = tmp_path / "boot.img"
+    path.write_bytes(boot_v0(b"\x00" * 4000, fdt_blob(96)))
+    with BootImage(str(path)) as image:
+        assert "kernel_dtb" not in image.sections
+        assert image.sections["kernel"].size == 4000
+
+
+def test_fdt_overrunning_kernel_is_ignored(tmp_path):
+    # totalsize claims more than is left of the kernel
+    blob = fdt_blob(64)[:4] + struct.pack(">I", 4096) + fdt_blob(64)[8:]
+    path = tmp_path / "boot.img"
+    path.write_bytes(boot_v0(b"\x00" * 4000 + blob, b"\x00" * 8192))
+    with BootImage(str(path)) as image:
+        assert "kernel_dtb" not in image.sections
+
+
+def boot_pxa(kernel, ramdisk, extra):
+    header = b"ANDROID!" + struct.pack("<10I", len(kernel), 0x8000, len(ramdisk), 0x1000000,
+                                       0, 0xf00000, len(extra), 0x10000000, 0x100, PAGE_SIZE)
+    header += b"pxa".ljust(24, b"\0") + b"console=ttyS0".ljust(512, b"\0")
+    header += bytes(1640 - len(header))
+    return page_align(header) + page_align(kernel) + page_align(ramdisk) + page_align(extra)
+
+
+def test_pxa_extra_section(tmp_path):
+    path = tmp_path / "boot.img"
+    path.write_bytes(boot_pxa(b"\x00" * 3000, b"ramdisk", fdt_blob(96)))
+    with BootImage(str(path)) as image:
+        assert image.pxa
+        assert image.page_size == PAGE_SIZE
+        assert image.name == "pxa"
+        assert image.cmdline == "console=ttyS0"
+        assert image.sections["kernel"].size == 3000
+        assert image.sections["extra"].offset == 4 * PAGE_SIZE
+        assert image.sections["extra"].size == 96
@@ -0,0 +1,78 @@
+import stat
+
+import pytest
+
+from cpio import Cpio, CpioEntry, CpioError, MAGISK_PATCHED, STOCK
+
+
+def make_archive(files):
+    archive = Cpio()
+    archive.mkdir(0o755, "sbin")
+    for name, data in files.items():
+        archive.add(0o644, name, data)
+    return archive
+
+
+def serialized(archive):
+    return b"".join(archive.serialize())
+
+
+def contents(archive):
+    return {name: (entry.mode, bytes(entry.data)) for name, entry in archive.entries.items()}
+
+
+def test_round_trip():
+    archive = make_archive({"init": b"\x7fELF" * 33, "sbin/empty": b"", "fstab.qcom": b"a b c\n"})
+    data = serialized(archive)
+    parsed = Cpio.parse(data)
+    assert contents(parsed) == contents(archive)
+    assert stat.S_ISDIR(parsed.entries["sbin"].mode)
+    # Serializing again gives the same bytes
+    assert serialized(parsed) == data
+
+
+def test_joined_archives():
+    first = serialized(make_archive({"a": b"first"}))
+    second = serialized(Cpio({"b": CpioEntry(stat.S_IFREG | 0o600, b"second")}))
+    parsed = Cpio.parse(first + second)
+    assert sorted(parsed.entries) == ["a", "b", "sbin"]
+    assert bytes(parsed.entries["b"].data) == b"second"
+
+
+def test_joined_archives_with_padding():
+    first = serialized(make_archive({"a": b"first"}))
+    second = serialized(Cpio({"b": CpioEntry(stat.S_IFREG | 0o600, b"second")}))
+    parsed = Cpio.parse(first + b"\0" * 512 + second + b"\0" * 100)
+    assert sorted(parsed.entries) == ["a", "b", "sbin"]
+
+
+def test_truncated_entry():
+    data = serialized(make_archive({"a": b"x" * 100}))
+    with pytest.raises(CpioError):
+        Cpio.parse(data[:200])
+
+
+def test_backup_restore():
+    origin = make_archive({"init": b"stock init", "fstab.qcom": b"/system ext4 verify\n"})
+    patched = origin.snapshot()
+    patched.add(0o750, "init", b"magiskinit")
+    patched.add(0o644, "overlay.d/sbin/magisk.xz", b"payload")
+    patched.rm("fstab.qcom")
+    patched.backup(origin)
+    patched.add(0o000, ".backup/.magisk", b"KEEPVERITY=true\n")
+
+    reparsed = Cpio.parse(serialized(patched))
+    assert reparsed.test() == MAGISK_PATCHED
+    assert reparsed.exists(".backup/init.xz")
+    assert reparsed.exists(".backup/fstab.qcom.xz")
+    assert bytes(reparsed.entries[".backup/.rmlist"].data) == b"overlay.d/sbin/magisk.xz\0"
+
+    reparsed.restore()
+    assert reparsed.test() == STOCK
+    assert contents(reparsed) == contents(origin)
+
+
+def test_restore_without_backup_clears_archive():
+    archive = make_archive({"init": b"init"})
+    archive.restore()
+    assert archive.entries == {}
@@ -0,0 +1,39 @@
+import struct
+
+from plan import plan_images
+from test_bootimg import boot_pxa, boot_v0
+
+
+def fdt_with_bootargs(bootargs):
+    """A device tree with only /chosen/bootargs"""
+    strings = b"bootargs\0"
+    value = bootargs + b"\0"
+    value += bytes(-len(value) % 4)
+    structure = struct.pack(">I", 1) + bytes(4)
+    structure += struct.pack(">I", 1) + b"chosen\0\0"
+    structure += struct.pack(">III", 3, len(bootargs) + 1, 0) + value
+    structure += struct.pack(">III", 2, 2, 9)
+    off_struct = 40 + 16
+    off_strings = off_struct + len(structure)
+    size = off_strings + len(strings)
+    header = struct.pack(">10I", 0xd00dfeed, size, off_struct, off_strings, 40, 17, 16, 0,
+                         len(strings), len(structure))
+    return header + bytes(16) + structure + strings
+
+
+def test_plan_predicts_extra_dtb(tmp_path):
+    path = tmp_path / "pxa.img"
+    path.write_bytes(boot_pxa(b"\x00" * 3000, b"", fdt_with_bootargs(b"skip_initramfs")))
+    record, = plan_images([str(path)])
+    assert record["status"] == "ok"
+    assert record["dtb"] == {"extra": {"fdts": 1, "test": 0, "patched": True}}
+    assert record["action"] == "patch"
+
+
+def test_plan_leaves_image_untouched(tmp_path):
+    path = tmp_path / "boot.img"
+    data = boot_v0(b"\x00" * 3000 + fdt_with_bootargs(b"skip_initramfs"), b"")
+    path.write_bytes(data)
+    record, = plan_images([str(path)])
+    assert record["dtb"]["kernel_dtb"]["patched"]
+    assert path.read_bytes() == data
@@ -0,0 +1,66 @@
+import struct
+
+import pytest
+
+from bootimg import AVB_FOOTER_MAGIC, AVB_FOOTER_SIZE
+from vbmeta import (DISABLE_FLAGS, FLAGS_OFFSET, VBMETA_HEADER_SIZE, VBMETA_MAGIC, VbmetaError,
+                    inspect_vbmeta, patch_vbmeta_flags, vbmeta_record)
+
+
+def vbmeta_header(flags=0):
+    header = bytearray(VBMETA_HEADER_SIZE)
+    header[:4] = VBMETA_MAGIC
+    struct.pack_into(">II", header, 4, 1, 0)
+    struct.pack_into(">QI", header, 112, 0, flags)
+    return bytes(header)
+
+
+def image_with_footer(vbmeta_offset=8192, flags=0, size=16384):
+    data = bytearray(size)
+    data[:8] = b"ANDROID!"
+    data[vbmeta_offset:vbmeta_offset + VBMETA_HEADER_SIZE] = vbmeta_header(flags)
+    footer = AVB_FOOTER_MAGIC + struct.pack(">IIQQQ", 1, 0, vbmeta_offset, vbmeta_offset,
+                                            VBMETA_HEADER_SIZE)
+    data[-AVB_FOOTER_SIZE:] = footer + bytes(AVB_FOOTER_SIZE - len(footer))
+    return bytes(data)
+
+
+def test_patch_footer_vbmeta(tmp_path):
+    path = tmp_path / "boot.img"
+    original = image_with_footer()
+    path.write_bytes(original)
+
+    assert patch_vbmeta_flags(str(path)) == (8192, "footer", 0)
+    patched = path.read_bytes()
+    assert struct.unpack_from(">I", patched, 8192 + FLAGS_OFFSET)[0] == DISABLE_FLAGS
+    # Only the flags word changed
+    changed = [i for i in range(len(original)) if original[i] != patched[i]]
+    assert changed and all(8192 + FLAGS_OFFSET <= i < 8192 + FLAGS_OFFSET + 4 for i in changed)
+
+    assert inspect_vbmeta(str(path))["flags"] == DISABLE_FLAGS
+    assert patch_vbmeta_flags(str(path)) == (8192, "footer", DISABLE_FLAGS)
+    assert path.read_bytes() == patched
+
+
+def test_patch_standalone_vbmeta(tmp_path):
+    path = tmp_path / "vbmeta.img"
+    path.write_bytes(vbmeta_header(flags=0) + bytes(4096))
+    assert patch_vbmeta_flags(str(path), 2) == (0, "vbmeta", 0)
+    assert inspect_vbmeta(str(path))["flags"] == 2
+
+
+def test_footer_outside_image(tmp_path):
+    path = tmp_path / "boot.img"
+    data = bytearray(image_with_footer())
+    struct.pack_into(">Q", data, len(data) - AVB_FOOTER_SIZE + 20, len(data))
+    path.write_bytes(bytes(data))
+    with pytest.raises(VbmetaError):
+        patch_vbmeta_flags(str(path))
+
+
+def test_record_without_vbmeta_is_skipped(tmp_path):
+    path = tmp_path / "plain.img"
+    path.write_bytes(bytes(8192))
+    record = vbmeta_record(str(path))
+    assert record["status"] == "skipped"
+    assert path.read_bytes() == bytes(8192)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+In-process AVB vbmeta flag patching
+Locates the vbmeta header of a standalone vbmeta.img or of an image with an
+AVB footer and rewrites its flags word in place through a writable mmap,
+like `avbtool --flags 3` or magiskboot's PATCHVBMETAFLAG handling.
+"""
+
+import os
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from bootimg import AVB_FOOTER_MAGIC, AVB_FOOTER_SIZE
+
+
+VBMETA_MAGIC = b"AVB0"
+VBMETA_HEADER_SIZE = 256
+# Big-endian u32 after the rollback index, see AvbVBMetaImageHeader
+FLAGS_OFFSET = 120
+RELEASE_OFFSET = 128
+RELEASE_SIZE = 48
+
+FLAG_HASHTREE_DISABLED = 1
+FLAG_VERIFICATION_DISABLED = 2
+# What Magisk writes when PATCHVBMETAFLAG is set
+DISABLE_FLAGS = FLAG_HASHTREE_DISABLED | FLAG_VERIFICATION_DISABLED
+
+
+class VbmetaError(Exception):
+    """Raised when an image has no usable vbmeta header"""
+
+
+def find_vbmeta(data):
+    """Return (offset, source) of the vbmeta header in data
+
+    source is "vbmeta" for a standalone image starting with the header and
+    "footer" when an AVB footer at the end of the image points to it.
+    """
+    if data[:4] == VBMETA_MAGIC:
+        return 0, "vbmeta"
+    if len(data) < AVB_FOOTER_SIZE:
+        raise VbmetaError("Image too small for an AVB footer")
+    footer = len(data) - AVB_FOOTER_SIZE
+    if data[footer:footer + 4] != AVB_FOOTER_MAGIC:
+        raise VbmetaError("No vbmeta header or AVB footer")
+
+    vbmeta_offset, vbmeta_size = struct.unpack_from(">QQ", data, footer + 20)
+    if vbmeta_size < VBMETA_HEADER_SIZE or vbmeta_offset + VBMETA_HEADER_SIZE > footer:
+        raise VbmetaError(f"AVB footer points outside the image ({vbmeta_offset:#x})")
+    if data[vbmeta_offset:vbmeta_offset + 4] != VBMETA_MAGIC:
+        raise VbmetaError(f"No vbmeta header at {vbmeta_offset:#x}")
+    return vbmeta_offset, "footer"
+
+
+def read_header(data, offset):
+    """Decode the fields of the vbmeta header at offset that matter here"""
+    major, minor = struct.unpack_from(">II", data, offset + 4)
+    algorithm, = struct.unpack_from(">I", data, offset + 28)
+    rollback_index, flags = struct.unpack_from(">QI", data, offset + 112)
+    release = bytes(data[offset + RELEASE_OFFSET:offset + RELEASE_OFFSET + RELEASE_SIZE])
+    return {
+        "offset": offset,
+        "libavb_version": f"{major}.{minor}",
+        "algorithm": algorithm,
+        "rollback_index": rollback_index,
+        "flags": flags,
+        "release": release.split(b"\0", 1)[0].decode("ascii", errors="replace"),
+    }
+
+
+def inspect_vbmeta(path):
+    """Return the vbmeta header fields of path without modifying it"""
+    if os.path.getsize(path) == 0:
+        raise VbmetaError("Empty image")
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        offset, source = find_vbmeta(data)
+        header = read_header(data, offset)
+    header["source"] = source
+    return header
+
+
+def patch_vbmeta_flags(path, flags=DISABLE_FLAGS):
+    """Set the vbmeta flags of path in place, returning (offset, source, old flags)
+
+    Only the four bytes of the flags word are written, and only when they
+    change. The signature is left alone: with verification disabled the
+    bootloader no longer checks it, as with `avbtool --flags 3`.
+    """
+    if os.path.getsize(path) == 0:
+        raise VbmetaError("Empty image")
+    with open(path, "r+b") as f, mmap.mmap(f.fileno(), 0) as data:
+        offset, source = find_vbmeta(data)
+        old_flags, = struct.unpack_from(">I", data, offset + FLAGS_OFFSET)
+        if old_flags != flags:
+            struct.pack_into(">I", data, offset + FLAGS_OFFSET, flags)
+            data.flush()
+    return offset, source, old_flags
+
+
+def vbmeta_record(path, flags=DISABLE_FLAGS, dry_run=False):
+    """Patch (or with dry_run only inspect) one image, returning a result record
+
+    Errors are reported in the record instead of raised, so a directory
+    of images can be processed in any order; images without any vbmeta
+    header are "skipped".
+    """
+    record = {"path": path, "status": "failed", "error": "", "source": "",
+              "offset": -1, "old_flags": None, "flags": flags, "patched": False}
+    try:
+        if dry_run:
+            header = inspect_vbmeta(path)
+            offset, source, old_flags = header["offset"], header["source"], header["flags"]
+        else:
+            offset, source, old_flags = patch_vbmeta_flags(path, flags)
+    except VbmetaError as e:
+        record["status"] = "skipped"
+        record["error"] = str(e)
+        return record
+    except (OSError, struct.error) as e:
+        record["error"] = str(e)
+        return record
+
+    record.update(status="ok", source=source, offset=offset, old_flags=old_flags,
+                  patched=old_flags != flags and not dry_run)
+    return record
+
+
+def find_vbmeta_images(directory):
+    """Every .img file directly in directory, sorted by name"""
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.endswith(".img") and os.path.isfile(os.path.join(directory, name))]
+
+
+def patch_vbmeta_images(paths, flags=DISABLE_FLAGS, max_workers=None, dry_run=False):
+    """Patch many images concurrently, returning their records in input order
+
+    Each image is one small in-place write, so a thread pool is enough.
+    """
+    if len(paths) <= 1:
+        return [vbmeta_record(path, flags, dry_run) for path in paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda path: vbmeta_record(path, flags, dry_run), paths))
+
+
+def format_vbmeta_results(records):
+    """One line per image: status, flags change and path"""
+    lines = []
+    for record in records:
+        if record["status"] == "ok":
+            change = f"{record['old_flags']:#x} -> {record['flags']:#x}" if record["patched"] \
+                else f"{record['old_flags']:#x}"
+            lines.append(f"{record['status']:<8} {record['source']:<7} {change:<12} {record['path']}")
+        else:
+            lines.append(f"{record['status']:<8} {'':<7} {record['error']:<12} {record['path']}")
+    return "\n".join(lines)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+In-process xz compression of the ramdisk overlay payloads
+Produces the same stream format as `magiskboot compress=xz`
+"""
+
+import os
+import lzma
+import filecmp
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from command_runner import CommandRunner
+
+
+XZ_BACKENDS = ["lzma", "magiskboot"]
+
+# magiskboot encodes a single LZMA2 filter at preset 9 with a CRC32 check
+MAGISK_XZ_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9}]
+MAGISK_XZ_CHECK = lzma.CHECK_CRC32
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def compress_xz(src_path, dst_path):
+    """Compress src_path to dst_path with Magisk-compatible xz settings"""
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=MAGISK_XZ_CHECK,
+                                     filters=MAGISK_XZ_FILTERS)
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+    return dst_path
+
+
+def compress_many(files, max_workers=None):
+    """Compress (src, dst) pairs concurrently; lzma releases the GIL while encoding"""
+    files = list(files)
+    if not files:
+        return []
+    max_workers = max_workers or min(len(files), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda pair: compress_xz(*pair), files))
+
+
+def compress_with_magiskboot(magiskboot_path, src_path, dst_path, runner=None):
+    """Compress a file with the magiskboot subprocess, returning its exit code"""
+    result = (runner or CommandRunner()).run([magiskboot_path, "compress=xz", src_path, dst_path],
+                                             merge_stderr=False)
+    return result.returncode
+
+
+def verify_compatibility(magiskboot_path, sample_path, runner=None):
+    """Check that the lzma backend output is byte-identical to magiskboot's
+
+    Returns True when both outputs match, False when they differ or
+    magiskboot could not compress the sample.
+    """
+    with tempfile.TemporaryDirectory(prefix="magisk_xz_") as temp_dir:
+        native_path = os.path.join(temp_dir, "native.xz")
+        reference_path = os.path.join(temp_dir, "magiskboot.xz")
+
+        compress_xz(sample_path, native_path)
+        if compress_with_magiskboot(magiskboot_path, sample_path, reference_path, runner) != 0:
+            return False
+        if not os.path.exists(reference_path):
+            return False
+        return filecmp.cmp(native_path, reference_path, shallow=False)